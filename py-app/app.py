@@ -3,11 +3,9 @@ import logging.config
 import logging.config
 import os
 import pathlib
-import random
 import time
+from typing import Callable, Iterable
 
-import cltl.leolani.gestures as gestures
-import requests
 from cltl.about.about import AboutImpl
 from cltl.about.api import About
 from cltl.backend.api.backend import Backend
@@ -25,53 +23,39 @@ from cltl.backend.source.console_source import ConsoleOutput
 from cltl.backend.spi.audio import AudioSource
 from cltl.backend.spi.image import ImageSource
 from cltl.backend.spi.text import TextOutput
+from cltl.brain.infrastructure import StoreConnector
 from cltl.brain.long_term_memory import LongTermMemory
 from cltl.chatui.api import Chats
 from cltl.chatui.memory import MemoryChats
 from cltl.combot.event.bdi import IntentionEvent, Intention
 from cltl.combot.infra.config.k8config import K8LocalConfigurationContainer
-from cltl.combot.infra.di_container import singleton
 from cltl.combot.infra.event import Event
-from cltl.combot.infra.event.memory import SynchronousEventBusContainer
+from cltl.combot.infra.event import EventBus
+from cltl.combot.infra.event.memory import SynchronousEventBusContainer, SynchronousEventBus
 from cltl.combot.infra.event_log import LogWriter
 from cltl.combot.infra.resource.threaded import ThreadedResourceContainer
 from cltl.dialogue_act_classification.api import DialogueActClassifier
-from cltl.dialogue_act_classification.midas_classifier import MidasDialogTagger
-from cltl.dialogue_act_classification.silicone_classifier import SiliconeDialogueActClassifier
 from cltl.emissordata.api import EmissorDataStorage
 from cltl.emissordata.file_storage import EmissorDataFileStorage
 from cltl.emotion_extraction.api import EmotionExtractor
-from cltl.emotion_extraction.utterance_go_emotion_extractor import GoEmotionDetector
-from cltl.emotion_extraction.utterance_vader_sentiment_extractor import VaderSentimentDetector
 from cltl.emotion_responder.api import EmotionResponder
 from cltl.emotion_responder.emotion_responder import EmotionResponderImpl
 from cltl.face_emotion_extraction.api import FaceEmotionExtractor
-from cltl.face_emotion_extraction.context_face_emotion_extractor import ContextFaceEmotionExtractor
 from cltl.face_recognition.api import FaceDetector
-from cltl.face_recognition.proxy import FaceDetectorProxy
 from cltl.factual_question_processing.api import FactualResponder
-from cltl.factual_question_processing.wikipedia_responder import WikipediaResponder
 from cltl.friends.api import FriendStore
-from cltl.friends.brain import BrainFriendsStore
-from cltl.friends.memory import MemoryFriendsStore
 from cltl.g2kmore.api import GetToKnowMore
 from cltl.g2kmore.brain_g2kmore import BrainGetToKnowMore
 from cltl.g2ky.api import GetToKnowYou
-from cltl.g2ky.verbal import VerbalGetToKnowYou
-from cltl.g2ky.visual import VisualGetToKnowYou
 from cltl.mention_extraction.api import MentionExtractor
 from cltl.mention_extraction.default_extractor import DefaultMentionExtractor, TextMentionDetector, \
     NewFaceMentionDetector, ObjectMentionDetector, TextPerspectiveDetector, ImagePerspectiveDetector
 from cltl.nlp.api import NLP
-from cltl.nlp.spacy_nlp import SpacyNLP
 from cltl.object_recognition.api import ObjectDetector
-from cltl.object_recognition.proxy import ObjectDetectorProxy
 from cltl.reply_generation.thought_selectors.random_selector import RandomSelector
 from cltl.triple_extraction.api import DialogueAct
 from cltl.triple_extraction.chat_analyzer import ChatAnalyzer
-from cltl.vad.webrtc_vad import WebRtcVAD
 from cltl.vector_id.api import VectorIdentity
-from cltl.vector_id.clusterid import ClusterIdentity
 from cltl.visualresponder.api import VisualResponder
 from cltl.visualresponder.visualresponder import VisualResponderImpl
 from cltl_service.about.service import AboutService
@@ -108,34 +92,176 @@ from cltl_service.triple_extraction.service import TripleExtractionService
 from cltl_service.vad.service import VadService
 from cltl_service.vector_id.service import VectorIdService
 from cltl_service.visualresponder.service import VisualResponderService
-from emissor.representation.util import serializer as emissor_serializer
 from flask import Flask
 from werkzeug.middleware.dispatcher import DispatcherMiddleware
 from werkzeug.serving import run_simple
 
+from leolani_app import metrics
+from leolani_app.brain_batching import BatchingBrainService
+from leolani_app.brain_client import install_connector, share_connection, store_connector_from_config, \
+    uninstall_connector
+from leolani_app.event_bus import AsyncEventBus
+from leolani_app.event_log import BatchedLogWriter, TypeDispatchSerializer
+from leolani_app.friends import CachedFriendStore
+from leolani_app.inference import InferenceServer, ModelClient
+from leolani_app.metrics import timed_singleton as singleton, InstrumentedEventBus, MetricsService
+from leolani_app.registry import ImplementationRegistry, load_reference
+from leolani_app.replay import DisabledService
+from leolani_app.result_cache import CachedModel, ResultCache, advance_midas_dialog
+from leolani_app.startup import StartupScheduler
+from leolani_app.text_output import RemoteTextOutput
+from leolani_app.triple_extraction import ConcurrentChatAnalyzer, ProgressiveTripleExtractionService, \
+    enable_micro_batching, group_analyzers
+from leolani_app.tracing import Tracer
+
 logging.config.fileConfig(os.environ.get('CLTL_LOGGING_CONFIG', default='config/logging.config'),
                           disable_existing_loggers=False)
 logger = logging.getLogger(__name__)
 
 
+# Implementations are imported only if selected in the configuration
+VAD_IMPLEMENTATIONS = ImplementationRegistry("VAD", {
+    "webrtc": "cltl.vad.webrtc_vad:WebRtcVAD",
+})
+OBJECT_DETECTORS = ImplementationRegistry("ObjectDetector", {
+    "proxy": "cltl.object_recognition.proxy:ObjectDetectorProxy",
+})
+FACE_DETECTORS = ImplementationRegistry("FaceDetector", {
+    "proxy": "cltl.face_recognition.proxy:FaceDetectorProxy",
+})
+DIALOGUE_ACT_CLASSIFIERS = ImplementationRegistry("DialogueClassifier", {
+    "midas": "cltl.dialogue_act_classification.midas_classifier:MidasDialogTagger",
+    "silicone": "cltl.dialogue_act_classification.silicone_classifier:SiliconeDialogueActClassifier",
+})
+EMOTION_EXTRACTORS = ImplementationRegistry("EmotionExtractor", {
+    "Go": "cltl.emotion_extraction.utterance_go_emotion_extractor:GoEmotionDetector",
+    "Vader": "cltl.emotion_extraction.utterance_vader_sentiment_extractor:VaderSentimentDetector",
+})
+# Factories of implementations with an optimized inference backend, see leolani_app.optimized_models
+OPTIMIZED_MODELS = ImplementationRegistry("OptimizedModel", {
+    "midas": "leolani_app.optimized_models:optimized_midas_tagger",
+    "Go": "leolani_app.optimized_models:optimized_go_emotion_detector",
+})
+FACE_EMOTION_EXTRACTORS = ImplementationRegistry("FaceEmotionExtractor", {
+    "emotic": "cltl.face_emotion_extraction.context_face_emotion_extractor:ContextFaceEmotionExtractor",
+})
+NLP_IMPLEMENTATIONS = ImplementationRegistry("NLP", {
+    "spacy": "cltl.nlp.spacy_nlp:SpacyNLP",
+})
+FACTUAL_RESPONDERS = ImplementationRegistry("FactualResponder", {
+    "wikipedia": "cltl.factual_question_processing.wikipedia_responder:WikipediaResponder",
+})
+FRIEND_STORES = ImplementationRegistry("FriendStore", {
+    "brain": "cltl.friends.brain:BrainFriendsStore",
+    "memory": "cltl.friends.memory:MemoryFriendsStore",
+})
+VECTOR_ID_IMPLEMENTATIONS = ImplementationRegistry("VectorIdentity", {
+    "agglomerative": "cltl.vector_id.clusterid:ClusterIdentity.agglomerative",
+    "indexed": "leolani_app.vector_index:IndexedIdentity.indexed",
+})
+G2KY_IMPLEMENTATIONS = ImplementationRegistry("G2KY", {
+    "visual": "cltl.g2ky.visual:VisualGetToKnowYou",
+    "verbal": "cltl.g2ky.verbal:VerbalGetToKnowYou",
+})
+
+
 class InfraContainer(SynchronousEventBusContainer, K8LocalConfigurationContainer, ThreadedResourceContainer):
-    pass
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        metrics.instrument_lifecycle(cls)
+
+    @property
+    @singleton
+    def tracer(self) -> Tracer:
+        config = self.config_manager.get_config("cltl.event.tracing")
+        if "enabled" not in config or not config.get_boolean("enabled"):
+            return False
+
+        return Tracer.from_config(self.config_manager, metrics.registry)
+
+    @property
+    @singleton
+    def event_bus(self) -> EventBus:
+        config = self.config_manager.get_config("cltl.event")
+        implementation = config.get("implementation") if "implementation" in config else "sync"
+
+        if implementation == "sync":
+            event_bus = SynchronousEventBus()
+        elif implementation == "async":
+            event_bus = AsyncEventBus.from_config(self.config_manager, metrics.registry)
+        else:
+            raise ValueError("Unsupported event bus implementation: " + implementation)
+
+        logger.info("Using %s event bus", implementation)
+
+        return InstrumentedEventBus(event_bus, metrics.registry, self.tracer)
+
+    @property
+    @singleton
+    def inference_server(self) -> InferenceServer:
+        return InferenceServer.from_config(self.config_manager, metrics.registry)
+
+    @property
+    @singleton
+    def result_cache(self) -> ResultCache:
+        config = self.config_manager.get_config("cltl.result_cache")
+        if "models" not in config or not config.get("models", multi=True):
+            return False
+
+        return ResultCache.from_config(self.config_manager, metrics.registry)
+
+    def _cached_model(self, name: str, model, model_id: str, methods: Iterable[str], context: int = 0,
+                      on_hit: Callable = None):
+        """Memoize the results of the model in the result cache if configured."""
+        config = self.config_manager.get_config("cltl.result_cache")
+        if not self.result_cache or name not in config.get("models", multi=True):
+            return model
+        if on_hit and isinstance(model, ModelClient):
+            logger.warning("Results of the hosted contextual model %s are not cached", name)
+            return model
+
+        logger.info("Caching results of model %s", model_id)
 
+        return CachedModel(model, self.result_cache, model_id, methods, context, on_hit, name)
 
-class RemoteTextOutput(TextOutput):
-    def __init__(self, remote_url: str):
-        self._remote_url = remote_url
+    @property
+    @singleton
+    def brain_connector(self) -> StoreConnector:
+        connector = store_connector_from_config(self.config_manager, metrics.registry)
+        if not connector:
+            return False
+
+        install_connector(connector)
+
+        return connector
+
+    def _shared_brain(self, component):
+        """Use the shared brain client in the brain component if configured."""
+        if self.brain_connector:
+            replaced = share_connection(component, self.brain_connector)
+            logger.debug("Shared brain client with %s (%s connections)", component.__class__.__name__, replaced)
 
-    def consume(self, text: str, language=None):
-        tts_headers = {'Content-type': 'text/plain'}
+        return component
 
-        # animation = gestures.BOW
-        animation = f"{random.choice(gestures.options)}"
-        print("THIS IS WHAT YOU SHOULD VERBALIZE FOR US:", text, animation)
+    def _load_model(self, name: str, reference: str, *args, **kwargs):
+        """Load the model in a host process of the inference server if configured, otherwise in-process."""
+        if name in self.inference_server:
+            logger.info("Hosting model %s in the inference server", name)
+            return self.inference_server.host(name, reference, *args, **kwargs)
 
-        response = f"\\^startTag({animation}){text}^stopTag({animation})"  #### cannot pass in strings with quotes!!
+        return load_reference(reference)(*args, **kwargs)
 
-        requests.post(f"{self._remote_url}/text", data=response, headers=tts_headers)
+    def stop(self):
+        try:
+            super().stop()
+        finally:
+            logger.info("Stop inference server")
+            self.inference_server.stop()
+            if self.result_cache:
+                self.result_cache.save()
+            if self.brain_connector:
+                uninstall_connector(self.brain_connector)
+                self.brain_connector.close()
 
 
 class BackendContainer(InfraContainer):
@@ -165,7 +291,7 @@ class BackendContainer(InfraContainer):
         config = self.config_manager.get_config("cltl.backend.text_output")
         remote_url = config.get("remote_url")
         if remote_url:
-            return RemoteTextOutput(remote_url)
+            return RemoteTextOutput.from_config(self.config_manager, metrics.registry, self.resource_manager)
         else:
             return ConsoleOutput()
 
@@ -277,8 +403,7 @@ class VADContainer(InfraContainer):
         if not implementation:
             logger.warning("No VAD configured")
             return False
-        if implementation != "webrtc":
-            raise ValueError("Unsupported VAD implementation: " + implementation)
+        vad_class = VAD_IMPLEMENTATIONS.get(implementation)
 
         config = self.config_manager.get_config("cltl.vad.webrtc")
         activity_window = config.get_int("activity_window")
@@ -289,7 +414,7 @@ class VADContainer(InfraContainer):
         # DEBUG
         # storage = "/Users/tkb/automatic/workspaces/robo/eliza-parent/cltl-eliza-app/py-app/storage/audio/debug/vad"
 
-        vad = WebRtcVAD(activity_window, activity_threshold, allow_gap, padding, storage=storage)
+        vad = vad_class(activity_window, activity_threshold, allow_gap, padding, storage=storage)
 
         return VadService.from_config(vad, self.event_bus, self.resource_manager, self.config_manager)
 
@@ -326,19 +451,18 @@ class ASRContainer(EmissorStorageContainer, InfraContainer):
             asr = GoogleASR(impl_config.get("language"), impl_config.get_int("sampling_rate"),
                             hints=impl_config.get("hints", multi=True))
         elif implementation == "whisper":
-            from cltl.asr.whisper_asr import WhisperASR
             impl_config = self.config_manager.get_config("cltl.asr.whisper")
-            asr = WhisperASR(impl_config.get("model"), impl_config.get("language"), storage=storage)
+            asr = self._load_model(implementation, "cltl.asr.whisper_asr:WhisperASR",
+                                   impl_config.get("model"), impl_config.get("language"), storage=storage)
         elif implementation == "speechbrain":
-            from cltl.asr.speechbrain_asr import SpeechbrainASR
             impl_config = self.config_manager.get_config("cltl.asr.speechbrain")
             model = impl_config.get("model")
-            asr = SpeechbrainASR(model, storage=storage)
+            asr = self._load_model(implementation, "cltl.asr.speechbrain_asr:SpeechbrainASR", model, storage=storage)
         elif implementation == "wav2vec":
-            from cltl.asr.wav2vec_asr import Wav2Vec2ASR
             impl_config = self.config_manager.get_config("cltl.asr.wav2vec")
             model = impl_config.get("model")
-            asr = Wav2Vec2ASR(model, sampling_rate=sampling_rate, storage=storage)
+            asr = self._load_model(implementation, "cltl.asr.wav2vec_asr:Wav2Vec2ASR",
+                                   model, sampling_rate=sampling_rate, storage=storage)
         elif not implementation:
             asr = False
         else:
@@ -400,15 +524,43 @@ class TripleExtractionContainer(EmissorStorageContainer, InfraContainer):
             dialogue_acts = [DialogueAct.STATEMENT]
             if "ConversationalQuestionAnalyzer" in implementation:
                 dialogue_acts += [DialogueAct.QUESTION]
-            analyzers.append(ConversationalAnalyzer(model, threshold, max_triples, batch_size, dialogue_acts))
+            conversational_analyzer = ConversationalAnalyzer(model, threshold, max_triples, batch_size, dialogue_acts)
+            batch_delay = config.get_float("batch_delay") if "batch_delay" in config else 0.0
+            batch_max_size = config.get_int("batch_max_size") if "batch_max_size" in config else 32
+            analyzers.append(conversational_analyzer)
+        else:
+            conversational_analyzer, batch_delay = None, 0.0
 
         if not analyzers:
             raise ValueError("No supported analyzers in " + implementation)
 
         logger.info("Using analyzers %s in Triple Extraction", implementation)
-            
-        return TripleExtractionService.from_config(ChatAnalyzer(analyzers, timeout=timeout), self.emissor_data_client, self.event_bus,
-                                                   self.resource_manager, self.config_manager)
+
+        config = self.config_manager.get_config("cltl.triple_extraction")
+        progressive = "progressive" in config and config.get_boolean("progressive")
+        if progressive or "concurrent" in config and config.get_boolean("concurrent"):
+            shared = config.get("shared_analyzers", multi=True) if "shared_analyzers" in config else []
+            deferred = config.get("deferred_analyzers", multi=True) \
+                if progressive and "deferred_analyzers" in config else []
+            replicas = config.get("replicas", multi=True) if "replicas" in config else []
+            replicas = {name.strip(): int(count) for name, count in (entry.split(":") for entry in replicas)}
+            chat_analyzer = ConcurrentChatAnalyzer(group_analyzers(analyzers, shared), timeout, deferred,
+                                                   replicas, metrics.registry)
+        else:
+            replicas = {}
+            chat_analyzer = ChatAnalyzer(analyzers, timeout=timeout)
+
+        # Triple scoring is only called concurrently by replicas of the ConversationalAnalyzer
+        if batch_delay > 0 and replicas.get("ConversationalAnalyzer", 1) > 1:
+            enable_micro_batching(conversational_analyzer, batch_delay / 1000, batch_max_size, metrics.registry)
+        elif batch_delay > 0:
+            logger.warning("Micro-batching of triple scoring is disabled, it requires concurrent triple extraction "
+                           "with replicas of the ConversationalAnalyzer")
+
+        service_class = ProgressiveTripleExtractionService if progressive else TripleExtractionService
+
+        return service_class.from_config(chat_analyzer, self.emissor_data_client, self.event_bus,
+                                         self.resource_manager, self.config_manager)
 
     def start(self):
         logger.info("Start Triple Extraction")
@@ -433,13 +585,18 @@ class BrainContainer(InfraContainer):
         clear_brain = bool(config.get_boolean("clear_brain"))
 
         # TODO figure out how to put the brain RDF files in the EMISSOR scenario folder
-        return LongTermMemory(address=brain_address,
-                              log_dir=pathlib.Path(brain_log_dir),
-                              clear_all=clear_brain)
+        return self._shared_brain(LongTermMemory(address=brain_address,
+                                                 log_dir=pathlib.Path(brain_log_dir),
+                                                 clear_all=clear_brain))
 
     @property
     @singleton
     def brain_service(self) -> BrainService:
+        config = self.config_manager.get_config("cltl.brain")
+        if "write_window" in config and config.get_float("write_window") > 0:
+            return BatchingBrainService.from_config(self.brain, self.event_bus, self.resource_manager,
+                                                    self.config_manager, metrics.registry)
+
         return BrainService.from_config(self.brain, self.event_bus, self.resource_manager, self.config_manager)
 
     def start(self):
@@ -484,6 +641,7 @@ class DisambiguationContainer(BrainContainer, InfraContainer):
             linkers.append(linker)
         if not linkers:
             raise ValueError("Unsupported implementation " + implementations)
+        linkers = [self._shared_brain(linker) for linker in linkers]
 
         logger.info("Initialized DisambiguationService with linkers %s",
                     [linker.__class__.__name__ for linker in linkers])
@@ -510,16 +668,26 @@ class DialogueActClassficationContainer(InfraContainer):
         config = self.config_manager.get_config("cltl.dialogue_act_classification")
         implementation = config.get("implementation")
 
-        if implementation == "midas":
-            config = self.config_manager.get_config("cltl.dialogue_act_classification.midas")
-            return MidasDialogTagger(config.get("model"))
-        elif implementation == "silicone":
-            return SiliconeDialogueActClassifier()
-        elif not implementation:
+        if not implementation:
             logger.warning("No DialogueClassifier implementation configured")
             return False
-        else:
-            raise ValueError("Unsupported DialogueClassifier implementation: " + implementation)
+
+        args = ()
+        reference = DIALOGUE_ACT_CLASSIFIERS.reference(implementation)
+        if implementation == "midas":
+            config = self.config_manager.get_config("cltl.dialogue_act_classification.midas")
+            args = (config.get("model"),)
+            backend = config.get("backend") if "backend" in config else "eager"
+            if backend != "eager":
+                reference = OPTIMIZED_MODELS.reference(implementation)
+                args += (backend, config.get("optimized_model") or None)
+
+        classifier = self._load_model(implementation, reference, *args)
+        # MIDAS classifies in the context of the previous utterance
+        context, on_hit = (1, advance_midas_dialog) if implementation == "midas" else (0, None)
+
+        return self._cached_model(implementation, classifier, ":".join(map(str, (implementation,) + args)),
+                                  ("extract_dialogue_act",), context, on_hit)
 
     @property
     @singleton
@@ -597,14 +765,13 @@ class ObjectRecognitionContainer(InfraContainer):
         if not implementation:
             logger.warning("No ObjectDetector configured")
             return False
-        if implementation != "proxy":
-            raise ValueError("Unknown FaceEmotionExtractor implementation: " + implementation)
+        detector_class = OBJECT_DETECTORS.get(implementation)
 
         config = self.config_manager.get_config("cltl.object_recognition.proxy")
         start_infra = config.get_boolean("start_infra")
         detector_url = config.get("detector_url") if "detector_url" in config else None
 
-        return ObjectDetectorProxy(start_infra, detector_url)
+        return detector_class(start_infra, detector_url)
 
     @property
     @singleton
@@ -640,15 +807,14 @@ class FaceRecognitionContainer(InfraContainer):
         if not implementation:
             logger.warning("No FaceDetector configured")
             return False
-        if implementation != "proxy":
-            raise ValueError("Unknown FaceEmotionExtractor implementation: " + implementation)
+        detector_class = FACE_DETECTORS.get(implementation)
 
         config = self.config_manager.get_config("cltl.face_recognition.proxy")
         start_infra = config.get_boolean("start_infra")
         detector_url = config.get("detector_url") if "detector_url" in config else None
         age_gender_url = config.get("age_gender_url") if "age_gender_url" in config else None
 
-        return FaceDetectorProxy(start_infra, detector_url, age_gender_url)
+        return detector_class(start_infra, detector_url, age_gender_url)
 
     @property
     @singleton
@@ -678,9 +844,24 @@ class VectorIdContainer(InfraContainer):
     @property
     @singleton
     def vector_id(self) -> VectorIdentity:
+        return self._create_vector_id()
+
+    def _create_vector_id(self, read_only: bool = None) -> VectorIdentity:
+        implementation = self.config_manager.get_config("cltl.vector_id").get("implementation")
+        factory = VECTOR_ID_IMPLEMENTATIONS.get(implementation)
+
+        if implementation == "indexed":
+            config = self.config_manager.get_config("cltl.vector_id.indexed")
+            if read_only is None:
+                read_only = "read_only" in config and config.get_boolean("read_only")
+
+            return factory(config.get_float("distance_threshold"), config.get("storage_path"),
+                           metric=config.get("metric"), backend=config.get("backend"),
+                           neighbours=config.get_int("neighbours"), read_only=read_only)
+
         config = self.config_manager.get_config("cltl.vector_id.agg")
 
-        return ClusterIdentity.agglomerative(0, config.get_float("distance_threshold"), config.get("storage_path"))
+        return factory(0, config.get_float("distance_threshold"), config.get("storage_path"))
 
     @property
     @singleton
@@ -708,18 +889,24 @@ class EmotionRecognitionContainer(InfraContainer):
         config = self.config_manager.get_config("cltl.emotion_recognition")
         implementation = config.get("impl")
 
+        if not implementation:
+            logger.warning("No EmotionExtractor implementation configured")
+            return False
+
+        args = ()
+        reference = EMOTION_EXTRACTORS.reference(implementation)
         if implementation == "Go":
             config = self.config_manager.get_config("cltl.emotion_recognition.go")
-            detector = GoEmotionDetector(config.get("model"))
-        elif implementation == "Vader":
-            detector = VaderSentimentDetector()
-        elif not implementation:
-            logger.warning("No EmotionExtractor implementation configured")
-            detector = False
-        else:
-            raise ValueError("Unknown emotion extractor implementation: " + implementation)
+            args = (config.get("model"),)
+            backend = config.get("backend") if "backend" in config else "eager"
+            if backend != "eager":
+                reference = OPTIMIZED_MODELS.reference(implementation)
+                args += (backend, config.get("optimized_model") or None)
+
+        extractor = self._load_model(implementation, reference, *args)
 
-        return detector
+        return self._cached_model(implementation, extractor, ":".join(map(str, (implementation,) + args)),
+                                  ("extract_text_emotions",))
 
     @property
     @singleton
@@ -730,15 +917,14 @@ class EmotionRecognitionContainer(InfraContainer):
         if not implementation:
             logger.warning("No FaceEmotionExtractor configured")
             return False
-        if implementation != "emotic":
-            raise ValueError("Unknown FaceEmotionExtractor implementation: " + implementation)
+        extractor_class = FACE_EMOTION_EXTRACTORS.get(implementation)
 
         config = self.config_manager.get_config("cltl.face_emotion_recognition.emotic")
 
-        return ContextFaceEmotionExtractor(config.get("model_context"),
-                                           config.get("model_body"),
-                                           config.get("model_emotic"),
-                                           config.get("value_thresholds"))
+        return extractor_class(config.get("model_context"),
+                               config.get("model_body"),
+                               config.get("model_emotic"),
+                               config.get("value_thresholds"))
 
     @property
     @singleton
@@ -794,9 +980,15 @@ class NLPContainer(InfraContainer):
     @property
     @singleton
     def nlp(self) -> NLP:
+        implementation = self.config_manager.get_config("cltl.nlp").get("implementation")
         config = self.config_manager.get_config("cltl.nlp.spacy")
+        entity_relations = config.get('entity_relations', multi=True)
 
-        return SpacyNLP(config.get('model'), config.get('entity_relations', multi=True))
+        nlp = self._load_model(implementation, NLP_IMPLEMENTATIONS.reference(implementation),
+                               config.get('model'), entity_relations)
+
+        return self._cached_model(implementation, nlp, f"{implementation}:{config.get('model')}:{entity_relations}",
+                                  ("analyze",))
 
     @property
     @singleton
@@ -903,7 +1095,10 @@ class FactualResponderContainer(EmissorStorageContainer, InfraContainer):
     @property
     @singleton
     def factual_responder(self) -> FactualResponder:
-        return WikipediaResponder()
+        config = self.config_manager.get_config("cltl.factual-responder")
+        implementation = config.get("implementation") if "implementation" in config else "wikipedia"
+
+        return FACTUAL_RESPONDERS.get(implementation)()
 
     @property
     @singleton
@@ -954,18 +1149,23 @@ class LeolaniContainer(EmissorStorageContainer, InfraContainer):
     @singleton
     def friend_store(self) -> FriendStore:
         implementation = self.config_manager.get_config("cltl.leolani.friends").get("implementation")
+        store_class = FRIEND_STORES.get(implementation)
 
         if implementation == "brain":
             config = self.config_manager.get_config("cltl.brain")
             brain_address = config.get("address")
             brain_log_dir = pathlib.Path(config.get("log_dir"))
 
-            return BrainFriendsStore(brain_address, brain_log_dir)
+            friend_store = self._shared_brain(store_class(brain_address, brain_log_dir))
+        else:
+            friend_store = store_class()
 
-        if implementation == "memory":
-            return MemoryFriendsStore()
+        config = self.config_manager.get_config("cltl.leolani.friends")
+        if "cache" in config and config.get_boolean("cache"):
+            friend_store = CachedFriendStore(friend_store, metrics.registry)
+            friend_store.subscribe(self.event_bus, self.config_manager.get_config("cltl.brain").get("topic_output"))
 
-        raise ValueError("Unsupported implemenation: " + implementation)
+        return friend_store
 
     @property
     @singleton
@@ -1035,6 +1235,8 @@ class LeolaniContainer(EmissorStorageContainer, InfraContainer):
             self.context_service.stop()
             if self.id_resolution_service:
                 self.id_resolution_service.stop()
+            if isinstance(self.friend_store, CachedFriendStore):
+                self.friend_store.unsubscribe()
         finally:
             super().stop()
 
@@ -1043,23 +1245,25 @@ class G2KYContainer(LeolaniContainer, EmissorStorageContainer, InfraContainer):
     @property
     @singleton
     def g2ky(self) -> GetToKnowYou:
-        get_friends = self.friend_store.get_friends()
-        friends = {face_id: names[1][0]
-                   for face_id, names in get_friends.items()
-                   if names[1]}
+        if isinstance(self.friend_store, CachedFriendStore):
+            friends = self.friend_store.names()
+        else:
+            get_friends = self.friend_store.get_friends()
+            friends = {face_id: names[1][0]
+                       for face_id, names in get_friends.items()
+                       if names[1]}
 
         logger.info("Initializing G2KY with %s friends", len(friends))
 
         config = self.config_manager.get_config("cltl.g2ky")
         implementation = config.get("implementation")
+        g2ky_class = G2KY_IMPLEMENTATIONS.get(implementation)
         if implementation == "visual":
             config = self.config_manager.get_config("cltl.g2ky.visual")
 
-            return VisualGetToKnowYou(gaze_images=config.get_int("gaze_images"), friends=friends)
-        elif implementation == "verbal":
-            return VerbalGetToKnowYou(friends)
+            return g2ky_class(gaze_images=config.get_int("gaze_images"), friends=friends)
         else:
-            raise ValueError("Unknown G2KY implementation: " + implementation)
+            return g2ky_class(friends)
 
     @property
     @singleton
@@ -1134,39 +1338,145 @@ class ApplicationContainer(ChatUIContainer, G2KYContainer, G2KMoreContainer, Leo
                            ObjectRecognitionContainer, EmotionRecognitionContainer,
                            ASRContainer, VADContainer,
                            EmissorStorageContainer, BackendContainer):
+    # Components constructed concurrently on startup mapped to the components they depend on.
+    # Components that are shared by multiple others must be listed as dependency, otherwise
+    # their construction may be attempted concurrently. The shared infrastructure of the
+    # InfraContainer is created before, and all services must be listed, see _create_components.
+    startup_dependencies = {
+        "audio_storage": (),
+        "image_storage": (),
+        "server": (),
+        "backend_service": ("audio_storage", "image_storage"),
+        "storage_service": ("audio_storage", "image_storage"),
+        "emissor_data_service": (),
+        "emissor_data_client": (),
+        "vad_service": (),
+        "asr_service": ("emissor_data_client",),
+        "object_recognition_service": (),
+        "face_recognition_service": (),
+        "vector_id_service": (),
+        "emotion_recognition_service": (),
+        "face_emotion_recognition_service": (),
+        "emotion_responder_service": (),
+        "dialogue_act_classification_service": (),
+        "nlp_service": (),
+        "mention_extraction_service": (),
+        "brain": (),
+        "brain_service": ("brain",),
+        "disambiguation_service": ("brain",),
+        "reply_service": ("brain", "emissor_data_client"),
+        "triple_extraction_service": ("emissor_data_client",),
+        "about_agent_service": ("emissor_data_client",),
+        "factual_responder_service": ("emissor_data_client",),
+        "visual_responder_service": ("emissor_data_client",),
+        "friend_store": ("brain",),
+        "id_resolution_service": ("friend_store", "emissor_data_client"),
+        "monitoring_service": ("friend_store",),
+        "context_service": ("friend_store",),
+        "keyword_service": ("emissor_data_client",),
+        "bdi_service": (),
+        "init_intention": ("emissor_data_client",),
+        "chat_intention": ("emissor_data_client",),
+        "g2ky_service": ("friend_store", "emissor_data_client"),
+        "g2kmore": ("brain",),
+        "g2kmore_service": ("g2kmore", "emissor_data_client"),
+        "thought_intention_service": ("g2kmore",),
+        "chatui_service": (),
+        "log_writer": (),
+        "event_log_service": ("log_writer",),
+        "metrics_service": (),
+    }
+
     @property
     @singleton
     def log_writer(self):
         config = self.config_manager.get_config("cltl.event_log")
+        log_format = config.get("format") if "format" in config else "json"
 
-        return LogWriter(config.get("log_dir"), serializer)
+        if log_format == "json":
+            return LogWriter(config.get("log_dir"), serializer)
+        elif log_format == "jsonl":
+            return BatchedLogWriter.from_config(self.config_manager, serializer, metrics.registry)
+        else:
+            raise ValueError("Unsupported event log format: " + log_format)
 
     @property
     @singleton
     def event_log_service(self):
         return EventLogService.from_config(self.log_writer, self.event_bus, self.config_manager)
 
+    @property
+    @singleton
+    def metrics_service(self) -> MetricsService:
+        return MetricsService(metrics.registry, self.tracer)
+
     def start(self):
+        self._create_components()
         logger.info("Start EventLog")
         super().start()
         self.event_log_service.start()
 
+    def _create_components(self):
+        config = self.config_manager.get_config("cltl.startup")
+        workers = config.get_int("workers") if "workers" in config else 0
+
+        services = {name for container in type(self).__mro__ for name, value in vars(container).items()
+                    if isinstance(value, property) and name.endswith("_service")}
+        missing = services - self.startup_dependencies.keys()
+        if missing:
+            raise ValueError(f"Services {sorted(missing)} are missing in the startup dependencies")
+
+        # Create the shared infrastructure before the components using it
+        _ = self.resource_manager
+        for name, value in vars(InfraContainer).items():
+            if isinstance(value, property):
+                getattr(self, name)
+
+        tasks = {name: (lambda name=name: getattr(self, name)) for name in self.startup_dependencies}
+        StartupScheduler(tasks, self.startup_dependencies, max_workers=workers).run()
+
     def stop(self):
         try:
             logger.info("Stop EventLog")
             self.event_log_service.stop()
+            if self.tracer:
+                self.tracer.dump(self.config_manager.get_config("cltl.event_log").get("log_dir"))
         finally:
             super().stop()
 
 
-def serializer(obj):
-    try:
-        return emissor_serializer(obj)
-    except Exception:
-        try:
-            return vars(obj)
-        except Exception:
-            return str(obj)
+class ReplayContainer(ApplicationContainer):
+    """
+    The application without backend, to replay recorded events, see :mod:`leolani_app.replay`.
+    """
+    @property
+    @singleton
+    def server(self):
+        # Return a placeholder
+        return ""
+
+    @property
+    @singleton
+    def backend_service(self):
+        return DisabledService()
+
+
+serializer = TypeDispatchSerializer()
+
+
+def web_app(started_app: ApplicationContainer):
+    routes = {
+        '/storage': started_app.storage_service.app,
+        '/emissor': started_app.emissor_data_service.app,
+        '/chatui': started_app.chatui_service.app,
+        '/monitoring': started_app.monitoring_service.app,
+        '/metrics': started_app.metrics_service.app,
+    }
+
+    if started_app.server:
+        routes['/host'] = started_app.server.app
+
+    return DispatcherMiddleware(Flask("Leolani app"), routes)
 
 
 def main():
@@ -1178,20 +1488,8 @@ def main():
         intention_topic = started_app.config_manager.get_config("cltl.bdi").get("topic_intention")
         started_app.event_bus.publish(intention_topic, Event.for_payload(IntentionEvent([Intention("init", None)])))
 
-
-        routes = {
-            '/storage': started_app.storage_service.app,
-            '/emissor': started_app.emissor_data_service.app,
-            '/chatui': started_app.chatui_service.app,
-            '/monitoring': started_app.monitoring_service.app,
-        }
-
-        if started_app.server:
-            routes['/host'] = started_app.server.app
-
-        web_app = DispatcherMiddleware(Flask("Leolani app"), routes)
-
-        run_simple('0.0.0.0', 8000, web_app, threaded=True, use_reloader=False, use_debugger=False, use_evalex=True)
+        run_simple('0.0.0.0', 8000, web_app(started_app), threaded=True, use_reloader=False, use_debugger=False,
+                   use_evalex=True)
 
         intention_topic = started_app.config_manager.get_config("cltl.bdi").get("topic_intention")
         started_app.event_bus.publish(intention_topic, Event.for_payload(IntentionEvent([Intention("terminate", None)])))
@@ -1,8 +1,15 @@
 import argparse
+import csv
+import json
 import logging.config
 import os
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint
-from typing import Iterable, Dict
+from typing import Iterable, Dict, List, Optional, Tuple
 
 import cv2
 import numpy as np
@@ -11,13 +18,35 @@ from cltl.face_recognition.api import FaceDetector
 from cltl.friends.api import FriendStore
 from cltl.vector_id.api import VectorIdentity
 
+from leolani_app.result_cache import ResultCache, content_key
+
+_CACHE_NAMESPACE = "friend_importer"
+
 
 class FriendImporter:
-    def __init__(self, friend_store: FriendStore, detector: FaceDetector, vector_id: VectorIdentity, resolution: CameraResolution):
+    def __init__(self, friend_store: FriendStore, detector: FaceDetector, vector_id: VectorIdentity, resolution: CameraResolution,
+                 cache: ResultCache = None, vector_id_key: str = None, detector_key: str = None):
+        """
+        Parameters
+        ----------
+        cache : ResultCache
+            Optional cache of face embeddings by image content, detector and resolution, and of the
+            vector IDs they were added with. Images in the cache are not detected again, and not added
+            again if the VectorID store confirms their cached vector ID through ``resolve``. Stores
+            without ``resolve``, e.g. the agglomerative store, get the cached embeddings added again.
+        vector_id_key : str
+            Identity of the VectorID store in the cache, e.g. implementation and storage path.
+        detector_key : str
+            Identity of the face detector in the cache, e.g. implementation and detector URL.
+        """
         self.friend_store = friend_store
         self.detector = detector
         self.vector_id = vector_id
         self.resolution = resolution
+        self.cache = cache
+        self.vector_id_key = vector_id_key if vector_id_key else type(vector_id).__qualname__
+        self.detector_key = detector_key if detector_key \
+            else f"{type(detector).__module__}.{type(detector).__qualname__}"
 
     @classmethod
     def create(cls, vector_id_path: str, face_detector_url: str, age_detector_url: str,
@@ -29,8 +58,9 @@ class FriendImporter:
         detector = FaceDetectorProxy(start_infra=False, detector_url=face_detector_url, age_gender_url=age_detector_url)
         vector_id = ClusterIdentity.agglomerative(storage_path=vector_id_path)
         friend_store = BrainFriendsStore(address=brain_url, log_dir=brain_log_dir) if brain_url else None
+        detector_key = f"{type(detector).__qualname__}:{face_detector_url}"
 
-        return cls(friend_store, detector, vector_id, resolution)
+        return cls(friend_store, detector, vector_id, resolution, detector_key=detector_key)
 
     @classmethod
     def create_autostart(cls, vector_id_path: str,
@@ -46,12 +76,17 @@ class FriendImporter:
         return cls(friend_store, detector, vector_id, resolution)
 
     @classmethod
-    def from_config(cls, config_path: str = None, no_brain: bool = False):
+    def from_config(cls, config_path: str = None, no_brain: bool = False, cache: ResultCache = None):
         from app import FaceRecognitionContainer, VectorIdContainer, LeolaniContainer
         from cltl.combot.infra.config.local import LocalConfigurationContainer
+        from leolani_app.metrics import timed_singleton as singleton
 
         class ImporterContainer(FaceRecognitionContainer, VectorIdContainer, LeolaniContainer, LocalConfigurationContainer):
-            pass
+            @property
+            @singleton
+            def vector_id(self) -> VectorIdentity:
+                # The importer adds the embeddings, also if the application opens the store read-only
+                return self._create_vector_id(read_only=False)
 
         if config_path:
             ImporterContainer.load_configuration(config_path, additional_config_files=())
@@ -66,16 +101,32 @@ class FriendImporter:
         friend_store = container.friend_store if not no_brain else None
 
         config = container.config_manager.get_config("cltl.video")
+        resolution = config.get_enum("resolution", CameraResolution)
+
+        implementation = container.config_manager.get_config("cltl.vector_id").get("implementation")
+        vector_id_config = container.config_manager.get_config(
+            "cltl.vector_id.indexed" if implementation == "indexed" else "cltl.vector_id.agg")
+        vector_id_key = f"{implementation}:{os.path.abspath(vector_id_config.get('storage_path'))}"
+
+        # Without URL the detector started by the proxy, or at its default URL, is used
+        detector_config = container.config_manager.get_config("cltl.face_recognition.proxy")
+        detector_url = detector_config.get("detector_url") if "detector_url" in detector_config else None
+        detector_key = f"{container.config_manager.get_config('cltl.face_recognition').get('implementation')}:" \
+                       f"{detector_url if detector_url else 'default'}"
 
-        return cls(friend_store, detector, vector_id, resolution=config.get_enum("resolution", CameraResolution))
+        return cls(friend_store, detector, vector_id, resolution, cache, vector_id_key, detector_key)
 
     def friends_to_ids(self, friends: Dict[str, Iterable[str]]):
         if not self.detector or not self.vector_id:
             raise ValueError("No detector or vector ID store configured")
 
-        with self.detector as face_detector:
-            ids = {name: self._add_representations(name, face_detector, image_paths)
-                   for name, image_paths in friends.items()}
+        try:
+            with self.detector as face_detector:
+                ids = {name: self._add_representations(name, face_detector, image_paths)
+                       for name, image_paths in friends.items()}
+        finally:
+            if self.cache is not None:
+                self.cache.save()
 
         return ids
 
@@ -88,20 +139,232 @@ class FriendImporter:
 
         [self.friend_store.add_friend(identifier=id, names=[name]) for name, ids in friends.items() for id in ids]
 
+    def bulk_import(self, images: List[Tuple[str, str]], checkpoint_path: str, workers: int = 4,
+                    concurrency: int = 2, batch_size: int = 32, retry_failed: bool = False):
+        """
+        Add the faces in the images to the VectorID store, resuming from the checkpoint.
+
+        Images are decoded on a pool of worker threads and sent to the face detector with bounded
+        concurrency. The embeddings are added to the VectorID store in batches, after which the
+        results are appended to the checkpoint. Images that fail, e.g. because they contain
+        multiple faces, are recorded as failed instead of aborting the import. Images in the
+        embedding cache are not detected, or not added at all if they are in the VectorID store.
+
+        Parameters
+        ----------
+        images : List[Tuple[str, str]]
+            Name of the friend and image path.
+        checkpoint_path : str
+            JSON lines file with the result per image, images in the checkpoint are skipped.
+        workers : int
+            Number of threads that load and resize images.
+        concurrency : int
+            Maximum number of concurrent face detector calls.
+        batch_size : int
+            Number of embeddings added to the VectorID store at once.
+        retry_failed : bool
+            Process images that failed in a previous run again.
+
+        Returns
+        -------
+        Tuple[Dict[str, List[str]], List[dict]]
+            The vector IDs per friend, including previous runs, and the failures of this run.
+        """
+        if not self.detector or not self.vector_id:
+            raise ValueError("No detector or vector ID store configured")
+
+        done = _read_checkpoint(checkpoint_path)
+        pending = [(name, path) for name, path in images
+                   if path not in done or (retry_failed and done[path]["status"] == "failed")]
+        logger.info("Importing %s images, %s already processed", len(pending), len(images) - len(pending))
+
+        stats = defaultdict(float)
+        failures = []
+        start = time.perf_counter()
+        try:
+            with open(checkpoint_path, "a") as checkpoint, self.detector as face_detector:
+                batch = []
+                for result in self._encode_images(face_detector, pending, workers, concurrency, stats):
+                    if "error" in result:
+                        logger.warning("Failed to import %s for %s: %s",
+                                       result["path"], result["name"], result["error"])
+                        failures.append(result)
+                        _write_checkpoint(checkpoint, [result])
+                        continue
+                    if "id" in result:
+                        _write_checkpoint(checkpoint, [result])
+                        continue
+
+                    batch.append(result)
+                    if len(batch) >= batch_size:
+                        _write_checkpoint(checkpoint, self._add_batch(batch, stats))
+                        batch = []
+                if batch:
+                    _write_checkpoint(checkpoint, self._add_batch(batch, stats))
+        finally:
+            if self.cache is not None:
+                self.cache.save()
+
+        stats["total"] = time.perf_counter() - start
+        _print_summary(len(pending), len(images) - len(pending), failures, stats)
+
+        done = _read_checkpoint(checkpoint_path)
+        ids = defaultdict(set)
+        for result in done.values():
+            if result["status"] == "ok":
+                ids[result["name"]].add(result["id"])
+
+        return {name: sorted(name_ids) for name, name_ids in ids.items()}, failures
+
+    def _encode_images(self, face_detector, images: List[Tuple[str, str]], workers: int, concurrency: int,
+                       stats: Dict[str, float]):
+        """Yield the embedding or error per image, in the order they complete."""
+        results = queue.Queue()
+        # Bound the number of decoded images waiting for the detector
+        in_flight = threading.BoundedSemaphore(workers + 2 * concurrency)
+        detections = threading.BoundedSemaphore(concurrency)
+        stats_lock = threading.Lock()
+
+        def record(key, duration):
+            with stats_lock:
+                stats[key] += duration
+
+        def detect(name, path, key, image):
+            try:
+                with detections:
+                    detect_start = time.perf_counter()
+                    embedding = self._encode_image(face_detector, image, path)
+                    record("detect", time.perf_counter() - detect_start)
+                self._remember(key, embedding)
+                if embedding is None:
+                    raise ValueError(f"No faces detected in {path}")
+                results.put({"name": name, "path": path, "key": key, "embedding": embedding})
+            except Exception as e:
+                results.put({"name": name, "path": path, "status": "failed", "error": str(e)})
+            finally:
+                in_flight.release()
+
+        def decode(name, path):
+            try:
+                key = self._image_key(path)
+                cached = self._cached(key)
+                if cached is not None:
+                    record("cached", 1)
+                    results.put({"name": name, "path": path, "key": key, **cached})
+                    in_flight.release()
+                    return
+
+                decode_start = time.perf_counter()
+                image = self._load_image(path)
+                record("decode", time.perf_counter() - decode_start)
+            except Exception as e:
+                results.put({"name": name, "path": path, "status": "failed", "error": str(e)})
+                in_flight.release()
+                return
+            detect_pool.submit(detect, name, path, key, image)
+
+        with ThreadPoolExecutor(workers, thread_name_prefix="decode") as decode_pool, \
+                ThreadPoolExecutor(concurrency, thread_name_prefix="detect") as detect_pool:
+            def submit_all():
+                for name, path in images:
+                    in_flight.acquire()
+                    decode_pool.submit(decode, name, path)
+
+            submitter = threading.Thread(target=submit_all, name="submit", daemon=True)
+            submitter.start()
+            for _ in images:
+                yield results.get()
+            submitter.join()
+
+    def _add_batch(self, batch: List[dict], stats: Dict[str, float]) -> List[dict]:
+        add_start = time.perf_counter()
+        vector_ids = self.vector_id.add(np.vstack([result["embedding"] for result in batch]))
+        stats["add"] += time.perf_counter() - add_start
+
+        for result, vector_id in zip(batch, vector_ids):
+            self._remember(result["key"], result["embedding"], vector_id)
+
+        return [{"name": result["name"], "path": result["path"], "status": "ok", "id": vector_id}
+                for result, vector_id in zip(batch, vector_ids)]
+
     def _add_representations(self, name, face_detector, image_paths):
         logger.info("Adding representations for friend %s from %s", name, image_paths)
-        representations = [self._encode_face(face_detector, path) for path in image_paths]
-        representations = list(filter(lambda r: r is not None, representations))
-        representations = np.vstack(representations)
+        vector_ids = set()
+        keys, representations = [], []
+        for path in image_paths:
+            key = self._image_key(path)
+            cached = self._cached(key)
+            if cached is not None and "id" in cached:
+                vector_ids.add(cached["id"])
+                continue
+            if cached is not None and "error" in cached:
+                continue
+
+            representation = cached["embedding"] if cached is not None and "embedding" in cached \
+                else self._encode_face(face_detector, path)
+            self._remember(key, representation)
+            if representation is not None:
+                keys.append(key)
+                representations.append(representation)
+
+        if representations:
+            added = self.vector_id.add(np.vstack(representations))
+            for key, representation, vector_id in zip(keys, representations, added):
+                self._remember(key, representation, vector_id)
+            vector_ids.update(added)
 
-        vector_ids = set(self.vector_id.add(representations))
         if len(vector_ids) > 1:
             logger.warning("Friend %s represented by multiple IDs: %s", name, vector_ids)
 
         return list(vector_ids)
 
+    def _image_key(self, image_path) -> Optional[str]:
+        if self.cache is None:
+            return None
+
+        with open(image_path, "rb") as image_file:
+            content = image_file.read()
+
+        return content_key(_CACHE_NAMESPACE, self.detector_key, str(self.resolution), content)
+
+    def _cached(self, key: Optional[str]) -> Optional[dict]:
+        """
+        The cached result for the image: its vector ID if it was added to the VectorID store,
+        otherwise its embedding, or an error if it contains no face.
+        """
+        if not key:
+            return None
+
+        entry = self.cache.get(key, namespace=_CACHE_NAMESPACE)
+        if entry is None:
+            return None
+        if entry["embedding"] is None:
+            return {"status": "failed", "error": "No faces detected (cached)"}
+
+        # The store may have been reset or clusters merged since the image was added, without
+        # confirmation of the vector ID by the store the cached embedding is added again
+        vector_id = entry["ids"].get(self.vector_id_key)
+        vector_id = self.vector_id.resolve(vector_id) if vector_id and hasattr(self.vector_id, "resolve") else None
+        if vector_id:
+            return {"status": "ok", "id": vector_id}
+
+        return {"embedding": entry["embedding"]}
+
+    def _remember(self, key: Optional[str], embedding, vector_id: str = None):
+        if not key:
+            return
+
+        entry = self.cache.get(key, namespace=_CACHE_NAMESPACE)
+        ids = dict(entry["ids"]) if entry else {}
+        if vector_id:
+            ids[self.vector_id_key] = vector_id
+        self.cache.put(key, {"embedding": embedding, "ids": ids}, namespace=_CACHE_NAMESPACE)
+
     def _encode_face(self, face_detector, image_path):
-        faces, _ = face_detector.detect(self._load_image(image_path))
+        return self._encode_image(face_detector, self._load_image(image_path), image_path)
+
+    def _encode_image(self, face_detector, image, image_path):
+        faces, _ = face_detector.detect(image)
         faces = list(faces)
 
         if len(faces) == 0:
@@ -123,23 +386,117 @@ class FriendImporter:
         return image
 
 
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+def images_from_directory(directory: str) -> List[Tuple[str, str]]:
+    """
+    Images in a directory with a subdirectory per friend, named after the friend.
+    """
+    return [(name, os.path.join(directory, name, file_name))
+            for name in sorted(os.listdir(directory)) if os.path.isdir(os.path.join(directory, name))
+            for file_name in sorted(os.listdir(os.path.join(directory, name)))
+            if file_name.lower().endswith(IMAGE_EXTENSIONS)]
+
+
+def images_from_manifest(manifest: str) -> List[Tuple[str, str]]:
+    """
+    Images from a CSV file with the name of the friend and the image path per line. Relative
+    paths are resolved against the directory of the manifest.
+    """
+    base = os.path.dirname(os.path.abspath(manifest))
+    with open(manifest, newline="") as manifest_file:
+        return [(row[0].strip(), os.path.join(base, row[1].strip()))
+                for row in csv.reader(manifest_file) if len(row) >= 2 and not row[0].startswith("#")]
+
+
+def _read_checkpoint(checkpoint_path: str) -> Dict[str, dict]:
+    if not os.path.exists(checkpoint_path):
+        return {}
+
+    done = {}
+    with open(checkpoint_path) as checkpoint:
+        for line in checkpoint:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # Incomplete line of an interrupted run
+                continue
+            done[result["path"]] = result
+
+    return done
+
+
+def _write_checkpoint(checkpoint, results: List[dict]):
+    for result in results:
+        checkpoint.write(json.dumps({key: value for key, value in result.items()
+                                     if key not in ("key", "embedding")}) + "\n")
+    checkpoint.flush()
+
+
+def _print_summary(processed: int, skipped: int, failures: List[dict], stats: Dict[str, float]):
+    total = stats["total"]
+    print(f"Processed {processed} images in {total:.1f} s ({processed / total if total else 0:.1f} images/s), "
+          f"{processed - len(failures)} imported, {len(failures)} failed, {skipped} skipped from the checkpoint, "
+          f"{int(stats['cached'])} from the embedding cache")
+    if processed:
+        print(f"Per image: decode {stats['decode'] / processed * 1000:.1f} ms, "
+              f"detect {stats['detect'] / processed * 1000:.1f} ms, add {stats['add'] / processed * 1000:.1f} ms")
+    if failures:
+        print("Failures:")
+        for failure in failures:
+            print(f"  {failure['name']}\t{failure['path']}\t{failure['error']}")
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Friends importer')
-    parser.add_argument('--friend', type=str, required=True, action='append', nargs="*",
+    parser.add_argument('--friend', type=str, action='append', nargs="*",
                         help="Friend name followed by image paths. The parameter can be specified multiple times.")
+    parser.add_argument('--directory', type=str,
+                        help="Bulk import from a directory with a subdirectory of images per friend, named after the friend")
+    parser.add_argument('--manifest', type=str,
+                        help="Bulk import from a CSV file with friend name and image path per line")
+    parser.add_argument('--checkpoint', type=str,
+                        help="Checkpoint of a bulk import, by default import_checkpoint.jsonl next to the directory "
+                             "or manifest. An interrupted import resumes from the checkpoint.")
+    parser.add_argument('--workers', type=int, default=4, help="Number of threads that load images in a bulk import")
+    parser.add_argument('--concurrency', type=int, default=2,
+                        help="Maximum number of concurrent face detector calls in a bulk import")
+    parser.add_argument('--batch-size', type=int, default=32,
+                        help="Number of faces added to the VectorID store at once in a bulk import")
+    parser.add_argument('--retry-failed', action='store_true',
+                        help="Retry images that failed in a previous run of a bulk import")
+    parser.add_argument('--cache', type=str, default="./storage/cache/friend_embeddings.pkl",
+                        help="Cache of face embeddings by image content, unchanged images are not detected again. "
+                             "With the indexed VectorID store they are also not added again, other stores "
+                             "get their embeddings added again on each run")
+    parser.add_argument('--no-cache', action='store_true', help="Don't use the embedding cache")
     parser.add_argument('--ids-only', action='store_true',
                         help="Only add friends to the VectorID store, don't associate vector IDs to names")
     args, _ = parser.parse_known_args()
 
+    if bool(args.friend) + bool(args.directory) + bool(args.manifest) != 1:
+        parser.error("Specify either --friend, --directory or --manifest")
+
     logging.config.fileConfig(os.environ.get('CLTL_LOGGING_CONFIG', default='config/logging.config'),
                               disable_existing_loggers=False)
     logger = logging.getLogger(__name__)
 
-    logger.info("Importing %s friends", len(args.friend))
-
-    importer = FriendImporter.from_config(no_brain=args.ids_only)
-    logger.info("Adding vector IDs for friends")
-    ids = importer.friends_to_ids({friend[0]: friend[1:] for friend in args.friend})
+    cache = ResultCache(max_size=1000000, path=args.cache) if not args.no_cache else None
+    importer = FriendImporter.from_config(no_brain=args.ids_only, cache=cache)
+    if args.friend:
+        logger.info("Importing %s friends", len(args.friend))
+        logger.info("Adding vector IDs for friends")
+        ids = importer.friends_to_ids({friend[0]: friend[1:] for friend in args.friend})
+    else:
+        source = args.directory if args.directory else args.manifest
+        images = images_from_directory(source) if args.directory else images_from_manifest(source)
+        checkpoint_path = args.checkpoint if args.checkpoint \
+            else os.path.join(os.path.dirname(os.path.abspath(source.rstrip(os.sep))), "import_checkpoint.jsonl")
+        logger.info("Importing %s images of %s friends from %s, checkpoint %s",
+                    len(images), len({name for name, _ in images}), source, checkpoint_path)
+        ids, _ = importer.bulk_import(images, checkpoint_path, args.workers, args.concurrency, args.batch_size,
+                                      args.retry_failed)
 
     pprint(ids)
 
@@ -0,0 +1,138 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Generic, List, Sequence, TypeVar
+
+from leolani_app.metrics import MetricsRegistry
+
+logger = logging.getLogger(__name__)
+
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class MicroBatcher(Generic[T, R]):
+    """
+    Combine requests from concurrent callers into batches.
+
+    A single pending request is processed immediately. Requests that arrive while a batch is
+    processed are combined into the next batch, which waits for further requests until it reaches
+    the maximum size, or until its first request waited for the maximum delay. Callers block until
+    the result of their request is available.
+    """
+
+    def __init__(self, process_batch: Callable[[Sequence[T]], Sequence[R]], max_delay: float = 0.005,
+                 max_size: int = 32, size: Callable[[T], int] = None, name: str = "MicroBatcher",
+                 metrics: MetricsRegistry = None):
+        """
+        Parameters
+        ----------
+        process_batch : Callable[[Sequence[T]], Sequence[R]]
+            Computes the results for a batch of requests, in the order of the requests.
+        max_delay : float
+            Maximum time in seconds a request waits for other requests to be batched with.
+        max_size : int
+            Maximum size of a batch. Batches can be larger if a single request exceeds the size.
+        size : Callable[[T], int]
+            Size of a request, e.g. the number of rows it contributes to a batch, by default ``1``.
+        name : str
+            Name of the batcher, used for the worker thread and the metrics.
+        metrics : MetricsRegistry
+            Optional registry to record the number of batches and requests, and the time requests
+            wait for their batch.
+        """
+        self._process_batch = process_batch
+        self._max_delay = max_delay
+        self._max_size = max_size
+        self._size = size if size else (lambda request: 1)
+        self._name = name
+        self._metrics = metrics
+
+        self._pending = []
+        self._pending_size = 0
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+
+        self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, request: T) -> R:
+        """
+        Add the request to the next batch and wait for its result.
+        """
+        future = Future()
+        with self._condition:
+            if not self._running:
+                raise RuntimeError(f"{self._name} is not running")
+
+            self._pending.append((time.perf_counter(), request, future))
+            self._pending_size += self._size(request)
+            self._condition.notify()
+
+        return future.result()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending or not self._running)
+                if not self._pending and not self._running:
+                    break
+
+                # Without other pending requests there is no concurrent caller to wait for
+                deadline = self._pending[0][0] + self._max_delay
+                while self._running and len(self._pending) > 1 and self._pending_size < self._max_size:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+
+                batch = self._take_batch()
+
+            self._process(batch)
+
+    def _take_batch(self) -> List:
+        batch, batch_size = [], 0
+        while self._pending and (not batch or batch_size + self._size(self._pending[0][1]) <= self._max_size):
+            item = self._pending.pop(0)
+            batch.append(item)
+            batch_size += self._size(item[1])
+        self._pending_size -= batch_size
+
+        return batch
+
+    def _process(self, batch: List):
+        start = time.perf_counter()
+        if self._metrics:
+            self._metrics.increment("batches", self._name)
+            self._metrics.increment("batched_requests", self._name, len(batch))
+            for enqueued, _, _ in batch:
+                self._metrics.record("batch_wait", self._name, (start - enqueued) * 1000)
+
+        try:
+            results = self._process_batch([request for _, request, _ in batch])
+        except Exception as e:
+            logger.exception("Failed to process batch of %s requests in %s", len(batch), self._name)
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        for (_, _, future), result in zip(batch, results):
+            future.set_result(result)
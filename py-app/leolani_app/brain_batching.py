@@ -0,0 +1,240 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Sequence
+
+from cltl.brain.infrastructure import Thoughts
+from cltl.brain.long_term_memory import LongTermMemory
+from cltl.combot.infra.config import ConfigurationManager
+from cltl.combot.infra.event import Event, EventBus
+from cltl.combot.infra.resource import ResourceManager
+from cltl.commons.discrete import UtteranceType
+from cltl_service.brain.service import BrainService
+from rdflib import Dataset
+
+from leolani_app.metrics import MetricsRegistry
+from leolani_app.tracing import active_span, current_span
+
+logger = logging.getLogger(__name__)
+
+
+PERCEPTION_TYPES = (UtteranceType.IMAGE_MENTION, UtteranceType.IMAGE_ATTRIBUTION)
+"""Utterance types of capsules whose brain writes are batched."""
+
+IDENTITY_KEYS = ("utterance_type", "context_id", "source", "item", "perspective")
+"""Capsule fields that identify the knowledge of a perception capsule, other fields differ per frame."""
+
+
+def _utterance_type(capsule: dict):
+    utterance_type = capsule.get("utterance_type")
+
+    return UtteranceType[utterance_type] if type(utterance_type) == str else utterance_type
+
+
+def merge_rdf(data: Sequence[str], format: str) -> str:
+    """
+    Merge serialized RDF datasets into a single dataset, identical triples in the same graph are merged.
+    """
+    if len(data) == 1:
+        return data[0]
+
+    dataset = Dataset()
+    for serialized in data:
+        dataset.parse(data=serialized, format=format)
+
+    return dataset.serialize(format=format)
+
+
+class BatchingBrainService(BrainService):
+    """
+    Brain service that batches the writes of perception capsules.
+
+    Capsules from visual perception, see :data:`PERCEPTION_TYPES`, that arrive within the write window
+    are collected and uploaded to the triple store in a single request. Perception capsules with the
+    same knowledge, see :data:`IDENTITY_KEYS`, are processed only once per window. The responses for
+    the batch are published in a single event after the upload.
+
+    The thoughts in the responses are computed as by the :class:`BrainService`: the entity novelty
+    before the knowledge of the capsule is written and the entity gaps after the batch upload. If
+    several capsules in a batch mention the same entity, the novelty of all but the first is
+    computed after the upload.
+
+    All other capsules, in particular chat statements and questions, are processed immediately.
+    They wait at most for the processing of a single perception capsule.
+
+    Deferred, duplicate and uploaded capsules are counted in the ``brain_batch_status`` metrics
+    group, the duration of the batch upload is recorded in the ``brain_batch`` group.
+    """
+
+    @classmethod
+    def from_config(cls, brain: LongTermMemory, event_bus: EventBus, resource_manager: ResourceManager,
+                    config_manager: ConfigurationManager, metrics: MetricsRegistry = None):
+        config = config_manager.get_config("cltl.brain")
+
+        return cls(config.get("topic_input"), config.get("topic_output"), brain, event_bus, resource_manager,
+                   window=config.get_float("write_window") / 1000 if "write_window" in config else 0.5,
+                   max_size=config.get_int("write_batch_size") if "write_batch_size" in config else 256,
+                   metrics=metrics)
+
+    def __init__(self, input_topic: str, output_topic: str, brain: LongTermMemory,
+                 event_bus: EventBus, resource_manager: ResourceManager, window: float = 0.5,
+                 max_size: int = 256, metrics: MetricsRegistry = None):
+        """
+        Parameters
+        ----------
+        window : float
+            Maximum time in seconds a perception capsule waits before it is written to the brain.
+        max_size : int
+            Number of distinct perception capsules that triggers a write before the window ends.
+        metrics : MetricsRegistry
+            Optional registry to record the number of batched capsules and the upload latency.
+        """
+        super().__init__(input_topic, output_topic, brain, event_bus, resource_manager)
+        self._window = window
+        self._max_size = max_size
+        self._metrics = metrics
+
+        self._brain_lock = threading.Lock()
+        self._pending = OrderedDict()
+        self._pending_since = None
+        self._pending_span = None
+        self._condition = threading.Condition()
+        self._running = False
+        self._flush_thread = None
+
+    def start(self, timeout=30):
+        with self._condition:
+            self._running = True
+        self._flush_thread = threading.Thread(target=self._run, name="BrainWriteBatch", daemon=True)
+        self._flush_thread.start()
+
+        super().start(timeout)
+
+    def stop(self):
+        try:
+            super().stop()
+        finally:
+            with self._condition:
+                self._running = False
+                self._condition.notify()
+            if self._flush_thread:
+                self._flush_thread.join()
+                self._flush_thread = None
+
+    def _process(self, event: Event[List[dict]]):
+        immediate = []
+        for capsule in event.payload:
+            try:
+                perception = _utterance_type(capsule) in PERCEPTION_TYPES
+            except KeyError:
+                perception = False
+
+            if perception:
+                self._defer(capsule)
+            else:
+                immediate.append(capsule)
+
+        if immediate:
+            with self._brain_lock:
+                super()._process(Event.for_payload(immediate))
+
+    def _defer(self, capsule: dict):
+        key = json.dumps({field: capsule.get(field) for field in IDENTITY_KEYS}, sort_keys=True, default=str)
+
+        with self._condition:
+            if key in self._pending:
+                self._count("duplicate")
+                return
+
+            self._pending[key] = capsule
+            if self._pending_since is None:
+                # The responses of the batch belong to the trace of its first capsule
+                self._pending_since = time.monotonic()
+                self._pending_span = current_span()
+                self._condition.notify()
+            elif len(self._pending) >= self._max_size:
+                self._condition.notify()
+
+        self._count("deferred")
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and not self._is_due():
+                    timeout = self._pending_since + self._window - time.monotonic() if self._pending else None
+                    self._condition.wait(timeout)
+
+                capsules = list(self._pending.values())
+                span = self._pending_span
+                self._pending.clear()
+                self._pending_since = None
+                self._pending_span = None
+                running = self._running
+
+            if capsules:
+                try:
+                    with active_span(span):
+                        self._write_batch(capsules)
+                except Exception:
+                    logger.exception("Failed to write batch of %s capsules to the brain", len(capsules))
+
+            if not running:
+                break
+
+    def _is_due(self) -> bool:
+        return bool(self._pending) and (len(self._pending) >= self._max_size
+                                        or time.monotonic() - self._pending_since >= self._window)
+
+    def _write_batch(self, capsules: List[dict]):
+        uploads = []
+        responses = []
+        entities = set()
+        for capsule in capsules:
+            # The brain is locked per capsule, to let chat capsules in between
+            with self._brain_lock:
+                self._brain._upload_to_brain = uploads.append
+                try:
+                    # Thoughts are computed here, as the capsule is not yet uploaded within capsule_mention
+                    response = self._brain.capsule_mention(capsule, create_label=True, return_thoughts=False)
+                    if response:
+                        entity = response['mention']['entity']
+                        novelty = self._brain.thought_generator.fill_entity_novelty(entity.id, entity.id) \
+                            if entity.id not in entities else None
+                        entities.add(entity.id)
+                        responses.append((response, novelty))
+                except Exception:
+                    logger.exception("Brain error (%s)", capsule)
+                finally:
+                    del self._brain._upload_to_brain
+
+        if not uploads:
+            return
+
+        start = time.perf_counter()
+        with self._brain_lock:
+            code = self._brain._upload_to_brain(merge_rdf(uploads, self._brain._connection.format))
+        if self._metrics:
+            self._metrics.record("brain_batch", "upload", (time.perf_counter() - start) * 1000)
+        self._count("uploaded", len(capsules))
+        logger.debug("Uploaded batch of %s capsules to the brain (%s)", len(capsules), code)
+
+        for response, novelty in responses:
+            entity = response['mention']['entity']
+            try:
+                with self._brain_lock:
+                    if novelty is None:
+                        novelty = self._brain.thought_generator.fill_entity_novelty(entity.id, entity.id)
+                    gaps = self._brain.thought_generator.get_entity_gaps(entity)
+                response['thoughts'] = Thoughts(None, novelty, None, None, None, gaps, None, None)
+            except Exception:
+                logger.exception("Failed to create thoughts for %s", entity.id)
+            response['response'] = code
+
+        if responses:
+            self._event_bus.publish(self._output_topic, Event.for_payload([response for response, _ in responses]))
+
+    def _count(self, key: str, count: int = 1):
+        if self._metrics:
+            self._metrics.increment("brain_batch_status", key, count)
@@ -0,0 +1,294 @@
+import copy
+import functools
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import FrozenSet, Iterable, Optional
+
+from cltl.brain.infrastructure import StoreConnector
+from rdflib import OWL, RDFS, Dataset, URIRef
+from rdflib.paths import NegatedPath, Path
+from rdflib.plugins.sparql import prepareQuery, prepareUpdate
+from rdflib.term import Variable
+
+from leolani_app.metrics import MetricsRegistry
+
+logger = logging.getLogger(__name__)
+
+
+_WHITESPACE = re.compile(r"\s+")
+
+SCHEMA_IRIS = frozenset(str(iri) for iri in (
+    RDFS.subClassOf, RDFS.subPropertyOf, RDFS.domain, RDFS.range,
+    OWL.equivalentClass, OWL.equivalentProperty, OWL.inverseOf, OWL.sameAs,
+    OWL.TransitiveProperty, OWL.SymmetricProperty))
+"""IRIs of ontology triples from which the triple store can infer triples with any other IRIs."""
+
+
+def normalize_query(query: str) -> str:
+    return _WHITESPACE.sub(" ", query).strip()
+
+
+def _walk(node):
+    """Yield all triple patterns in the SPARQL algebra."""
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key == "triples" and isinstance(value, list):
+                yield from (tuple(triple) for triple in value)
+            else:
+                yield from _walk(value)
+        return
+
+    if isinstance(node, (list, tuple)):
+        for item in node:
+            yield from _walk(item)
+
+
+def _path_iris(path) -> Optional[set]:
+    if isinstance(path, URIRef):
+        return {path}
+    if isinstance(path, NegatedPath) or not isinstance(path, Path):
+        return None
+
+    iris = set()
+    for attribute in ("args", "path", "arg"):
+        value = getattr(path, attribute, None)
+        for part in (value if isinstance(value, list) else [value] if value is not None else []):
+            part_iris = _path_iris(part)
+            if part_iris is None:
+                return None
+            iris |= part_iris
+
+    return iris
+
+
+@functools.lru_cache(maxsize=1024)
+def query_dependencies(query: str) -> Optional[FrozenSet[str]]:
+    """
+    The IRIs the result of the query depends on, or ``None`` if the query may depend on any triple.
+
+    A triple can only affect the result of the query if it matches one of its triple patterns,
+    i.e. contains all constants of the pattern. If every pattern contains an IRI, triples that
+    contain none of the IRIs of the query don't affect its result.
+
+    >>> sorted(query_dependencies("SELECT ?name WHERE { <http://ex.org/sam> <http://ex.org/name> ?name }"))
+    ['http://ex.org/name', 'http://ex.org/sam']
+    >>> query_dependencies("SELECT * WHERE { ?s ?p ?o }") is None
+    True
+    """
+    try:
+        algebra = prepareQuery(query).algebra
+    except Exception:
+        logger.debug("Can't analyze query, it depends on any change: %s", query)
+        return None
+
+    iris = set()
+    for triple in _walk(algebra):
+        pattern_iris = set()
+        for term in triple:
+            if isinstance(term, Path):
+                path_iris = _path_iris(term)
+                if path_iris is None:
+                    return None
+                pattern_iris |= path_iris
+            elif isinstance(term, URIRef):
+                pattern_iris.add(term)
+        if not pattern_iris:
+            return None
+        iris |= pattern_iris
+
+    return frozenset(str(iri) for iri in iris)
+
+
+def _triple_iris(triples: Iterable) -> set:
+    return {str(term) for triple in triples for term in triple[:3] if isinstance(term, URIRef)}
+
+
+def update_changes(update: str) -> Optional[set]:
+    """
+    The IRIs of the triples changed by the update, or ``None`` if they can't be determined.
+
+    >>> sorted(update_changes("INSERT DATA { <http://ex.org/sam> <http://ex.org/name> 'Sam' }"))
+    ['http://ex.org/name', 'http://ex.org/sam']
+    >>> update_changes("DELETE { ?s ?p ?o } WHERE { ?s ?p ?o }") is None
+    True
+    """
+    try:
+        requests = prepareUpdate(update).algebra
+    except Exception:
+        return None
+
+    iris = set()
+    for request in requests:
+        if request.name not in ("InsertData", "DeleteData"):
+            return None
+
+        triples = list(request.get("triples") or [])
+        for graph_triples in (request.get("quads") or {}).values():
+            triples.extend(graph_triples)
+        if any(isinstance(term, Variable) for triple in triples for term in triple):
+            return None
+        iris |= _triple_iris(triples)
+
+    return iris
+
+
+def upload_changes(data: str, format: str) -> Optional[set]:
+    """
+    The IRIs of the uploaded triples, or ``None`` if they can't be determined.
+    """
+    try:
+        dataset = Dataset()
+        dataset.parse(data=data, format=format)
+    except Exception:
+        return None
+
+    return _triple_iris(dataset.quads((None, None, None, None)))
+
+
+class CachingStoreConnector(StoreConnector):
+    """
+    Read cache in front of a triple store connection.
+
+    Query results are cached by the normalized query. Updates and uploads through the connection
+    invalidate only the cached queries that depend on the changed triples, see :func:`query_dependencies`;
+    updates whose changes can't be determined, e.g. ``DELETE ... WHERE``, and changes of the ontology,
+    see :data:`SCHEMA_IRIS`, invalidate the whole cache.
+
+    Triples the triple store infers from the changed triples with an existing ontology, e.g. through
+    super properties, and changes by other clients are not detected. The age of cached results is
+    therefore bounded by ``max_age``.
+
+    Hits, misses and invalidations are counted in the ``brain_cache_status`` metrics group, the age
+    of the results returned from the cache is recorded in the ``brain_cache`` group.
+    """
+
+    def __init__(self, connector: StoreConnector, max_size: int = 1024, max_age: float = 0.0,
+                 metrics: MetricsRegistry = None):
+        """
+        Parameters
+        ----------
+        connector : StoreConnector
+            The connection to the triple store.
+        max_size : int
+            Maximum number of cached query results.
+        max_age : float
+            Maximum age in seconds of cached results, ``0`` for no limit.
+        metrics : MetricsRegistry
+            Optional registry to record cache metrics.
+        """
+        super().__init__(connector.address, connector.format)
+        self._connector = connector
+        self._max_size = max_size
+        self._max_age = max_age
+        self._metrics = metrics
+
+        self._entries = OrderedDict()
+        self._dependents = defaultdict(set)
+        self._unrestricted = set()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def upload(self, data):
+        try:
+            return self._connector.upload(data)
+        finally:
+            self._invalidate(upload_changes(data, self.format))
+
+    def query(self, query, ask=False, post=False):
+        if post:
+            try:
+                return self._connector.query(query, ask=ask, post=post)
+            finally:
+                self._invalidate(update_changes(query))
+
+        key = (normalize_query(query), ask)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._max_age and time.monotonic() - entry[1] > self._max_age:
+                self._remove(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+            generation = self._generation
+
+        if entry is not None:
+            self._count("hit")
+            if self._metrics:
+                self._metrics.record("brain_cache", "age", (time.monotonic() - entry[1]) * 1000)
+            return copy.deepcopy(entry[0])
+
+        self._count("miss")
+        result = self._connector.query(query, ask=ask, post=post)
+        dependencies = query_dependencies(key[0])
+
+        with self._lock:
+            # Don't cache results that may have been read before a concurrent change
+            if generation == self._generation:
+                self._add(key, copy.deepcopy(result), dependencies)
+
+        return result
+
+    def export_repository(self):
+        return self._connector.export_repository()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._dependents.clear()
+            self._unrestricted.clear()
+            self._generation += 1
+
+    def close(self):
+        self.clear()
+        if hasattr(self._connector, "close"):
+            self._connector.close()
+
+    def _add(self, key, result, dependencies: Optional[FrozenSet[str]]):
+        if key in self._entries:
+            self._remove(key)
+
+        self._entries[key] = (result, time.monotonic(), dependencies)
+        if dependencies is None:
+            self._unrestricted.add(key)
+        else:
+            for iri in dependencies:
+                self._dependents[iri].add(key)
+
+        while len(self._entries) > self._max_size:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        _, _, dependencies = self._entries.pop(key)
+        if dependencies is None:
+            self._unrestricted.discard(key)
+            return
+
+        for iri in dependencies:
+            dependents = self._dependents.get(iri)
+            if dependents is not None:
+                dependents.discard(key)
+                if not dependents:
+                    del self._dependents[iri]
+
+    def _invalidate(self, changes: Optional[set]):
+        if changes is None or not SCHEMA_IRIS.isdisjoint(changes):
+            self.clear()
+            self._count("cleared")
+            return
+
+        with self._lock:
+            self._generation += 1
+            keys = set(self._unrestricted)
+            for iri in changes:
+                keys |= self._dependents.get(iri, set())
+            for key in keys:
+                self._remove(key)
+
+        self._count("invalidated", len(keys))
+
+    def _count(self, key: str, count: int = 1):
+        if self._metrics and count:
+            self._metrics.increment("brain_cache_status", key, count)
@@ -0,0 +1,209 @@
+import logging
+import threading
+import time
+from typing import Any, Optional
+
+import requests
+from cltl.brain.infrastructure import StoreConnector
+from cltl.combot.infra.config import ConfigurationManager
+from requests.adapters import HTTPAdapter
+
+from leolani_app.brain_cache import CachingStoreConnector
+from leolani_app.embedded_brain import EmbeddedStoreConnector, is_embedded
+from leolani_app.metrics import MetricsRegistry
+
+logger = logging.getLogger(__name__)
+
+
+class PooledStoreConnector(StoreConnector):
+    """
+    Connection to the triple store that is shared by all brain components.
+
+    Requests are sent over a pool of keep-alive HTTP connections, the number of concurrent
+    requests to the triple store is limited. The latency of queries and uploads is recorded
+    in the ``brain`` metrics group by query type, failed requests are counted in ``brain_status``.
+    """
+
+    @classmethod
+    def from_config(cls, config_manager: ConfigurationManager, metrics: MetricsRegistry = None):
+        config = config_manager.get_config("cltl.brain")
+
+        return cls(config.get("address"),
+                   pool_size=config.get_int("pool_size") if "pool_size" in config else 8,
+                   max_concurrency=config.get_int("max_concurrency") if "max_concurrency" in config else 4,
+                   timeout=config.get_float("timeout") if "timeout" in config else 30.0,
+                   metrics=metrics)
+
+    def __init__(self, address: str, format: str = "trig", pool_size: int = 8, max_concurrency: int = 4,
+                 timeout: float = 30.0, metrics: MetricsRegistry = None):
+        """
+        Parameters
+        ----------
+        address : str
+            URL of the repository in the triple store.
+        format : str
+            RDF serialization format of uploaded data.
+        pool_size : int
+            Maximum number of keep-alive connections.
+        max_concurrency : int
+            Maximum number of concurrent requests, further requests wait for a free slot.
+        timeout : float
+            Connect and read timeout of a request in seconds.
+        metrics : MetricsRegistry
+            Optional registry to record request latencies and failures.
+        """
+        super().__init__(address, format)
+        self._timeout = timeout
+        self._metrics = metrics
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+
+        self._session = requests.Session()
+        self._session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self._session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    def upload(self, data):
+        response = self._request("upload", "POST", self.address + "/statements", data=data,
+                                 headers={'Content-Type': 'application/x-' + self.format})
+
+        return str(response.status_code)
+
+    def query(self, query, ask=False, post=False):
+        if post:
+            response = self._request("update", "POST", self.address + "/statements", data={"update": query},
+                                     headers={'Accept': 'application/sparql-results+json'})
+            response.raise_for_status()
+
+            return response.json() if response.content and "json" in response.headers.get("Content-Type", "") \
+                else response.text
+
+        response = self._request("ask" if ask else "select", "POST", self.address, data={"query": query},
+                                 headers={'Accept': 'application/sparql-results+json'})
+        response.raise_for_status()
+        result = response.json()
+
+        return result['boolean'] if ask else result["results"]["bindings"]
+
+    def export_repository(self):
+        response = self._request("export", "GET", self.address + "/statements",
+                                 headers={'Accept': 'application/x-' + self.format})
+
+        return str(response.text)
+
+    def close(self):
+        self._session.close()
+
+    def _request(self, kind: str, method: str, url: str, **kwargs) -> requests.Response:
+        start = time.perf_counter()
+        with self._slots:
+            acquired = time.perf_counter()
+            try:
+                return self._session.request(method, url, timeout=self._timeout, **kwargs)
+            except requests.RequestException:
+                if self._metrics:
+                    self._metrics.increment("brain_status", f"{kind}.failed")
+                raise
+            finally:
+                if self._metrics:
+                    self._metrics.record("brain", "wait", (acquired - start) * 1000)
+                    self._metrics.record("brain", kind, (time.perf_counter() - acquired) * 1000)
+
+
+def store_connector_from_config(config_manager: ConfigurationManager,
+                                metrics: MetricsRegistry = None) -> Optional[StoreConnector]:
+    """
+    The shared connector for the configured brain address, or ``None`` if the brain components
+    should use their own connections.
+
+    The embedded store is always shared, as there can be only one instance of it. The query cache
+    requires a shared connector, as it is invalidated by the changes made through the connector.
+    """
+    config = config_manager.get_config("cltl.brain")
+    address = config.get("address")
+    cache_size = config.get_int("query_cache_size") if "query_cache_size" in config else 0
+
+    if is_embedded(address):
+        connector = EmbeddedStoreConnector(address,
+                                           flush_interval=config.get_float("flush_interval")
+                                           if "flush_interval" in config else 5.0)
+    elif cache_size or "shared_client" in config and config.get_boolean("shared_client"):
+        connector = PooledStoreConnector.from_config(config_manager, metrics)
+    else:
+        return None
+
+    if cache_size:
+        max_age = config.get_float("query_cache_max_age") if "query_cache_max_age" in config else 0.0
+        connector = CachingStoreConnector(connector, cache_size, max_age, metrics)
+
+    return connector
+
+
+_SHARED_CONNECTORS = {}
+
+
+def _connector_factory(address: str, format: str = "trig") -> StoreConnector:
+    connector = _SHARED_CONNECTORS.get(address.rstrip("/"))
+    if connector is not None and connector.format == format:
+        return connector
+
+    return StoreConnector(address, format)
+
+
+def install_connector(connector: StoreConnector):
+    """
+    Use the connector in brain components that are constructed afterwards, if they connect to its address.
+
+    Brain components create their connection in the constructor of the :class:`BasicBrain`, which
+    is replaced by the shared connector. This is required for the embedded store, whose address
+    is not understood by the default connection.
+    """
+    from cltl.brain import basic_brain
+
+    _SHARED_CONNECTORS[connector.address.rstrip("/")] = connector
+    basic_brain.StoreConnector = _connector_factory
+
+
+def uninstall_connector(connector: StoreConnector):
+    """
+    Stop using the connector in brain components, and restore the default connection once no connector is installed.
+    """
+    from cltl.brain import basic_brain
+
+    if _SHARED_CONNECTORS.get(connector.address.rstrip("/")) is connector:
+        del _SHARED_CONNECTORS[connector.address.rstrip("/")]
+    if not _SHARED_CONNECTORS:
+        basic_brain.StoreConnector = StoreConnector
+
+
+def share_connection(component: Any, connector: StoreConnector, max_depth: int = 3) -> int:
+    """
+    Replace the store connections of the brain component and the brains it contains by the shared connector.
+
+    Only connections to the same address as the shared connector are replaced.
+
+    Returns
+    -------
+    int
+        The number of replaced connections.
+    """
+    return _share_connection(component, connector, max_depth, set())
+
+
+def _share_connection(component: Any, connector: StoreConnector, depth: int, visited: set) -> int:
+    if depth < 0 or id(component) in visited or not hasattr(component, "__dict__"):
+        return 0
+    visited.add(id(component))
+
+    replaced = 0
+    connection: Optional[StoreConnector] = vars(component).get("_connection")
+    if isinstance(connection, StoreConnector) and connection is not connector:
+        if connection.address.rstrip("/") == connector.address.rstrip("/"):
+            component._connection = connector
+            replaced += 1
+        else:
+            logger.info("Keep connection of %s to %s", component.__class__.__name__, connection.address)
+
+    for value in list(vars(component).values()):
+        if hasattr(value, "__dict__") and not isinstance(value, (StoreConnector, type)):
+            replaced += _share_connection(value, connector, depth - 1, visited)
+
+    return replaced
@@ -0,0 +1,220 @@
+"""
+In-process triple store for the brain, as alternative to GraphDB for single-node deployments and tests.
+
+The store is selected with an ``embedded://`` address of the brain, followed by the directory of
+the store, e.g. ``embedded:///var/leolani/brain`` or ``embedded://./storage/brain``. The repository
+is kept in memory and persisted as N-Quads in that directory.
+
+Repositories can be copied between GraphDB and the embedded store, e.g. from the ``py-app/`` directory::
+
+    python -m leolani_app.embedded_brain http://localhost:7200/repositories/sandbox embedded://./storage/brain
+
+or exported to and imported from a TriG file by using the file as source or target.
+"""
+import argparse
+import functools
+import logging
+import os
+import threading
+import time
+from typing import List, Optional
+
+from cltl.brain.infrastructure import StoreConnector
+from rdflib import BNode, Dataset, Literal, URIRef
+from rdflib.plugins.sparql import prepareQuery
+
+logger = logging.getLogger(__name__)
+
+
+EMBEDDED_SCHEME = "embedded://"
+_REPOSITORY_FILE = "repository.nq"
+
+
+def is_embedded(address: str) -> bool:
+    return address.startswith(EMBEDDED_SCHEME)
+
+
+def _term(term) -> dict:
+    if isinstance(term, URIRef):
+        return {"type": "uri", "value": str(term)}
+    if isinstance(term, BNode):
+        return {"type": "bnode", "value": str(term)}
+
+    value = {"type": "literal", "value": str(term)}
+    if isinstance(term, Literal):
+        if term.language:
+            value["xml:lang"] = term.language
+        elif term.datatype:
+            value["datatype"] = str(term.datatype)
+
+    return value
+
+
+@functools.lru_cache(maxsize=512)
+def _prepare(query: str):
+    # Parsing dominates the time of queries on small repositories and brain queries are repeated a lot
+    return prepareQuery(query)
+
+
+class EmbeddedStoreConnector(StoreConnector):
+    """
+    Triple store connection to an in-process RDF dataset, with the same interface and query results
+    as the connection to GraphDB. The default graph is the union of all named graphs, as in GraphDB.
+
+    Changes are written to disk by a background thread at most every ``flush_interval`` seconds
+    and when the connection is closed. Note that no RDFS inference is applied to the data.
+    """
+
+    def __init__(self, address: str, format: str = "trig", flush_interval: float = 5.0):
+        """
+        Parameters
+        ----------
+        address : str
+            ``embedded://`` followed by the directory of the store.
+        format : str
+            RDF serialization format of uploaded and exported data.
+        flush_interval : float
+            Maximum time in seconds before changes are written to disk.
+        """
+        if not is_embedded(address):
+            raise ValueError(f"Not an embedded store address: {address}")
+
+        super().__init__(address, format)
+        self._directory = address[len(EMBEDDED_SCHEME):]
+        self._flush_interval = flush_interval
+
+        self._dataset = Dataset(default_union=True)
+        self._lock = threading.RLock()
+        self._dirty = False
+        self._closed = threading.Event()
+
+        self._load()
+        self._flusher = threading.Thread(target=self._run, name="EmbeddedBrainFlush", daemon=True)
+        self._flusher.start()
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self._directory, _REPOSITORY_FILE)
+
+    def upload(self, data):
+        with self._lock:
+            self._dataset.parse(data=data, format=self.format)
+            self._dirty = True
+
+        return "204"
+
+    def query(self, query, ask=False, post=False):
+        with self._lock:
+            if post:
+                self._dataset.update(query)
+                self._dirty = True
+                return ""
+
+            result = self._dataset.query(_prepare(query))
+            if ask:
+                return bool(result.askAnswer)
+
+            return [{str(var): _term(value) for var, value in row.asdict().items()} for row in result]
+
+    def export_repository(self):
+        with self._lock:
+            return self._dataset.serialize(format=self.format)
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            data = self._dataset.serialize(format="nquads")
+            self._dirty = False
+
+        os.makedirs(self._directory, exist_ok=True)
+        with open(self.path + ".tmp", "w") as repository_file:
+            repository_file.write(data)
+        os.replace(self.path + ".tmp", self.path)
+        logger.debug("Saved embedded brain to %s", self.path)
+
+    def close(self):
+        self._closed.set()
+        self._flusher.join()
+        self.flush()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            logger.info("Created embedded brain at %s", self._directory)
+            return
+
+        start = time.perf_counter()
+        with self._lock:
+            self._dataset.parse(self.path, format="nquads")
+        logger.info("Loaded embedded brain from %s (%s quads) in %.1f s",
+                    self.path, len(self._dataset), time.perf_counter() - start)
+
+    def _run(self):
+        while not self._closed.wait(self._flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to save embedded brain to %s", self.path)
+
+
+def _open(location: str) -> Optional[StoreConnector]:
+    if is_embedded(location):
+        return EmbeddedStoreConnector(location)
+    if location.startswith(("http://", "https://")):
+        from leolani_app.brain_client import PooledStoreConnector
+        return PooledStoreConnector(location)
+
+    return None
+
+
+def copy_repository(source: str, target: str) -> None:
+    """
+    Copy the content of a repository to another repository or file.
+
+    Parameters
+    ----------
+    source : str
+        GraphDB repository URL, ``embedded://`` address or TriG file.
+    target : str
+        GraphDB repository URL, ``embedded://`` address or TriG file.
+    """
+    connections: List[StoreConnector] = []
+    try:
+        source_connection = _open(source)
+        if source_connection:
+            connections.append(source_connection)
+            data = source_connection.export_repository()
+        else:
+            with open(source) as source_file:
+                data = source_file.read()
+
+        target_connection = _open(target)
+        if target_connection:
+            connections.append(target_connection)
+            status = target_connection.upload(data)
+            if not str(status).startswith("2"):
+                raise ValueError(f"Failed to upload to {target}: {status}")
+        else:
+            with open(target, "w") as target_file:
+                target_file.write(data)
+    finally:
+        for connection in connections:
+            if hasattr(connection, "close"):
+                connection.close()
+
+    logger.info("Copied %s to %s", source, target)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy brain repositories between GraphDB and the embedded store")
+    parser.add_argument("source", type=str, help="GraphDB repository URL, embedded:// address or TriG file")
+    parser.add_argument("target", type=str, help="GraphDB repository URL, embedded:// address or TriG file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    copy_repository(args.source, args.target)
+
+
+if __name__ == '__main__':
+    main()
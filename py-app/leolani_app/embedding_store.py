@@ -0,0 +1,232 @@
+import json
+import logging
+import os
+import struct
+from typing import Any, List, Optional
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+_MAGIC = b"LEOEMB01"
+_HEADER = struct.Struct("<8sI")
+_HEADER_SIZE = 64
+
+_EMBEDDINGS_FILE = "embeddings.f32"
+_LABELS_FILE = "labels.i64"
+_CLUSTERS_FILE = "clusters.jsonl"
+_LOCK_FILE = "writer.lock"
+
+
+class EmbeddingStore:
+    """
+    Append-only, memory-mapped storage of embeddings with a label per embedding and a log of cluster changes.
+
+    The store is a directory with
+
+    * ``embeddings.f32``: a 64 byte header with the dimension, followed by the embeddings as float32 rows,
+    * ``labels.i64``: the label of each embedding as int64,
+    * ``clusters.jsonl``: cluster changes, one JSON value per line.
+
+    Embeddings are appended to the files and read through a memory map, so opening the store does not
+    load the embeddings into memory. The number of embeddings is derived from the file sizes; rows that
+    were not completely written, e.g. when the process was killed, are discarded by the next writer.
+
+    Only one process can open the store for writing, any number of processes can open it read-only and
+    see the appended data after :meth:`refresh`.
+    """
+
+    def __init__(self, directory: str, read_only: bool = False):
+        """
+        Parameters
+        ----------
+        directory : str
+            Directory of the store, created if it does not exist and the store is writable.
+        read_only : bool
+            Open the store for reading only.
+
+        Raises
+        ------
+        RuntimeError
+            If the store is writable and already opened for writing by another process.
+        """
+        self._directory = directory
+        self._read_only = read_only
+
+        self._dim = None
+        self._count = 0
+        self._vectors = None
+        self._labels = None
+        self._clusters_offset = 0
+        self._lock_file = None
+
+        if not read_only:
+            os.makedirs(directory, exist_ok=True)
+            self._lock()
+
+        self._read_header()
+        self.refresh()
+        if not read_only:
+            self._truncate()
+
+    @property
+    def dim(self) -> Optional[int]:
+        return self._dim
+
+    @property
+    def read_only(self) -> bool:
+        return self._read_only
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """Read-only view of the stored embeddings."""
+        if self._vectors is None or len(self._vectors) != self._count:
+            self._vectors = self._map(_EMBEDDINGS_FILE, np.float32, _HEADER_SIZE, (self._count, self._dim or 0))
+
+        return self._vectors
+
+    @property
+    def labels(self) -> np.ndarray:
+        """Read-only view of the labels of the stored embeddings."""
+        if self._labels is None or len(self._labels) != self._count:
+            self._labels = self._map(_LABELS_FILE, np.int64, 0, (self._count,))
+
+        return self._labels
+
+    def read_clusters(self) -> List[Any]:
+        """
+        Cluster changes appended since the last call.
+        """
+        path = self._path(_CLUSTERS_FILE)
+        if not os.path.exists(path):
+            return []
+
+        with open(path, "rb") as clusters_file:
+            clusters_file.seek(self._clusters_offset)
+            data = clusters_file.read()
+
+        # Ignore an incomplete last line, it is read when it is complete
+        complete = data[:data.rfind(b"\n") + 1]
+        self._clusters_offset += len(complete)
+
+        return [json.loads(line) for line in complete.decode("utf-8").splitlines() if line]
+
+    def append(self, vectors: np.ndarray, labels: np.ndarray, clusters: List[Any] = ()):
+        """
+        Append embeddings with their labels, and the cluster changes they caused.
+
+        The cluster changes are written first and the labels last, so a partially written
+        append doesn't leave embeddings without cluster.
+        """
+        if self._read_only:
+            raise ValueError(f"Embedding store {self._directory} is read-only")
+
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        labels = np.ascontiguousarray(labels, dtype=np.int64)
+        if len(vectors) != len(labels):
+            raise ValueError(f"Number of embeddings ({len(vectors)}) and labels ({len(labels)}) differ")
+        if self._dim is None:
+            self._write_header(vectors.shape[1])
+        elif vectors.shape[1] != self._dim:
+            raise ValueError(f"Dimension of the embeddings ({vectors.shape[1]}) differs from the store ({self._dim})")
+
+        if clusters:
+            with open(self._path(_CLUSTERS_FILE), "ab") as clusters_file:
+                data = "".join(json.dumps(change) + "\n" for change in clusters).encode("utf-8")
+                clusters_file.write(data)
+            self._clusters_offset += len(data)
+
+        with open(self._path(_EMBEDDINGS_FILE), "ab") as embeddings_file:
+            embeddings_file.write(vectors.tobytes())
+        with open(self._path(_LABELS_FILE), "ab") as labels_file:
+            labels_file.write(labels.tobytes())
+
+        self._count += len(vectors)
+
+    def refresh(self) -> int:
+        """
+        Update the number of embeddings from the files, e.g. after another process appended to them.
+
+        Returns
+        -------
+        int
+            The number of new embeddings.
+        """
+        if self._dim is None:
+            self._read_header()
+        if self._dim is None:
+            return 0
+
+        embeddings_size = os.path.getsize(self._path(_EMBEDDINGS_FILE)) - _HEADER_SIZE
+        labels_size = os.path.getsize(self._path(_LABELS_FILE)) if os.path.exists(self._path(_LABELS_FILE)) else 0
+        count = min(embeddings_size // (4 * self._dim), labels_size // 8)
+
+        added = count - self._count
+        self._count = count
+
+        return added
+
+    def close(self):
+        if self._lock_file:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _map(self, name: str, dtype, offset: int, shape) -> np.ndarray:
+        if not shape[0]:
+            return np.empty(shape, dtype=dtype)
+
+        return np.memmap(self._path(name), dtype=dtype, mode="r", offset=offset, shape=shape)
+
+    def _read_header(self):
+        path = self._path(_EMBEDDINGS_FILE)
+        if not os.path.exists(path) or os.path.getsize(path) < _HEADER_SIZE:
+            return
+
+        with open(path, "rb") as embeddings_file:
+            magic, dim = _HEADER.unpack(embeddings_file.read(_HEADER.size))
+        if magic != _MAGIC:
+            raise ValueError(f"Not an embedding store: {path}")
+        self._dim = dim
+
+    def _write_header(self, dim: int):
+        with open(self._path(_EMBEDDINGS_FILE), "wb") as embeddings_file:
+            embeddings_file.write(_HEADER.pack(_MAGIC, dim).ljust(_HEADER_SIZE, b"\0"))
+        open(self._path(_LABELS_FILE), "wb").close()
+        self._dim = dim
+
+    def _truncate(self):
+        """Discard incompletely written rows."""
+        if self._dim is None:
+            return
+
+        expected = _HEADER_SIZE + self._count * 4 * self._dim
+        if os.path.getsize(self._path(_EMBEDDINGS_FILE)) > expected:
+            logger.warning("Discard incomplete embeddings in %s", self._directory)
+            os.truncate(self._path(_EMBEDDINGS_FILE), expected)
+        if os.path.getsize(self._path(_LABELS_FILE)) > self._count * 8:
+            logger.warning("Discard incomplete labels in %s", self._directory)
+            os.truncate(self._path(_LABELS_FILE), self._count * 8)
+
+    def _lock(self):
+        if fcntl is None:
+            return
+
+        self._lock_file = open(self._path(_LOCK_FILE), "w")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_file.close()
+            self._lock_file = None
+            raise RuntimeError(f"Embedding store {self._directory} is already opened for writing")
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self._directory, name)
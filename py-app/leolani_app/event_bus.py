@@ -0,0 +1,210 @@
+import enum
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from queue import Queue, Full, Empty
+from typing import Callable, Dict, Iterable, List, Mapping
+
+from cltl.combot.infra.config import ConfigurationManager
+from cltl.combot.infra.event import EventBus, Event
+
+from leolani_app.metrics import MetricsRegistry, subscriber_name
+
+logger = logging.getLogger(__name__)
+
+
+_STOP = object()
+
+
+class QueuePolicy(enum.Enum):
+    """
+    Strategy applied when an event is published while the queue of a subscriber is full.
+    """
+    BLOCK = enum.auto()
+    """Block the publisher until there is space in the queue."""
+    DROP_OLDEST = enum.auto()
+    """Drop the oldest queued event."""
+    DROP_NEWEST = enum.auto()
+    """Drop the published event."""
+    KEEP_LATEST = enum.auto()
+    """Keep only the latest event, regardless of the configured queue size."""
+
+
+@dataclass
+class TopicQueue:
+    size: int
+    policy: QueuePolicy = QueuePolicy.BLOCK
+
+
+class _Subscription:
+    def __init__(self, topic: str, handler: Callable[[Event], None], topic_queue: TopicQueue, workers: int,
+                 metrics: MetricsRegistry = None):
+        self.topic = topic
+        self.handler = handler
+        self.name = subscriber_name(handler)
+
+        self._policy = topic_queue.policy
+        self._queue = Queue(maxsize=1 if self._policy == QueuePolicy.KEEP_LATEST else topic_queue.size)
+        self._metrics = metrics
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._threads = [threading.Thread(target=self._run, name=f"{self.name}:{topic}:{idx}", daemon=True)
+                         for idx in range(workers)]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        # Queued events are processed before the workers terminate. Events published with a dropping
+        # policy after the subscription is stopped are dropped, so the stop sentinels are never dropped.
+        with self._lock:
+            self._stopped = True
+        for _ in self._threads:
+            self._queue.put(_STOP)
+
+    def put(self, event: Event):
+        item = (time.perf_counter(), event)
+        if self._policy == QueuePolicy.BLOCK:
+            self._queue.put(item)
+            return
+
+        with self._lock:
+            if self._stopped:
+                self._dropped(event)
+                return
+
+            while True:
+                try:
+                    self._queue.put_nowait(item)
+                    return
+                except Full:
+                    if self._policy == QueuePolicy.DROP_NEWEST:
+                        self._dropped(event)
+                        return
+
+                try:
+                    _, dropped = self._queue.get_nowait()
+                    self._dropped(dropped)
+                except Empty:
+                    pass
+
+    def _dropped(self, event: Event):
+        logger.debug("Dropped event %s on topic %s for %s", event.id, self.topic, self.name)
+        if self._metrics:
+            self._metrics.increment("dropped", f"{self.name}:{self.topic}")
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+
+            enqueued, event = item
+            if self._metrics:
+                self._metrics.record("queue", f"{self.name}:{self.topic}", (time.perf_counter() - enqueued) * 1000)
+            try:
+                self.handler(event)
+            except:
+                logger.exception("Failed to handle event %s on topic %s by %s", event.id, self.topic, self.name)
+
+
+class AsyncEventBus(EventBus):
+    """
+    In-process event bus that invokes subscribers asynchronously.
+
+    Each subscription of a handler to a topic has its own bounded queue and worker
+    thread(s), so a slow subscriber does not stall the publisher or other subscribers.
+    Publishing only blocks if the queue of a subscriber is full.
+
+    With a single worker thread per subscription (the default), events are delivered
+    to a subscriber in the order they were published on a topic. The number of worker
+    threads can be increased per subscriber, in which case the order is not guaranteed
+    for that subscriber.
+    """
+
+    @classmethod
+    def from_config(cls, config_manager: ConfigurationManager, metrics: MetricsRegistry = None):
+        config = config_manager.get_config("cltl.event.async")
+        queue_size = config.get_int("queue_size")
+        concurrency = config.get("concurrency", multi=True) if "concurrency" in config else []
+        concurrency = {name.strip(): int(threads)
+                       for name, threads in (entry.split(":") for entry in concurrency)}
+
+        queue_sections = config.get("topic_queues", multi=True) if "topic_queues" in config else []
+        topic_queues = {}
+        for section in queue_sections:
+            queue_config = config_manager.get_config(section)
+            topic_queue = TopicQueue(queue_config.get_int("queue_size"),
+                                     queue_config.get_enum("queue_policy", QueuePolicy))
+            subscriber = queue_config.get("queue_subscriber") if "queue_subscriber" in queue_config else None
+            for topic in queue_config.get("queue_topics", multi=True):
+                key = f"{subscriber}:{topic}" if subscriber else topic
+                if key in topic_queues:
+                    logger.warning("Queue for %s in %s overrides %s", key, section, topic_queues[key])
+                topic_queues[key] = topic_queue
+
+        return cls(queue_size, concurrency, topic_queues, metrics)
+
+    def __init__(self, queue_size: int = 256, concurrency: Mapping[str, int] = None,
+                 topic_queues: Mapping[str, TopicQueue] = None, metrics: MetricsRegistry = None):
+        """
+        Parameters
+        ----------
+        queue_size : int
+            Maximum number of queued events per subscription, the publisher is blocked if
+            the queue is full.
+        concurrency : Mapping[str, int]
+            Number of worker threads by subscriber name, the default is a single thread.
+            Subscribers are named by their :class:`TopicWorker` name or their class name.
+        topic_queues : Mapping[str, TopicQueue]
+            Queue size and policy by ``<subscriber>:<topic>`` for the subscription of a single subscriber,
+            or by topic for all subscriptions to the topic, overriding the default queue. Use this for
+            subscribers of high-rate topics where dropping events is preferable to building up a backlog.
+        metrics : MetricsRegistry
+            Optional registry to record the time events spend in the queue and dropped events.
+        """
+        self._default_queue = TopicQueue(queue_size)
+        self._concurrency = dict(concurrency) if concurrency else {}
+        self._topic_queues = dict(topic_queues) if topic_queues else {}
+        self._metrics = metrics
+
+        self._subscriptions: Dict[str, List[_Subscription]] = {}
+        self._topic_lock = threading.RLock()
+
+    def publish(self, topic: str, event: Event) -> None:
+        with self._topic_lock:
+            subscriptions = tuple(self._subscriptions.setdefault(topic, []))
+
+        for subscription in subscriptions:
+            subscription.put(Event.with_topic(event, topic))
+
+    def subscribe(self, topic: str, handler: Callable[[Event], None]) -> None:
+        name = subscriber_name(handler)
+        topic_queue = self._topic_queues.get(f"{name}:{topic}", self._topic_queues.get(topic, self._default_queue))
+        subscription = _Subscription(topic, handler, topic_queue, self._concurrency.get(name, 1), self._metrics)
+        with self._topic_lock:
+            self._subscriptions.setdefault(topic, []).append(subscription)
+        subscription.start()
+
+        logger.info("Subscribed %s to topic %s (%s)", subscription.name, topic, topic_queue)
+
+    def unsubscribe(self, topic: str, handler: Callable[[Event], None] = None) -> None:
+        with self._topic_lock:
+            subscriptions = self._subscriptions.get(topic, [])
+            removed = [subscription for subscription in subscriptions
+                       if handler is None or subscription.handler == handler]
+            if handler and not removed:
+                raise ValueError("Failed to unregister " + subscriber_name(handler))
+            self._subscriptions[topic] = [subscription for subscription in subscriptions
+                                          if subscription not in removed]
+
+        for subscription in removed:
+            subscription.stop()
+            logger.info("Unsubscribed %s from topic %s", subscription.name, topic)
+
+    @property
+    def topics(self) -> Iterable[str]:
+        with self._topic_lock:
+            return list(self._subscriptions.keys())
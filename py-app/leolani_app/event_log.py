@@ -0,0 +1,274 @@
+import collections.abc
+import enum
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+import uuid
+from datetime import datetime, date
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+from cltl.combot.infra.config import ConfigurationManager
+from rdflib import URIRef
+
+from leolani_app.metrics import MetricsRegistry
+
+logger = logging.getLogger(__name__)
+
+
+def _identity(obj):
+    return obj
+
+
+def _enum(obj):
+    return obj.name.lower()
+
+
+def _string(obj):
+    return str(obj)
+
+
+def _array(obj):
+    return tuple(obj.tolist())
+
+
+def _isoformat(obj):
+    return obj.isoformat()
+
+
+def _named_tuple(obj):
+    return obj._asdict()
+
+
+def _iterable(obj):
+    return tuple(obj)
+
+
+class TypeDispatchSerializer:
+    """
+    Serializer for :func:`json.dumps` equivalent to the emissor ``serializer``, with the
+    conversion resolved once per type instead of by a chain of checks per object.
+
+    Objects are serialized with their public non-callable attributes. The attributes defined
+    on the class, e.g. properties, are cached per type, attributes of the instance are
+    resolved per object, as they may differ between instances of the same type.
+    """
+
+    def __init__(self):
+        self._converters: Dict[type, Callable[[Any], Any]] = {}
+        self._class_attributes: Dict[type, List[str]] = {}
+
+    def __call__(self, obj: Any) -> Any:
+        obj_type = type(obj)
+        try:
+            converter = self._converters[obj_type]
+        except KeyError:
+            converter = self._converters.setdefault(obj_type, self._resolve(obj))
+
+        try:
+            return converter(obj)
+        except Exception:
+            logger.debug("Failed to serialize %s, fall back to its string representation", obj_type)
+            return str(obj)
+
+    def _resolve(self, obj: Any) -> Callable[[Any], Any]:
+        if isinstance(obj, (str, int, float, complex, bool)):
+            return _identity
+        if isinstance(obj, enum.Enum):
+            return _enum
+        if isinstance(obj, (URIRef, uuid.UUID, pathlib.PurePath)):
+            return _string
+        if isinstance(obj, np.ndarray):
+            return _array
+        if isinstance(obj, (datetime, date)):
+            return _isoformat
+        if isinstance(obj, tuple) and hasattr(obj, '_asdict'):
+            return _named_tuple
+        if isinstance(obj, collections.abc.Iterable):
+            return _iterable
+
+        return self._attributes
+
+    def _attributes(self, obj: Any) -> dict:
+        obj_type = type(obj)
+        try:
+            class_attributes = self._class_attributes[obj_type]
+        except KeyError:
+            class_attributes = [key for key in dir(obj_type)
+                                if not key.startswith("_") and not callable(getattr(obj_type, key, None))]
+            self._class_attributes[obj_type] = class_attributes
+
+        attributes = {key: getattr(obj, key) for key in class_attributes}
+        instance_attributes = getattr(obj, "__dict__", {})
+        attributes.update((key, value) for key, value in instance_attributes.items()
+                          if not key.startswith("_") and not callable(value))
+
+        return attributes
+
+
+class BatchedLogWriter:
+    """
+    High-throughput replacement for the :class:`cltl.combot.infra.event_log.LogWriter`.
+
+    Events are buffered in memory and written by a background thread in batches, either
+    when the batch is full or after the flush interval, as line-delimited JSON with one
+    event per line. The log file is rotated when it exceeds the configured size or age.
+
+    If the writer cannot keep up and the buffer is full, new events are dropped.
+    """
+
+    @classmethod
+    def from_config(cls, config_manager: ConfigurationManager, serializer: Callable[[Any], Any] = None,
+                    metrics: MetricsRegistry = None):
+        config = config_manager.get_config("cltl.event_log")
+
+        return cls(config.get("log_dir"), serializer if serializer else TypeDispatchSerializer(),
+                   batch_size=config.get_int("batch_size") if "batch_size" in config else 256,
+                   flush_interval=config.get_float("flush_interval") if "flush_interval" in config else 1.0,
+                   buffer_size=config.get_int("buffer_size") if "buffer_size" in config else 16384,
+                   rotate_bytes=config.get_int("rotate_bytes") if "rotate_bytes" in config else 0,
+                   rotate_seconds=config.get_int("rotate_seconds") if "rotate_seconds" in config else 0,
+                   metrics=metrics)
+
+    def __init__(self, log_dir: str, serializer: Callable[[Any], Any], batch_size: int = 256,
+                 flush_interval: float = 1.0, buffer_size: int = 16384, rotate_bytes: int = 0,
+                 rotate_seconds: int = 0, metrics: MetricsRegistry = None):
+        """
+        Parameters
+        ----------
+        log_dir : str
+            Directory of the log files.
+        serializer : Callable[[Any], Any]
+            Conversion of objects to JSON serializable types, see :func:`json.dumps`.
+        batch_size : int
+            Number of buffered events that triggers a write.
+        flush_interval : float
+            Maximum time in seconds events are buffered before they are written.
+        buffer_size : int
+            Maximum number of buffered events, further events are dropped.
+        rotate_bytes : int
+            Start a new log file when the current one exceeds this size, ``0`` disables rotation by size.
+        rotate_seconds : int
+            Start a new log file when the current one is older, ``0`` disables rotation by time.
+        metrics : MetricsRegistry
+            Optional registry to record write latencies and the number of written and dropped events.
+        """
+        self._log_dir = log_dir
+        self._serializer = serializer
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._buffer_size = buffer_size
+        self._rotate_bytes = rotate_bytes
+        self._rotate_seconds = rotate_seconds
+        self._metrics = metrics
+
+        self._buffer = []
+        self._condition = threading.Condition()
+        self._running = False
+        self._writer_thread = None
+
+        self._log_file = None
+        self._log_file_opened = None
+
+    def __enter__(self):
+        with self._condition:
+            self._running = True
+        self._writer_thread = threading.Thread(target=self._run, name="BatchedLogWriter", daemon=True)
+        self._writer_thread.start()
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._writer_thread is None:
+            return
+
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._writer_thread.join()
+        self._writer_thread = None
+
+    def put(self, event):
+        with self._condition:
+            if len(self._buffer) >= self._buffer_size:
+                logger.warning("Event log overloaded: dropped event %s", getattr(event, "id", event))
+                self._count("dropped")
+                return
+
+            self._buffer.append(event)
+            if len(self._buffer) >= self._batch_size:
+                self._condition.notify()
+
+    def _run(self):
+        try:
+            running = True
+            while running:
+                with self._condition:
+                    self._condition.wait_for(lambda: not self._running or len(self._buffer) >= self._batch_size,
+                                             timeout=self._flush_interval)
+                    batch, self._buffer = self._buffer, []
+                    running = self._running
+
+                if batch:
+                    self._write(batch)
+        finally:
+            self._close()
+
+    def _write(self, batch: list):
+        start = time.perf_counter()
+
+        lines = []
+        for event in batch:
+            try:
+                lines.append(json.dumps(event, default=self._serializer, separators=(',', ':')))
+            except Exception:
+                logger.exception("Failed to serialize event %s", getattr(event, "id", event))
+                self._count("failed")
+
+        log_file = self._current_file()
+        log_file.write("\n".join(lines) + "\n")
+        log_file.flush()
+
+        self._count("written", len(lines))
+        if self._metrics:
+            self._metrics.record("event_log", "write", (time.perf_counter() - start) * 1000)
+
+    def _current_file(self):
+        if self._log_file is not None and self._rotate():
+            self._close()
+
+        if self._log_file is None:
+            path = self._get_event_log_path()
+            self._log_file = open(path, 'w')
+            self._log_file_opened = time.monotonic()
+            logger.info("Writing event log at %s", path)
+
+        return self._log_file
+
+    def _rotate(self) -> bool:
+        return bool((self._rotate_bytes and self._log_file.tell() >= self._rotate_bytes)
+                    or (self._rotate_seconds and time.monotonic() - self._log_file_opened >= self._rotate_seconds))
+
+    def _close(self):
+        if self._log_file is not None:
+            self._log_file.close()
+            logger.info("Closed event log at %s", self._log_file.name)
+            self._log_file = None
+
+    def _get_event_log_path(self) -> str:
+        os.makedirs(self._log_dir, exist_ok=True)
+
+        path = f"{self._log_dir}/{datetime.now():%y_%m_%d-%H_%M_%S}"
+        candidate, index = f"{path}.jsonl", 0
+        while os.path.exists(candidate):
+            index += 1
+            candidate = f"{path}-{index}.jsonl"
+
+        return candidate
+
+    def _count(self, key: str, count: int = 1):
+        if self._metrics:
+            self._metrics.increment("event_log_status", key, count)
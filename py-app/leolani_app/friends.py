@@ -0,0 +1,201 @@
+import logging
+import threading
+from typing import Dict, Iterator, List, Mapping, Optional, Tuple
+
+from cltl.combot.infra.event import Event, EventBus
+from cltl.friends.api import FriendStore
+
+from leolani_app.metrics import MetricsRegistry
+from leolani_app.result_cache import normalize_text
+
+logger = logging.getLogger(__name__)
+
+
+_PERSON_TYPES = {"person", "friend"}
+_NAME_PREDICATES = {"label", "name", "be-called", "be-named", "is-called", "is-named", "call", "have-name"}
+
+
+def normalize_name(name: str) -> str:
+    return normalize_text(name).casefold()
+
+
+def _label(element) -> Optional[str]:
+    label = element.get("label") if isinstance(element, dict) else element
+
+    return str(label) if label else None
+
+
+def _is_person(entity) -> bool:
+    types = entity.get("type") if isinstance(entity, dict) else None
+    if isinstance(types, str):
+        types = [types]
+
+    return bool(types) and any(str(entity_type).casefold() in _PERSON_TYPES for entity_type in types)
+
+
+def person_names(response: dict) -> List[Tuple[Optional[str], str]]:
+    """
+    The names given to persons in a brain response, as pairs of the URI of the person and the name.
+
+    Only statements with a person as subject and a naming predicate, see :data:`_NAME_PREDICATES`,
+    change the names of friends. Other knowledge about persons, e.g. the author of a statement
+    or the person in a face mention, does not.
+    """
+    capsule = response.get("statement") if isinstance(response, dict) else None
+    if not isinstance(capsule, dict) or not _is_person(capsule.get("subject")):
+        return []
+
+    predicate = _label(capsule.get("predicate"))
+    name = _label(capsule.get("object"))
+    if not predicate or not name or predicate.casefold() not in _NAME_PREDICATES:
+        return []
+
+    return [(capsule["subject"].get("uri"), name)]
+
+
+class CachedFriendStore(FriendStore):
+    """
+    In-memory view on a friend store, shared by all components that look up friends.
+
+    Friends are indexed by their identifier, e.g. the face ID, and by their normalized names. The view
+    is loaded from the store on first use and updated when friends are added through it, or when
+    other components name a known friend in the brain, see :meth:`subscribe`. Names given to persons
+    that are not known as friend cause a reload on the next lookup.
+
+    Loads of the underlying store are counted in the ``friends_status`` metrics group.
+    """
+
+    def __init__(self, store: FriendStore, metrics: MetricsRegistry = None):
+        """
+        Parameters
+        ----------
+        store : FriendStore
+            The friend store that is cached.
+        metrics : MetricsRegistry
+            Optional registry to count cache loads.
+        """
+        self._store = store
+        self._metrics = metrics
+
+        self._friends: Optional[Dict[str, Tuple[str, List[str]]]] = None
+        self._by_name: Dict[str, List[str]] = {}
+        self._lock = threading.RLock()
+
+        self._event_bus = None
+        self._topic = None
+
+    def get_friends(self) -> Dict[str, Tuple[str, List[str]]]:
+        with self._lock:
+            return dict(self._index())
+
+    def get_friend(self, identifier: str) -> Optional[Tuple[str, List[str]]]:
+        with self._lock:
+            return self._index().get(identifier)
+
+    def find_friends(self, name: str) -> List[str]:
+        """
+        The identifiers of the friends with the given name.
+        """
+        with self._lock:
+            self._index()
+            return list(self._by_name.get(normalize_name(name), ()))
+
+    def add_friend(self, identifier: str, names: List[str] = None, *args, **kwargs):
+        result = self._store.add_friend(identifier, names, *args, **kwargs)
+
+        with self._lock:
+            if self._friends is not None:
+                uri, known_names = self._friends.get(identifier, (None, []))
+                added = [name for name in (names or []) if name not in known_names]
+                self._friends[identifier] = (uri, known_names + added)
+                for name in added:
+                    self._by_name.setdefault(normalize_name(name), []).append(identifier)
+
+        return result
+
+    def names(self) -> Mapping[str, str]:
+        """
+        Live view of the first name of each friend by identifier.
+        """
+        return _FriendNames(self)
+
+    def invalidate(self):
+        """
+        Reload the friends from the store on the next lookup.
+        """
+        with self._lock:
+            self._friends = None
+            self._by_name = {}
+
+    def subscribe(self, event_bus: EventBus, topic: str):
+        """
+        Update the cache when persons are named in the knowledge published on the topic, e.g. brain responses.
+        """
+        self._event_bus = event_bus
+        self._topic = topic
+        event_bus.subscribe(topic, self._on_knowledge)
+
+    def unsubscribe(self):
+        if self._event_bus:
+            self._event_bus.unsubscribe(self._topic, self._on_knowledge)
+            self._event_bus = None
+
+    def _on_knowledge(self, event: Event):
+        payload = event.payload if isinstance(event.payload, list) else [event.payload]
+        names = [person_name for response in payload for person_name in person_names(response)]
+        if not names:
+            return
+
+        with self._lock:
+            if self._friends is None:
+                return
+
+            by_uri = {uri: identifier for identifier, (uri, _) in self._friends.items() if uri}
+            for uri, name in names:
+                identifier = by_uri.get(uri)
+                if identifier is None:
+                    logger.debug("Invalidate friends after naming of unknown person %s in event %s", uri, event.id)
+                    self.invalidate()
+                    return
+
+                _, known_names = self._friends[identifier]
+                if name not in known_names:
+                    self._friends[identifier] = (uri, known_names + [name])
+                    self._by_name.setdefault(normalize_name(name), []).append(identifier)
+                    logger.debug("Added name %s to friend %s", name, identifier)
+
+    def _index(self) -> Dict[str, Tuple[str, List[str]]]:
+        if self._friends is None:
+            friends = dict(self._store.get_friends())
+            by_name = {}
+            for identifier, (_, names) in friends.items():
+                for name in names or []:
+                    by_name.setdefault(normalize_name(name), []).append(identifier)
+
+            self._friends, self._by_name = friends, by_name
+            if self._metrics:
+                self._metrics.increment("friends_status", "loaded")
+            logger.debug("Loaded %s friends", len(friends))
+
+        return self._friends
+
+    def __getattr__(self, name: str):
+        return getattr(self._store, name)
+
+
+class _FriendNames(Mapping):
+    def __init__(self, store: CachedFriendStore):
+        self._store = store
+
+    def __getitem__(self, identifier: str) -> str:
+        friend = self._store.get_friend(identifier)
+        if not friend or not friend[1]:
+            raise KeyError(identifier)
+
+        return friend[1][0]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter([identifier for identifier, (_, names) in self._store.get_friends().items() if names])
+
+    def __len__(self) -> int:
+        return sum(1 for _, names in self._store.get_friends().values() if names)
@@ -0,0 +1,129 @@
+"""
+Report the import time of the application based on the output of ``python -X importtime``.
+
+Run from the ``py-app/`` directory, e.g.::
+
+    python -m leolani_app.importtime --budget 3000
+
+The command exits with a non-zero status if the total import time exceeds the budget (in ms).
+"""
+import argparse
+import json
+import re
+import subprocess
+import sys
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Dict, List
+
+_LINE = re.compile(r"^import time:\s*(\d+)\s*\|\s*(\d+)\s*\|(\s*)(\S+)\s*$")
+
+
+@dataclass
+class ImportTime:
+    module: str
+    self_us: int
+    cumulative_us: int
+    depth: int
+
+
+def measure(module: str, python: str = sys.executable) -> List[ImportTime]:
+    """
+    Import the given module in a fresh interpreter and collect the import times.
+
+    Parameters
+    ----------
+    module : str
+        The module to import.
+    python : str
+        The Python interpreter to use.
+
+    Returns
+    -------
+    List[ImportTime]
+        The import time of each imported module in the order reported by the interpreter.
+    """
+    process = subprocess.run([python, "-X", "importtime", "-c", f"import {module}"],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if process.returncode != 0:
+        raise ValueError(f"Failed to import {module}:\n{process.stderr[-2000:]}")
+
+    return parse(process.stderr.splitlines())
+
+
+def parse(lines: List[str]) -> List[ImportTime]:
+    times = []
+    for line in lines:
+        match = _LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            # Nested imports are indented by two spaces per level, top-level imports by one
+            times.append(ImportTime(name, int(self_us), int(cumulative_us), (len(indent) - 1) // 2))
+
+    return times
+
+
+def by_package(times: List[ImportTime], module: str) -> Dict[str, int]:
+    """
+    Aggregate the import time in microseconds of the direct imports of the given module by package.
+
+    Imports done during interpreter startup are excluded. Namespace packages (e.g. ``cltl``)
+    are resolved to the first two name components.
+    """
+    end = max((idx for idx, import_time in enumerate(times)
+               if import_time.depth == 0 and import_time.module == module), default=None)
+    if end is None:
+        raise ValueError(f"No import time reported for {module}")
+
+    start = end
+    while start > 0 and times[start - 1].depth > 0:
+        start -= 1
+
+    packages = defaultdict(int)
+    for import_time in times[start:end]:
+        if import_time.depth == 1:
+            packages[_package(import_time.module)] += import_time.cumulative_us
+    packages[module] += times[end].self_us
+
+    return dict(packages)
+
+
+def _package(module: str) -> str:
+    components = module.split(".")
+    if components[0] in ("cltl", "cltl_service") and len(components) > 1:
+        return ".".join(components[:2])
+
+    return components[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time report")
+    parser.add_argument("--module", type=str, default="app", help="Module to import")
+    parser.add_argument("--budget", type=float, default=None, help="Import time budget in ms")
+    parser.add_argument("--top", type=int, default=20, help="Number of packages to report")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    times = measure(args.module)
+    packages = sorted(by_package(times, args.module).items(), key=lambda item: item[1], reverse=True)
+    total_ms = sum(cumulative for _, cumulative in packages) / 1000
+
+    if args.json:
+        print(json.dumps({"module": args.module,
+                          "total_ms": total_ms,
+                          "budget_ms": args.budget,
+                          "packages_ms": {package: cumulative / 1000 for package, cumulative in packages}},
+                         indent=2))
+    else:
+        print(f"Import time of {args.module}: {total_ms:.1f} ms" +
+              (f" (budget {args.budget:.1f} ms)" if args.budget else ""))
+        for package, cumulative in packages[:args.top]:
+            print(f"{cumulative / 1000:10.1f} ms  {package}")
+
+    if args.budget and total_ms > args.budget:
+        print(f"Import time {total_ms:.1f} ms exceeds the budget of {args.budget:.1f} ms", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,477 @@
+"""
+Host models in separate processes and access them through thin clients.
+
+Each hosted model runs in its own model host process with a limited number of intra-op
+threads, so that models don't compete for all cores of the application process and their
+memory is accounted for separately. Clients forward method calls of the model to its host
+over a :mod:`multiprocessing.connection`, the messages are pickled tuples:
+
+* ``("load", reference, args, kwargs, threads, batch_methods, batch_delay, batch_size)``
+  from the client, answered by ``("ready", None, pid)`` or ``("failed", None, error)``,
+* ``("call", request_id, method, args, kwargs)`` from the client, answered by
+  ``("result", request_id, value)`` or ``("error", request_id, error)``,
+* ``("stop",)`` from the client to terminate the host.
+
+Calls to a method configured as batch method are collected for up to the batch delay and
+passed to the batch method of the model as list of their first argument.
+
+The host process is started with ``python -m leolani_app.inference``.
+"""
+import argparse
+import itertools
+import logging
+import os
+import queue
+import secrets
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Any, Dict, Mapping, Optional
+
+from cltl.combot.infra.config import ConfigurationManager
+
+from leolani_app.metrics import MetricsRegistry
+from leolani_app.registry import load_reference
+
+logger = logging.getLogger(__name__)
+
+
+_AUTHKEY_ENV = "LEOLANI_INFERENCE_AUTHKEY"
+_THREAD_ENV = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS")
+
+
+class ModelHost:
+    """
+    Client side of a model host process.
+    """
+
+    def __init__(self, name: str, reference: str, args: tuple = (), kwargs: Mapping[str, Any] = None,
+                 threads: int = 1, batch_methods: Mapping[str, str] = None, batch_delay: float = 0.005,
+                 batch_size: int = 16, timeout: float = 60.0, metrics: MetricsRegistry = None):
+        """
+        Parameters
+        ----------
+        name : str
+            Name of the hosted model.
+        reference : str
+            Factory of the model in the form ``"module.path:attribute"``.
+        args : tuple
+            Positional arguments of the factory.
+        kwargs : Mapping[str, Any]
+            Keyword arguments of the factory.
+        threads : int
+            Number of intra-op threads of the model.
+        batch_methods : Mapping[str, str]
+            Methods of the model mapped to a method that computes a list of results for a list of inputs.
+        batch_delay : float
+            Maximum time in seconds calls to a batch method wait for other calls.
+        batch_size : int
+            Maximum number of calls in a batch.
+        timeout : float
+            Maximum time in seconds to wait for the result of a call.
+        metrics : MetricsRegistry
+            Optional registry to record the latency of calls.
+        """
+        self.name = name
+        self._reference = reference
+        self._args = tuple(args)
+        self._kwargs = dict(kwargs) if kwargs else {}
+        self._threads = threads
+        self._batch_methods = dict(batch_methods) if batch_methods else {}
+        self._batch_delay = batch_delay
+        self._batch_size = batch_size
+        self._timeout = timeout
+        self._metrics = metrics
+
+        self._process = None
+        self._connection: Optional[Connection] = None
+        self._pid = None
+        self._connected = False
+        self._send_lock = threading.Lock()
+        self._pending: Dict[int, Future] = {}
+        self._pending_lock = threading.Lock()
+        self._request_ids = itertools.count()
+        self._receiver = None
+
+    def start(self, startup_timeout: float = 300.0):
+        """
+        Start the host process and block until the model is loaded.
+
+        Raises
+        ------
+        RuntimeError
+            If the model could not be loaded.
+        """
+        authkey = secrets.token_bytes(32)
+        listener = Listener(authkey=authkey)
+        try:
+            env = dict(os.environ, **{key: str(self._threads) for key in _THREAD_ENV})
+            env[_AUTHKEY_ENV] = authkey.hex()
+            self._process = subprocess.Popen([sys.executable, "-m", "leolani_app.inference",
+                                              "--address", str(listener.address)], env=env)
+            self._connection = self._accept(listener, startup_timeout)
+        finally:
+            listener.close()
+
+        self._connection.send(("load", self._reference, self._args, self._kwargs, self._threads,
+                               self._batch_methods, self._batch_delay, self._batch_size))
+        if not self._connection.poll(startup_timeout):
+            self.stop()
+            raise RuntimeError(f"Timeout while loading model {self.name}")
+
+        status, _, value = self._connection.recv()
+        if status != "ready":
+            self.stop()
+            raise RuntimeError(f"Failed to load model {self.name}: {value}")
+
+        self._pid = value
+        self._connected = True
+        self._receiver = threading.Thread(target=self._receive, name=f"ModelHost-{self.name}", daemon=True)
+        self._receiver.start()
+        logger.info("Started model host %s (pid %s, %s threads)", self.name, self._pid, self._threads)
+
+    def _accept(self, listener: Listener, timeout: float) -> Connection:
+        accepted = []
+        acceptor = threading.Thread(target=lambda: accepted.append(listener.accept()), daemon=True)
+        acceptor.start()
+
+        deadline = time.monotonic() + timeout
+        while not accepted:
+            if self._process.poll() is not None:
+                raise RuntimeError(f"Model host {self.name} exited with {self._process.returncode}")
+            if time.monotonic() > deadline:
+                self._process.kill()
+                raise RuntimeError(f"Timeout while starting model host {self.name}")
+            acceptor.join(0.1)
+
+        return accepted[0]
+
+    def stop(self):
+        if self._connection is not None:
+            try:
+                with self._send_lock:
+                    self._connection.send(("stop",))
+            except (OSError, ValueError):
+                pass
+
+        if self._process is not None:
+            try:
+                self._process.wait(10)
+            except subprocess.TimeoutExpired:
+                logger.warning("Model host %s did not stop, kill it", self.name)
+                self._process.kill()
+            self._process = None
+
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        if self._receiver is not None:
+            self._receiver.join()
+            self._receiver = None
+
+    def call(self, method: str, *args, **kwargs) -> Any:
+        """
+        Invoke the method of the hosted model and block until its result is available.
+
+        Exceptions raised by the model are raised by this method.
+        """
+        start = time.perf_counter()
+        future = Future()
+        request_id = next(self._request_ids)
+        with self._pending_lock:
+            if not self._connected:
+                raise RuntimeError(f"Model host {self.name} is not running")
+            self._pending[request_id] = future
+
+        try:
+            with self._send_lock:
+                self._connection.send(("call", request_id, method, args, kwargs))
+            return future.result(self._timeout)
+        finally:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            if self._metrics:
+                self._metrics.record("inference", f"{self.name}.{method}", (time.perf_counter() - start) * 1000)
+
+    def status(self) -> dict:
+        return {
+            "pid": self._pid,
+            "alive": self._connected and self._process is not None and self._process.poll() is None,
+            "threads": self._threads,
+            "pending": len(self._pending),
+        }
+
+    def _receive(self):
+        try:
+            while True:
+                status, request_id, value = self._connection.recv()
+                with self._pending_lock:
+                    future = self._pending.get(request_id)
+                if future is None:
+                    continue
+                if status == "result":
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+        except (EOFError, OSError):
+            logger.info("Model host %s disconnected", self.name)
+        finally:
+            with self._pending_lock:
+                pending, self._pending = self._pending, {}
+                self._connected = False
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(RuntimeError(f"Model host {self.name} disconnected"))
+
+
+class ModelClient:
+    """
+    Thin client for a hosted model, method calls are forwarded to the model host.
+
+    Only methods of the model are supported, attributes can not be accessed through the client.
+    """
+
+    def __init__(self, host: ModelHost):
+        self._host = host
+
+    def __getattr__(self, method: str):
+        if method.startswith("__"):
+            raise AttributeError(method)
+
+        def remote_call(*args, **kwargs):
+            return self._host.call(method, *args, **kwargs)
+
+        return remote_call
+
+    def __repr__(self):
+        return f"ModelClient({self._host.name})"
+
+
+class InferenceServer:
+    """
+    Registry of the model hosts of the application.
+
+    The models to host are configured by name, components that use a model call :meth:`host`
+    if the model is in the server, or construct it in-process otherwise.
+    """
+
+    @classmethod
+    def from_config(cls, config_manager: ConfigurationManager, metrics: MetricsRegistry = None):
+        config = config_manager.get_config("cltl.inference")
+
+        models = config.get("models", multi=True) if "models" in config else []
+        models = {name.strip(): int(threads)
+                  for name, threads in (entry.split(":") for entry in models)}
+        batch_methods = config.get("batch_methods", multi=True) if "batch_methods" in config else []
+        model_batch_methods = {}
+        for entry in batch_methods:
+            method, batch_method = entry.split(":")
+            name, method = method.strip().split(".")
+            model_batch_methods.setdefault(name, {})[method] = batch_method.strip()
+
+        return cls(models, model_batch_methods,
+                   batch_delay=config.get_float("batch_delay") / 1000 if "batch_delay" in config else 0.005,
+                   batch_size=config.get_int("batch_size") if "batch_size" in config else 16,
+                   timeout=config.get_float("timeout") if "timeout" in config else 60.0,
+                   startup_timeout=config.get_float("startup_timeout") if "startup_timeout" in config else 300.0,
+                   metrics=metrics)
+
+    def __init__(self, models: Mapping[str, int] = None, batch_methods: Mapping[str, Mapping[str, str]] = None,
+                 batch_delay: float = 0.005, batch_size: int = 16, timeout: float = 60.0,
+                 startup_timeout: float = 300.0, metrics: MetricsRegistry = None):
+        """
+        Parameters
+        ----------
+        models : Mapping[str, int]
+            Names of the hosted models mapped to the number of intra-op threads of their host.
+        batch_methods : Mapping[str, Mapping[str, str]]
+            Batch methods by method name for the hosted models, see :class:`ModelHost`.
+        batch_delay : float
+            Maximum time in seconds calls to a batch method wait for other calls.
+        batch_size : int
+            Maximum number of calls in a batch.
+        timeout : float
+            Maximum time in seconds to wait for the result of a call.
+        startup_timeout : float
+            Maximum time in seconds to wait for a model to be loaded.
+        metrics : MetricsRegistry
+            Optional registry to record the latency of calls.
+        """
+        self._models = dict(models) if models else {}
+        self._batch_methods = dict(batch_methods) if batch_methods else {}
+        self._batch_delay = batch_delay
+        self._batch_size = batch_size
+        self._timeout = timeout
+        self._startup_timeout = startup_timeout
+        self._metrics = metrics
+
+        self._hosts: Dict[str, ModelHost] = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._models
+
+    def host(self, name: str, reference: str, *args, **kwargs) -> ModelClient:
+        """
+        Start a host process for the model and return a client for it.
+
+        Parameters
+        ----------
+        name : str
+            The configured name of the model.
+        reference : str
+            Factory of the model in the form ``"module.path:attribute"``.
+        args, kwargs
+            Arguments of the factory, they must be picklable.
+
+        Raises
+        ------
+        ValueError
+            If the model is not configured to be hosted.
+        RuntimeError
+            If the model could not be loaded.
+        """
+        if name not in self._models:
+            raise ValueError(f"Model {name} is not configured in the inference server")
+
+        with self._lock:
+            if name in self._hosts:
+                raise ValueError(f"Model {name} is already hosted")
+            host = ModelHost(name, reference, args, kwargs, self._models[name], self._batch_methods.get(name),
+                             self._batch_delay, self._batch_size, self._timeout, self._metrics)
+            self._hosts[name] = host
+
+        # Models are loaded concurrently during startup
+        host.start(self._startup_timeout)
+
+        return ModelClient(host)
+
+    def status(self) -> dict:
+        with self._lock:
+            hosts = dict(self._hosts)
+
+        return {name: host.status() for name, host in hosts.items()}
+
+    def stop(self):
+        with self._lock:
+            hosts, self._hosts = list(self._hosts.values()), {}
+
+        for host in hosts:
+            try:
+                host.stop()
+            except Exception:
+                logger.exception("Failed to stop model host %s", host.name)
+
+
+def _serve(address: str, authkey: bytes):
+    connection = Client(address, authkey=authkey)
+    _, reference, args, kwargs, threads, batch_methods, batch_delay, batch_size = connection.recv()
+
+    try:
+        try:
+            import torch
+            torch.set_num_threads(threads)
+        except ImportError:
+            pass
+
+        model = load_reference(reference)(*args, **kwargs)
+    except Exception as e:
+        logger.exception("Failed to load model %s", reference)
+        connection.send(("failed", None, repr(e)))
+        return
+
+    connection.send(("ready", None, os.getpid()))
+
+    requests = queue.Queue()
+
+    def receive():
+        try:
+            while True:
+                message = connection.recv()
+                if message[0] == "stop":
+                    break
+                requests.put(message)
+        except (EOFError, OSError):
+            pass
+        finally:
+            requests.put(None)
+
+    threading.Thread(target=receive, name="ModelHostReceiver", daemon=True).start()
+
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+
+        _, request_id, method, args, kwargs = request
+        if method not in batch_methods or len(args) != 1 or kwargs:
+            _respond(connection, request_id, lambda: getattr(model, method)(*args, **kwargs))
+            continue
+
+        batch, stopped = [request], False
+        deadline = time.monotonic() + batch_delay
+        while len(batch) < batch_size:
+            try:
+                request = requests.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if request is None:
+                stopped = True
+                break
+            if request[2] != method or len(request[3]) != 1 or request[4]:
+                _respond(connection, request[1], lambda: getattr(model, request[2])(*request[3], **request[4]))
+                continue
+            batch.append(request)
+
+        _respond_batch(connection, batch, getattr(model, batch_methods[method]))
+        if stopped:
+            break
+
+    connection.close()
+
+
+def _respond(connection: Connection, request_id: int, compute):
+    try:
+        connection.send(("result", request_id, compute()))
+    except Exception as e:
+        _send_error(connection, request_id, e)
+
+
+def _respond_batch(connection: Connection, batch, batch_method):
+    try:
+        results = batch_method([args[0] for _, _, _, args, _ in batch])
+    except Exception as e:
+        for _, request_id, _, _, _ in batch:
+            _send_error(connection, request_id, e)
+        return
+
+    for (_, request_id, _, _, _), result in zip(batch, results):
+        try:
+            connection.send(("result", request_id, result))
+        except Exception as e:
+            _send_error(connection, request_id, e)
+
+
+def _send_error(connection: Connection, request_id: int, error: Exception):
+    try:
+        connection.send(("error", request_id, error))
+    except Exception:
+        # The exception is not picklable
+        connection.send(("error", request_id, RuntimeError(repr(error))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Model host process of the inference server")
+    parser.add_argument("--address", type=str, required=True, help="Address of the inference server")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format=f"%(asctime)s %(levelname)s [model host {os.getpid()}] %(message)s")
+
+    _serve(args.address, bytes.fromhex(os.environ.pop(_AUTHKEY_ENV)))
+
+
+if __name__ == '__main__':
+    main()
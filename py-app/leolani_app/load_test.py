@@ -0,0 +1,260 @@
+"""
+Drive the chat UI of a running application with concurrent simulated users.
+
+Each user posts utterances to its own chat and waits for the response of the agent
+in that chat. The number of users is ramped up in stages, for each stage the throughput,
+response times and error rate are reported, as well as the stage after which adding
+users no longer increases the throughput significantly (the knee of the throughput curve).
+Run from the ``py-app/`` directory, e.g.::
+
+    python -m leolani_app.load_test --users 1 2 4 8 --duration 60 --profile chatonly --report load.json
+
+The chat UI routes can be adjusted with ``--post-path`` and ``--poll-path``, ``{chat_id}`` is
+replaced by the chat of the simulated user.
+"""
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from typing import List, Optional, Sequence
+
+import requests
+
+from leolani_app.metrics import LatencyStatistics
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_UTTERANCES = (
+    "Hello, my name is Sam",
+    "How are you today?",
+    "I like to play football",
+    "Where do you live?",
+    "My sister lives in Amsterdam",
+    "What do you know about me?",
+    "Do you like music?",
+    "Goodbye",
+)
+
+
+class _Stage:
+    def __init__(self, users: int):
+        self.users = users
+        self.latency = LatencyStatistics()
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.duration = 0.0
+        self._lock = threading.Lock()
+
+    def count(self, requests: int = 0, errors: int = 0, timeouts: int = 0):
+        with self._lock:
+            self.requests += requests
+            self.errors += errors
+            self.timeouts += timeouts
+
+    def to_dict(self) -> dict:
+        responses = self.latency.count
+
+        return {
+            "users": self.users,
+            "duration_s": self.duration,
+            "requests": self.requests,
+            "responses": responses,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "error_rate": (self.errors + self.timeouts) / self.requests if self.requests else 0.0,
+            "throughput_per_s": responses / self.duration if self.duration else 0.0,
+            "response_time": self.latency.to_dict(),
+        }
+
+
+class ChatLoadGenerator:
+    """
+    Simulated users that chat with the agent through the chat UI REST API.
+    """
+
+    def __init__(self, base_url: str, utterances: Sequence[str] = DEFAULT_UTTERANCES, sample: bool = False,
+                 post_path: str = "/chatui/chat/{chat_id}", poll_path: str = "/chatui/chat/{chat_id}",
+                 speaker: str = "load-test", timeout: float = 30.0, think_time: float = 1.0,
+                 poll_interval: float = 0.05):
+        """
+        Parameters
+        ----------
+        base_url : str
+            URL of the application, e.g. ``http://localhost:8000``.
+        utterances : Sequence[str]
+            Utterances of the simulated users.
+        sample : bool
+            Sample the utterances randomly instead of using them in order as a script.
+        post_path : str
+            Path to post an utterance to, ``{chat_id}`` is replaced by the chat of the user.
+        poll_path : str
+            Path to retrieve the utterances of a chat as JSON list.
+        speaker : str
+            Speaker name of the simulated users.
+        timeout : float
+            Maximum time in seconds to wait for the response of the agent.
+        think_time : float
+            Time in seconds a user waits after a response before the next utterance.
+        poll_interval : float
+            Interval in seconds at which the chat is polled for the response.
+        """
+        self._base_url = base_url.rstrip("/")
+        self._utterances = list(utterances)
+        self._sample = sample
+        self._post_path = post_path
+        self._poll_path = poll_path
+        self._speaker = speaker
+        self._timeout = timeout
+        self._think_time = think_time
+        self._poll_interval = poll_interval
+
+    def run(self, users: Sequence[int], duration: float, knee_gain: float = 0.1) -> dict:
+        """
+        Run the load test in stages with increasing number of concurrent users.
+
+        Parameters
+        ----------
+        users : Sequence[int]
+            Number of concurrent users in each stage.
+        duration : float
+            Duration of each stage in seconds.
+        knee_gain : float
+            Minimum relative throughput increase of a stage over the previous one, below which
+            the previous stage is reported as the knee of the throughput curve.
+        """
+        stages = []
+        run_id = uuid.uuid4().hex[:8]
+        for stage_idx, user_count in enumerate(users):
+            stage = self._run_stage(f"{run_id}-{stage_idx}", user_count, duration)
+            stages.append(stage.to_dict())
+            logger.info("Completed stage with %s users: %s", user_count, stages[-1])
+
+        return {
+            "base_url": self._base_url,
+            "stage_duration_s": duration,
+            "stages": stages,
+            "knee_users": _knee(stages, knee_gain),
+        }
+
+    def _run_stage(self, stage_id: str, users: int, duration: float) -> _Stage:
+        stage = _Stage(users)
+        stop = threading.Event()
+        threads = [threading.Thread(target=self._user, args=(f"{stage_id}-{idx}", stage, stop),
+                                    name=f"load-user-{idx}", daemon=True)
+                   for idx in range(users)]
+
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        stop.wait(duration)
+        stop.set()
+        for thread in threads:
+            thread.join(self._timeout)
+        stage.duration = time.monotonic() - start
+
+        return stage
+
+    def _user(self, chat_id: str, stage: _Stage, stop: threading.Event):
+        session = requests.Session()
+        post_url = self._base_url + self._post_path.format(chat_id=chat_id)
+        poll_url = self._base_url + self._poll_path.format(chat_id=chat_id)
+
+        turn = 0
+        while not stop.is_set():
+            text = random.choice(self._utterances) if self._sample else self._utterances[turn % len(self._utterances)]
+            turn += 1
+            try:
+                known = len(self._poll(session, poll_url))
+                start = time.monotonic()
+                session.post(post_url, params={"speaker": self._speaker}, data=text.encode("utf-8"),
+                             headers={'Content-type': 'text/plain'}, timeout=self._timeout).raise_for_status()
+                stage.count(requests=1)
+
+                if self._await_response(session, poll_url, known, start):
+                    stage.latency.add((time.monotonic() - start) * 1000)
+                else:
+                    stage.count(timeouts=1)
+            except (requests.RequestException, ValueError) as e:
+                logger.debug("Request of %s failed: %s", chat_id, e)
+                stage.count(errors=1)
+
+            stop.wait(self._think_time)
+
+        session.close()
+
+    def _await_response(self, session: requests.Session, poll_url: str, known: int, start: float) -> bool:
+        while time.monotonic() - start < self._timeout:
+            utterances = self._poll(session, poll_url)
+            # The first new utterance is the posted one, responses follow
+            if any(self._is_response(utterance) for utterance in utterances[known + 1:]):
+                return True
+            time.sleep(self._poll_interval)
+
+        return False
+
+    def _poll(self, session: requests.Session, poll_url: str) -> List:
+        response = session.get(poll_url, timeout=self._timeout)
+        response.raise_for_status()
+
+        return response.json()
+
+    def _is_response(self, utterance) -> bool:
+        speaker = utterance.get("speaker") if isinstance(utterance, dict) else None
+
+        return speaker != self._speaker
+
+
+def _knee(stages: List[dict], knee_gain: float) -> Optional[int]:
+    for previous, stage in zip(stages, stages[1:]):
+        if stage["throughput_per_s"] < previous["throughput_per_s"] * (1 + knee_gain):
+            return previous["users"]
+
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test through the chat UI")
+    parser.add_argument("--url", type=str, default="http://localhost:8000", help="URL of the application")
+    parser.add_argument("--users", type=int, nargs="+", default=[1, 2, 4, 8],
+                        help="Number of concurrent users per stage")
+    parser.add_argument("--duration", type=float, default=60, help="Duration of each stage in seconds")
+    parser.add_argument("--utterances", type=str, default=None, help="File with one utterance per line")
+    parser.add_argument("--sample", action="store_true", help="Sample utterances instead of using them in order")
+    parser.add_argument("--think-time", type=float, default=1.0, help="Seconds between response and next utterance")
+    parser.add_argument("--timeout", type=float, default=30.0, help="Seconds to wait for a response")
+    parser.add_argument("--post-path", type=str, default="/chatui/chat/{chat_id}", help="Path to post utterances")
+    parser.add_argument("--poll-path", type=str, default="/chatui/chat/{chat_id}", help="Path to poll the chat")
+    parser.add_argument("--knee-gain", type=float, default=0.1,
+                        help="Minimum relative throughput gain per stage to continue the curve")
+    parser.add_argument("--profile", type=str, default=None,
+                        help="Name of the configuration profile of the application, included in the report")
+    parser.add_argument("--report", type=str, default=None, help="File to write the JSON report to")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    utterances = DEFAULT_UTTERANCES
+    if args.utterances:
+        with open(args.utterances) as utterance_file:
+            utterances = [line.strip() for line in utterance_file if line.strip()]
+
+    generator = ChatLoadGenerator(args.url, utterances, sample=args.sample,
+                                  post_path=args.post_path, poll_path=args.poll_path,
+                                  timeout=args.timeout, think_time=args.think_time)
+    report = generator.run(args.users, args.duration, args.knee_gain)
+    report["profile"] = args.profile
+
+    content = json.dumps(report, indent=2)
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            report_file.write(content)
+    print(content)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,323 @@
+import functools
+import inspect
+import logging
+import threading
+import time
+import weakref
+from collections import defaultdict, deque
+from contextlib import nullcontext
+from typing import Callable, Dict, Iterable
+
+from cltl.combot.infra.di_container import singleton
+from cltl.combot.infra.event import EventBus, Event
+from cltl.combot.infra.topic_worker import TopicWorker
+from flask import Flask, jsonify
+
+logger = logging.getLogger(__name__)
+
+
+_SAMPLE_SIZE = 1024
+
+
+class LatencyStatistics:
+    """
+    Thread-safe summary of latency measurements in milliseconds.
+
+    Percentiles are computed from the most recent measurements.
+    """
+
+    def __init__(self, sample_size: int = _SAMPLE_SIZE):
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=sample_size)
+        self._count = 0
+        self._total = 0.0
+        self._max = 0.0
+
+    def add(self, value: float):
+        with self._lock:
+            self._samples.append(value)
+            self._count += 1
+            self._total += value
+            self._max = max(self._max, value)
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    def percentile(self, percentile: float) -> float:
+        with self._lock:
+            samples = sorted(self._samples)
+
+        return _percentile(samples, percentile)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            samples = sorted(self._samples)
+            count, total, max_value = self._count, self._total, self._max
+
+        return {
+            "count": count,
+            "mean_ms": total / count if count else 0.0,
+            "max_ms": max_value,
+            "p50_ms": _percentile(samples, 50),
+            "p95_ms": _percentile(samples, 95),
+            "p99_ms": _percentile(samples, 99),
+        }
+
+
+def _percentile(samples, percentile):
+    if not samples:
+        return 0.0
+
+    return samples[min(len(samples) - 1, int(len(samples) * percentile / 100))]
+
+
+class MetricsRegistry:
+    """
+    Central registry of timings and counters of the application, organized in groups.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timings = defaultdict(dict)
+        self._counters = defaultdict(lambda: defaultdict(int))
+
+    def timing(self, group: str, key: str) -> LatencyStatistics:
+        with self._lock:
+            if key not in self._timings[group]:
+                self._timings[group][key] = LatencyStatistics()
+
+            return self._timings[group][key]
+
+    def record(self, group: str, key: str, duration_ms: float):
+        self.timing(group, key).add(duration_ms)
+
+    def increment(self, group: str, key: str, count: int = 1):
+        with self._lock:
+            self._counters[group][key] += count
+
+    def counters(self, group: str) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counters[group])
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            timings = {group: dict(values) for group, values in self._timings.items()}
+            counters = {group: dict(values) for group, values in self._counters.items()}
+
+        return {
+            "timings": {group: {key: statistics.to_dict() for key, statistics in values.items()}
+                        for group, values in timings.items()},
+            "counters": counters,
+        }
+
+
+registry = MetricsRegistry()
+"""
+The metrics registry of the application.
+"""
+
+
+def _elapsed_ms(start: float) -> float:
+    return (time.perf_counter() - start) * 1000
+
+
+def timed_singleton(method):
+    """
+    Drop-in replacement for the :func:`singleton` decorator that records the
+    time it takes to construct the singleton instance.
+    """
+    @functools.wraps(method)
+    def construct(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            registry.record("construction", method.__qualname__, _elapsed_ms(start))
+
+    return singleton(construct)
+
+
+_lifecycle = threading.local()
+
+
+def instrument_lifecycle(container_class: type):
+    """
+    Record the duration of the `start` and `stop` methods defined by the given container class.
+
+    As containers call their super class in `start` and `stop`, the time spent in
+    nested calls is excluded from the recorded durations.
+    """
+    for name in ("start", "stop"):
+        if name in container_class.__dict__:
+            setattr(container_class, name, _timed_lifecycle(container_class.__dict__[name], name))
+
+
+def _timed_lifecycle(method: Callable, phase: str):
+    @functools.wraps(method)
+    def timed(self, *args, **kwargs):
+        if not hasattr(_lifecycle, "nested"):
+            _lifecycle.nested = []
+
+        _lifecycle.nested.append(0.0)
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            duration = _elapsed_ms(start)
+            nested = _lifecycle.nested.pop()
+            if _lifecycle.nested:
+                _lifecycle.nested[-1] += duration
+            registry.record(phase, method.__qualname__.split(".")[0], duration - nested)
+
+    return timed
+
+
+class InstrumentedEventBus(EventBus):
+    """
+    Event bus that delegates to another :class:`EventBus` and records per topic
+    publishing counts and per service event handling counts and latencies.
+
+    For subscribers that are :class:`TopicWorker` instances, also the time spent
+    in processing the event on the worker thread is recorded.
+
+    If a :class:`leolani_app.tracing.Tracer` is provided, published events are traced
+    through the handlers and workers that process them.
+    """
+
+    def __init__(self, event_bus: EventBus, metrics: MetricsRegistry = registry, tracer=None):
+        self._event_bus = event_bus
+        self._metrics = metrics
+        self._tracer = tracer
+        self._handlers = {}
+        self._lock = threading.Lock()
+        self._workers = weakref.WeakSet()
+
+    @property
+    def delegate(self) -> EventBus:
+        return self._event_bus
+
+    def publish(self, topic: str, event: Event) -> None:
+        self._metrics.increment("published", topic)
+        if self._tracer:
+            self._tracer.publish(topic, event)
+        self._event_bus.publish(topic, event)
+
+    def subscribe(self, topic, handler: Callable[[Event], None]) -> None:
+        name = subscriber_name(handler)
+        self._instrument_worker(handler)
+
+        timed_handler = self._timed_handler(handler, f"{name}:{topic}")
+        with self._lock:
+            self._handlers[(topic, handler)] = timed_handler
+        self._event_bus.subscribe(topic, timed_handler)
+
+    def unsubscribe(self, topic: str, handler: Callable[[Event], None] = None) -> None:
+        if handler is None:
+            with self._lock:
+                for key in [key for key in self._handlers if key[0] == topic]:
+                    del self._handlers[key]
+            self._event_bus.unsubscribe(topic, None)
+            return
+
+        with self._lock:
+            timed_handler = self._handlers.pop((topic, handler), handler)
+        self._event_bus.unsubscribe(topic, timed_handler)
+
+    @property
+    def topics(self) -> Iterable[str]:
+        return self._event_bus.topics
+
+    def _timed_handler(self, handler: Callable[[Event], None], key: str):
+        @functools.wraps(handler)
+        def timed(event: Event):
+            start = time.perf_counter()
+            try:
+                with self._activate(event):
+                    handler(event)
+            finally:
+                self._metrics.record("handler", key, _elapsed_ms(start))
+
+        return timed
+
+    def _instrument_worker(self, handler):
+        worker = getattr(handler, "__self__", None)
+        if not isinstance(worker, TopicWorker):
+            return
+
+        with self._lock:
+            if worker in self._workers:
+                return
+            self._workers.add(worker)
+
+        process = worker.process
+
+        def timed_process(event):
+            start = time.perf_counter()
+            try:
+                with self._activate(event):
+                    process(event)
+            finally:
+                if event is not None:
+                    self._metrics.record("processing", f"{worker.name}:{event.metadata.topic}", _elapsed_ms(start))
+
+        worker.process = timed_process
+
+    def _activate(self, event: Event):
+        return self._tracer.activate(event) if self._tracer else nullcontext()
+
+
+def subscriber_name(handler: Callable) -> str:
+    handler = inspect.unwrap(handler)
+    owner = getattr(handler, "__self__", None)
+    if owner is None:
+        return getattr(handler, "__qualname__", repr(handler))
+
+    # Topic workers are named after the service they belong to
+    name = getattr(owner, "name", None)
+
+    return name if isinstance(name, str) else owner.__class__.__name__
+
+
+class MetricsService:
+    """
+    Provides the content of a :class:`MetricsRegistry` as JSON through a REST API.
+
+    If a :class:`leolani_app.tracing.Tracer` is provided, the most recent completed
+    traces are available at ``/traces``.
+    """
+
+    def __init__(self, metrics: MetricsRegistry = registry, tracer=None):
+        self._metrics = metrics
+        self._tracer = tracer
+        self._app = None
+
+    @property
+    def app(self):
+        if self._app:
+            return self._app
+
+        self._app = Flask(__name__)
+
+        @self._app.route('/', methods=['GET'])
+        def metrics():
+            return jsonify(self._metrics.to_dict())
+
+        @self._app.route('/traces', methods=['GET'])
+        def traces():
+            if not self._tracer:
+                return jsonify({"error": "Tracing is not enabled"}), 404
+
+            return jsonify(self._tracer.recent())
+
+        @self._app.route('/<group>', methods=['GET'])
+        def metrics_group(group: str):
+            content = self._metrics.to_dict()
+            if group in content["timings"]:
+                return jsonify(content["timings"][group])
+            if group in content["counters"]:
+                return jsonify(content["counters"][group])
+
+            return jsonify({"error": f"Unknown metrics group {group}"}), 404
+
+        return self._app
@@ -0,0 +1,379 @@
+"""
+Optimized CPU inference backends for the MIDAS dialogue act classifier and the GO emotion detector.
+
+Supported backends are
+
+* ``eager``: the original PyTorch model,
+* ``int8``: PyTorch with dynamic int8 quantization of the linear layers,
+* ``onnx``: the model exported to ONNX and run with ONNX Runtime (requires ``onnxruntime``).
+
+The optimized model is created from the original one and stored in ``resources/`` with::
+
+    python -m leolani_app.optimized_models convert midas resources/midas-da-roberta/classifier.pt --backend int8
+
+and compared to the original model in latency and agreement of the predictions with::
+
+    python -m leolani_app.optimized_models benchmark midas resources/midas-da-roberta/classifier.pt \\
+        --backend int8 --optimized-model resources/midas-int8.pt
+
+Run the commands from the ``py-app/`` directory. The factories in this module are referenced in
+the application by name, torch and the models are only imported when they are used.
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from types import SimpleNamespace
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+
+from leolani_app.metrics import LatencyStatistics
+
+logger = logging.getLogger(__name__)
+
+
+BACKENDS = ("eager", "int8", "onnx")
+
+DEFAULT_UTTERANCES = (
+    "Hello, my name is Sam",
+    "How are you today?",
+    "I am fine, thank you",
+    "What is your favourite food?",
+    "I really love pizza",
+    "Do you like cats?",
+    "Yes, I do",
+    "No, I prefer dogs",
+    "Tell me something about yourself",
+    "That is so funny!",
+    "I am sorry to hear that",
+    "My sister lives in Amsterdam",
+    "Where do you live?",
+    "I hate waiting for the bus",
+    "This is really annoying",
+    "Wow, that is amazing",
+    "I am a bit scared of the dark",
+    "Can you help me with my homework?",
+    "Stop talking please",
+    "Goodbye, see you tomorrow",
+)
+
+
+def default_artifact(kind: str, backend: str) -> str:
+    return os.path.join("resources", f"{kind}-{backend}.{'onnx' if backend == 'onnx' else 'pt'}")
+
+
+def optimized_midas_tagger(model_path: str, backend: str = "eager", artifact: Optional[str] = None):
+    """
+    Create a :class:`MidasDialogTagger` that runs with the given backend.
+
+    Parameters
+    ----------
+    model_path : str
+        Path of the original model.
+    backend : str
+        One of :data:`BACKENDS`.
+    artifact : Optional[str]
+        Path of the optimized model created with the ``convert`` command. For the ``int8`` backend
+        the model is quantized on load if the artifact does not exist.
+    """
+    from cltl.dialogue_act_classification.midas_classifier import MidasDialogTagger
+
+    tagger = MidasDialogTagger(model_path)
+    tagger._model = _optimize(tagger._model, tagger._tokenizer, "midas", backend, artifact)
+
+    return tagger
+
+
+def optimized_go_emotion_detector(model: str, backend: str = "eager", artifact: Optional[str] = None):
+    """
+    Create a :class:`GoEmotionDetector` that runs with the given backend, see :func:`optimized_midas_tagger`.
+    """
+    from cltl.emotion_extraction.utterance_go_emotion_extractor import GoEmotionDetector
+
+    detector = GoEmotionDetector(model)
+    pipeline = detector.emotion_pipeline
+    optimized = _optimize(pipeline.model, pipeline.tokenizer, "go", backend, artifact)
+    if backend == "onnx":
+        detector.emotion_pipeline = _OnnxTextClassificationPipeline(optimized, pipeline.tokenizer, pipeline.model.config)
+    else:
+        pipeline.model = optimized
+
+    return detector
+
+
+def _optimize(model, tokenizer, kind: str, backend: str, artifact: Optional[str]):
+    if backend not in BACKENDS:
+        raise ValueError(f"Unsupported backend {backend}, expected one of {BACKENDS}")
+
+    artifact = artifact if artifact else default_artifact(kind, backend)
+    if backend == "eager":
+        return model
+
+    if backend == "int8":
+        quantized = quantize_dynamic(model)
+        if os.path.exists(artifact):
+            import torch
+            quantized.load_state_dict(torch.load(artifact, map_location="cpu"))
+            logger.info("Loaded quantized %s model from %s", kind, artifact)
+        else:
+            logger.warning("No quantized %s model at %s, quantized the model on load", kind, artifact)
+
+        return quantized
+
+    if not os.path.exists(artifact):
+        raise ValueError(f"No ONNX {kind} model at {artifact}, "
+                         f"create it with: python -m leolani_app.optimized_models convert {kind} ...")
+
+    logger.info("Loaded ONNX %s model from %s", kind, artifact)
+
+    return OnnxSequenceClassifier(artifact)
+
+
+def quantize_dynamic(model):
+    """
+    Quantize the weights of the linear layers of the model to int8.
+    """
+    import torch
+
+    model.eval()
+
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def export_onnx(model, tokenizer, path: str):
+    """
+    Export the sequence classification model to ONNX with dynamic batch and sequence dimensions.
+    """
+    import torch
+
+    sample = tokenizer(["Hello, how are you?"], padding=True, return_tensors="pt")
+    input_names = list(sample.keys())
+
+    class _Logits(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+        def forward(self, *inputs):
+            return self.model(**dict(zip(input_names, inputs))).logits
+
+    model.eval()
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["logits"] = {0: "batch"}
+    with torch.no_grad():
+        torch.onnx.export(_Logits(), tuple(sample[name] for name in input_names), path,
+                          input_names=input_names, output_names=["logits"], dynamic_axes=dynamic_axes,
+                          opset_version=14)
+
+
+class OnnxSequenceClassifier:
+    """
+    Stand-in for a transformers sequence classification model, that runs the exported model
+    with ONNX Runtime. Called with the tokenizer output, it returns an object with ``logits``.
+    """
+
+    def __init__(self, path: str, threads: int = None):
+        """
+        Parameters
+        ----------
+        path : str
+            Path of the ONNX model.
+        threads : int
+            Number of intra-op threads, by default ``OMP_NUM_THREADS`` if set, see :mod:`leolani_app.inference`.
+        """
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        threads = threads if threads else int(os.environ.get("OMP_NUM_THREADS", 0))
+        if threads:
+            options.intra_op_num_threads = threads
+        self._session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self._input_names = [session_input.name for session_input in self._session.get_inputs()]
+
+    def __call__(self, **inputs):
+        import torch
+
+        feed = {name: inputs[name].cpu().numpy() for name in self._input_names}
+        logits, = self._session.run(["logits"], feed)
+
+        return SimpleNamespace(logits=torch.from_numpy(logits))
+
+    def to(self, device):
+        return self
+
+    def eval(self):
+        return self
+
+
+class _OnnxTextClassificationPipeline:
+    """
+    Replacement for the transformers text classification pipeline with all scores, as used by
+    the :class:`GoEmotionDetector`.
+    """
+
+    def __init__(self, model: OnnxSequenceClassifier, tokenizer, config):
+        self.model = model
+        self.tokenizer = tokenizer
+        self._id2label = config.id2label
+        self._sigmoid = config.problem_type == "multi_label_classification" or config.num_labels == 1
+
+    def __call__(self, texts):
+        import torch
+
+        texts = [texts] if isinstance(texts, str) else list(texts)
+        logits = self.model(**self.tokenizer(texts, padding=True, truncation=True, return_tensors="pt")).logits
+        scores = torch.sigmoid(logits) if self._sigmoid else torch.softmax(logits, dim=-1)
+
+        return [[{"label": self._id2label[idx], "score": float(score)} for idx, score in enumerate(row)]
+                for row in scores.tolist()]
+
+
+# Model and tokenizer of the original implementation, and the prediction used to compare backends
+def _midas_components(tagger) -> Tuple[Any, Any]:
+    return tagger._model, tagger._tokenizer
+
+
+def _go_components(detector) -> Tuple[Any, Any]:
+    return detector.emotion_pipeline.model, detector.emotion_pipeline.tokenizer
+
+
+def _midas_predict(tagger, utterance: str) -> Tuple[str, float]:
+    act = tagger.extract_dialogue_act(utterance)[0]
+
+    return act.value, act.confidence
+
+
+def _go_predict(detector, utterance: str) -> Tuple[str, float]:
+    emotion = next(emotion for emotion in detector.extract_text_emotions(utterance)
+                   if getattr(emotion.type, "name", emotion.type) == "GO")
+
+    return emotion.value, emotion.confidence
+
+
+_MODELS = {
+    "midas": (optimized_midas_tagger, _midas_components, _midas_predict),
+    "go": (optimized_go_emotion_detector, _go_components, _go_predict),
+}
+
+
+def convert(kind: str, model_path: str, backend: str, output: Optional[str] = None) -> str:
+    """
+    Create the optimized model for the given backend from the original model.
+
+    Returns
+    -------
+    str
+        The path of the optimized model.
+    """
+    factory, components, _ = _MODELS[kind]
+    output = output if output else default_artifact(kind, backend)
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+
+    model, tokenizer = components(factory(model_path))
+    if backend == "int8":
+        import torch
+        torch.save(quantize_dynamic(model).state_dict(), output)
+    elif backend == "onnx":
+        export_onnx(model, tokenizer, output)
+    else:
+        raise ValueError(f"Nothing to convert for backend {backend}")
+
+    logger.info("Wrote %s %s model to %s", backend, kind, output)
+
+    return output
+
+
+def benchmark(kind: str, model_path: str, backend: str, artifact: Optional[str] = None,
+              utterances: Sequence[str] = DEFAULT_UTTERANCES, repeat: int = 3) -> dict:
+    """
+    Compare latency and predictions of the optimized model with the original model.
+
+    The agreement is the fraction of utterances for which the optimized model predicts the same
+    top label as the original model, the confidence difference is the mean absolute difference of
+    the confidence of the top labels.
+    """
+    factory, _, predict = _MODELS[kind]
+    reference_model = factory(model_path)
+    optimized_model = factory(model_path, backend, artifact)
+
+    reference, reference_latency = _run(reference_model, predict, utterances, repeat)
+    optimized, optimized_latency = _run(optimized_model, predict, utterances, repeat)
+
+    agreement = sum(expected[0] == actual[0] for expected, actual in zip(reference, optimized))
+    confidence_difference = sum(abs(expected[1] - actual[1]) for expected, actual in zip(reference, optimized))
+
+    return {
+        "model": kind,
+        "backend": backend,
+        "utterances": len(utterances),
+        "repeat": repeat,
+        "agreement": agreement / len(utterances) if utterances else 0.0,
+        "confidence_difference": confidence_difference / len(utterances) if utterances else 0.0,
+        "latency": {"eager": reference_latency.to_dict(), backend: optimized_latency.to_dict()},
+        "speedup_p50": (reference_latency.percentile(50) / optimized_latency.percentile(50)
+                        if optimized_latency.percentile(50) else None),
+        "disagreements": [{"utterance": utterance, "eager": expected[0], backend: actual[0]}
+                          for utterance, expected, actual in zip(utterances, reference, optimized)
+                          if expected[0] != actual[0]],
+    }
+
+
+def _run(model, predict: Callable[[Any, str], Tuple[str, float]], utterances: Sequence[str],
+         repeat: int) -> Tuple[List[Tuple[str, float]], LatencyStatistics]:
+    # Warm up, e.g. lazy initialization of the runtime
+    predict(model, utterances[0])
+
+    predictions, latency = [], LatencyStatistics()
+    for iteration in range(repeat):
+        for utterance in utterances:
+            start = time.perf_counter()
+            prediction = predict(model, utterance)
+            latency.add((time.perf_counter() - start) * 1000)
+            if iteration == 0:
+                predictions.append(prediction)
+
+    return predictions, latency
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Optimized CPU inference backends for the classifiers")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    convert_parser = subparsers.add_parser("convert", help="Create the optimized model")
+    benchmark_parser = subparsers.add_parser("benchmark", help="Compare the optimized with the original model")
+    for subparser in (convert_parser, benchmark_parser):
+        subparser.add_argument("model", choices=sorted(_MODELS), help="The model to optimize")
+        subparser.add_argument("model_path", type=str, help="Path or name of the original model")
+        subparser.add_argument("--backend", choices=BACKENDS[1:], default="int8", help="The optimized backend")
+
+    convert_parser.add_argument("--output", type=str, default=None,
+                                help="Path of the optimized model, by default in resources/")
+    benchmark_parser.add_argument("--optimized-model", type=str, default=None,
+                                  help="Path of the optimized model, by default in resources/")
+    benchmark_parser.add_argument("--utterances", type=str, default=None, help="File with one utterance per line")
+    benchmark_parser.add_argument("--repeat", type=int, default=3, help="Number of runs over the utterances")
+    benchmark_parser.add_argument("--report", type=str, default=None, help="File to write the JSON report to")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "convert":
+        print(convert(args.model, args.model_path, args.backend, args.output))
+        return
+
+    utterances = DEFAULT_UTTERANCES
+    if args.utterances:
+        with open(args.utterances) as utterance_file:
+            utterances = [line.strip() for line in utterance_file if line.strip()]
+
+    report = benchmark(args.model, args.model_path, args.backend, args.optimized_model, utterances, args.repeat)
+
+    content = json.dumps(report, indent=2)
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            report_file.write(content)
+    print(content)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import importlib
+import logging
+from typing import Any, Callable, Iterable, Mapping
+
+logger = logging.getLogger(__name__)
+
+
+class ImplementationRegistry:
+    """
+    Maps configured implementation names of a component to factories that are imported on first use.
+
+    Factories are registered as ``"module.path:attribute"`` references, so registering an
+    implementation does not import it. Only the implementations that are actually selected
+    in the configuration are imported, which keeps e.g. torch based components out of
+    deployments that don't use them.
+    """
+
+    def __init__(self, component: str, implementations: Mapping[str, str]):
+        """
+        Parameters
+        ----------
+        component : str
+            Name of the component, used in error messages.
+        implementations : Mapping[str, str]
+            Factory references in the form ``"module.path:attribute"`` by implementation name.
+        """
+        self._component = component
+        self._implementations = dict(implementations)
+        self._loaded = {}
+
+    @property
+    def names(self) -> Iterable[str]:
+        return tuple(self._implementations.keys())
+
+    def __contains__(self, implementation: str) -> bool:
+        return implementation in self._implementations
+
+    def reference(self, implementation: str) -> str:
+        """
+        Parameters
+        ----------
+        implementation : str
+            The configured implementation name.
+
+        Returns
+        -------
+        str
+            The factory reference in the form ``"module.path:attribute"``.
+
+        Raises
+        ------
+        ValueError
+            If the implementation is not registered.
+        """
+        if implementation not in self._implementations:
+            raise ValueError(f"Unsupported {self._component} implementation: {implementation}")
+
+        return self._implementations[implementation]
+
+    def get(self, implementation: str) -> Callable[..., Any]:
+        """
+        Import and return the factory for the given implementation.
+
+        Parameters
+        ----------
+        implementation : str
+            The configured implementation name.
+
+        Returns
+        -------
+        Callable[..., Any]
+            The factory, typically the implementation class.
+
+        Raises
+        ------
+        ValueError
+            If the implementation is not registered.
+        """
+        if implementation not in self._loaded:
+            self._loaded[implementation] = load_reference(self.reference(implementation))
+            logger.debug("Loaded %s implementation %s", self._component, implementation)
+
+        return self._loaded[implementation]
+
+
+def load_reference(reference: str) -> Any:
+    """
+    Import the object referenced as ``"module.path:attribute"``.
+    """
+    module_name, _, attribute = reference.partition(":")
+    if not module_name or not attribute:
+        raise ValueError(f"Invalid reference {reference}, expected 'module.path:attribute'")
+
+    obj = importlib.import_module(module_name)
+    for name in attribute.split("."):
+        obj = getattr(obj, name)
+
+    return obj
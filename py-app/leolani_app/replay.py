@@ -0,0 +1,240 @@
+"""
+Replay a recorded event log through the application services.
+
+The events recorded on the input topics (by default the chat input and camera images) are
+republished on the event bus, the services derive all other events from them as in the
+recorded session. Run from the ``py-app/`` directory, e.g.::
+
+    python -m leolani_app.replay storage/event_log --speed 2
+
+The application is started without backend, i.e. without robot, camera or microphone, and
+serves the same routes as the application, e.g. ``/emissor`` and ``/storage`` used by the
+services, on port 8000 for the duration of the replay. To replay with stand-in components, e.g. a different model or brain, pass an additional
+configuration file with ``--config`` that selects their implementations.
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import Any, Iterable, Iterator, List, Optional
+
+from cltl.combot.event.bdi import IntentionEvent, Intention
+from cltl.combot.infra.config.local import ADDITIONAL_CONFIGS
+from cltl.combot.infra.event import Event, EventBus
+from cltl.combot.infra.event.api import EventMetadata
+from cltl.combot.infra.time_util import timestamp_now
+
+from leolani_app.metrics import MetricsRegistry
+
+logger = logging.getLogger(__name__)
+
+
+_DECODER = json.JSONDecoder(object_hook=lambda d: SimpleNamespace(**d))
+
+
+@dataclass
+class RecordedEvent:
+    topic: str
+    timestamp: int
+    payload: Any
+
+
+def event_log_files(path: str) -> List[str]:
+    """
+    The event log files at the given path in chronological order.
+
+    Parameters
+    ----------
+    path : str
+        An event log file or a directory with event log files.
+    """
+    if os.path.isfile(path):
+        return [path]
+
+    return sorted(os.path.join(path, name) for name in os.listdir(path)
+                  if name.endswith((".json", ".jsonl")) and not name.endswith("-latency.json"))
+
+
+def read_event_log(path: str, topics: Iterable[str] = None) -> Iterator[RecordedEvent]:
+    """
+    Read the events from the event log files at the given path.
+
+    Both the JSON array written by the :class:`LogWriter` and the line-delimited JSON written
+    by the :class:`leolani_app.event_log.BatchedLogWriter` are supported. Payloads are
+    deserialized as :class:`SimpleNamespace`, as for events received from a remote event bus.
+
+    Parameters
+    ----------
+    path : str
+        An event log file or a directory with event log files.
+    topics : Iterable[str]
+        Optional topics to which the events are restricted.
+    """
+    topics = set(topics) if topics else None
+    for log_file in event_log_files(path):
+        logger.info("Reading event log %s", log_file)
+        with open(log_file) as log:
+            if log_file.endswith(".jsonl"):
+                recorded = (_DECODER.decode(line) for line in log if line.strip())
+            else:
+                recorded = _decode_array(log.read())
+
+            for event in recorded:
+                if topics is None or event.metadata.topic in topics:
+                    yield RecordedEvent(event.metadata.topic, event.metadata.timestamp, event.payload)
+
+
+def _decode_array(content: str) -> Iterator[Any]:
+    # The LogWriter separates events with a trailing comma, may not have closed the array
+    # and writes null when it is stopped
+    idx = 0
+    while idx < len(content):
+        if content[idx] in "[],\n\r\t ":
+            idx += 1
+            continue
+
+        obj, idx = _DECODER.raw_decode(content, idx)
+        if obj is not None:
+            yield obj
+
+
+class DisabledService:
+    """
+    Placeholder for services that are not run during replay, e.g. the backend.
+    """
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class EventReplayer:
+    """
+    Publish recorded events on the event bus.
+    """
+
+    def __init__(self, event_bus: EventBus, speed: Optional[float] = 1.0, metrics: MetricsRegistry = None):
+        """
+        Parameters
+        ----------
+        event_bus : EventBus
+            The event bus to publish the events on.
+        speed : Optional[float]
+            Factor by which the replay is faster than the recording, ``1.0`` preserves the original
+            timing. With ``None`` events are published as fast as possible.
+        metrics : MetricsRegistry
+            Optional registry to record the delay of published events with respect to their schedule.
+        """
+        self._event_bus = event_bus
+        self._speed = speed
+        self._metrics = metrics
+
+    def replay(self, events: Iterable[RecordedEvent]) -> dict:
+        """
+        Publish the events and block until all events are published.
+
+        Returns
+        -------
+        dict
+            Summary with the number of events by topic, the duration and throughput of the replay.
+        """
+        counts = {}
+        start = time.monotonic()
+        first_timestamp = None
+
+        for recorded in events:
+            if first_timestamp is None:
+                first_timestamp = recorded.timestamp
+
+            if self._speed:
+                scheduled = start + (recorded.timestamp - first_timestamp) / 1000 / self._speed
+                delay = scheduled - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                elif self._metrics:
+                    self._metrics.record("replay", "lag", -delay * 1000)
+
+            event = Event(str(uuid.uuid4()), recorded.payload, EventMetadata(timestamp_now()))
+            self._event_bus.publish(recorded.topic, event)
+            counts[recorded.topic] = counts.get(recorded.topic, 0) + 1
+
+        duration = time.monotonic() - start
+        total = sum(counts.values())
+
+        return {
+            "events": total,
+            "topics": counts,
+            "duration_s": duration,
+            "throughput_per_s": total / duration if duration else 0.0,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded event log")
+    parser.add_argument("path", type=str, help="Event log file or directory")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed relative to the recording")
+    parser.add_argument("--fast", action="store_true", help="Replay as fast as possible")
+    parser.add_argument("--topics", type=str, nargs="*", default=None,
+                        help="Topics to replay, defaults to the topics configured in cltl.replay")
+    parser.add_argument("--config", type=str, nargs="*", default=(),
+                        help="Additional configuration files, e.g. to select stand-in implementations")
+    parser.add_argument("--drain", type=float, default=None,
+                        help="Seconds to wait for the services after the last event is published")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    # The application is loaded only when replaying, to keep this module importable on its own
+    from app import ReplayContainer, web_app
+    from leolani_app import metrics
+    from werkzeug.serving import make_server
+
+    ReplayContainer.load_configuration(additional_config_files=list(ADDITIONAL_CONFIGS) + list(args.config))
+    with ReplayContainer() as application:
+        # The services access the EMISSOR data and the stored signals through the web application
+        server = make_server('0.0.0.0', 8000, web_app(application), threaded=True)
+        server_thread = threading.Thread(target=server.serve_forever, name="ReplayWebApp", daemon=True)
+        server_thread.start()
+
+        try:
+            config = application.config_manager.get_config("cltl.replay")
+            topics = args.topics if args.topics else config.get("topics", multi=True)
+            drain = args.drain if args.drain is not None else config.get_float("drain")
+
+            intention_topic = application.config_manager.get_config("cltl.bdi").get("topic_intention")
+            application.event_bus.publish(intention_topic, Event.for_payload(IntentionEvent([Intention("init", None)])))
+
+            replayer = EventReplayer(application.event_bus, None if args.fast else args.speed, metrics.registry)
+            report = replayer.replay(read_event_log(args.path, topics))
+
+            logger.info("Replayed %s events, waiting %s seconds for the services", report["events"], drain)
+            time.sleep(drain)
+
+            application.event_bus.publish(intention_topic,
+                                          Event.for_payload(IntentionEvent([Intention("terminate", None)])))
+        finally:
+            server.shutdown()
+            server_thread.join()
+
+    content = metrics.registry.to_dict()
+    report["latency"] = {group: content["timings"].get(group, {})
+                         for group in ("end_to_end", "hop", "processing", "replay")}
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"Replayed {report['events']} events in {report['duration_s']:.1f} s "
+              f"({report['throughput_per_s']:.1f} events/s)")
+        for group, timings in report["latency"].items():
+            for key, statistics in sorted(timings.items()):
+                print(f"{group:12} {key:60} n={statistics['count']:<6} p50={statistics['p50_ms']:8.1f} ms "
+                      f"p95={statistics['p95_ms']:8.1f} ms p99={statistics['p99_ms']:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
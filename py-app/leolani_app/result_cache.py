@@ -0,0 +1,265 @@
+import hashlib
+import logging
+import os
+import pickle
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Iterable, Optional
+
+from cltl.combot.infra.config import ConfigurationManager
+
+from leolani_app.metrics import MetricsRegistry
+
+logger = logging.getLogger(__name__)
+
+
+_WHITESPACE = re.compile(r"\s+")
+_MISSING = object()
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize unicode and whitespace of the text. The case is preserved, as it is relevant e.g. for
+    named entity recognition.
+    """
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFC", text)).strip()
+
+
+def content_key(*parts: Any) -> str:
+    """
+    Content hash of the given parts, e.g. the model identity and its input.
+
+    Strings, bytes and objects supporting ``tobytes()``, like numpy arrays, are hashed by content,
+    other objects by their ``repr``.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, bytes):
+            data = part
+        elif isinstance(part, str):
+            data = part.encode("utf-8")
+        elif hasattr(part, "tobytes"):
+            data = repr((getattr(part, "shape", None), str(getattr(part, "dtype", None)))).encode("utf-8") \
+                   + part.tobytes()
+        else:
+            data = repr(part).encode("utf-8")
+        digest.update(len(data).to_bytes(8, "big"))
+        digest.update(data)
+
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Thread-safe, size-bounded LRU cache of computation results by content key.
+
+    The cache can be persisted to a file, entries that can't be pickled are not persisted.
+    Hits, misses and evictions are counted in the ``result_cache`` metrics group.
+    """
+
+    @classmethod
+    def from_config(cls, config_manager: ConfigurationManager, metrics: MetricsRegistry = None):
+        config = config_manager.get_config("cltl.result_cache")
+
+        return cls(config.get_int("max_size") if "max_size" in config else 4096,
+                   config.get("path") if "path" in config and config.get("path") else None,
+                   metrics)
+
+    def __init__(self, max_size: int = 4096, path: Optional[str] = None, metrics: MetricsRegistry = None):
+        """
+        Parameters
+        ----------
+        max_size : int
+            Maximum number of cached results, the least recently used results are evicted first.
+        path : Optional[str]
+            File to load the cache from and to save it to, see :meth:`save`.
+        metrics : MetricsRegistry
+            Optional registry to count hits, misses and evictions.
+        """
+        self._max_size = max_size
+        self._path = path
+        self._metrics = metrics
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None, namespace: str = "default") -> Any:
+        with self._lock:
+            value = self._entries.get(key, _MISSING)
+            if value is not _MISSING:
+                self._entries.move_to_end(key)
+
+        self._count(namespace, "miss" if value is _MISSING else "hit")
+
+        return default if value is _MISSING else value
+
+    def put(self, key: Hashable, value: Any, namespace: str = "default"):
+        evicted = 0
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                evicted += 1
+
+        if evicted:
+            self._count(namespace, "evicted", evicted)
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any], namespace: str = "default") -> Any:
+        """
+        Return the cached result for the key, or compute and cache it.
+
+        Concurrent misses for the same key may compute the result more than once.
+        """
+        value = self.get(key, _MISSING, namespace)
+        if value is _MISSING:
+            value = compute()
+            self.put(key, value, namespace)
+
+        return value
+
+    def load(self, path: str):
+        try:
+            with open(path, "rb") as cache_file:
+                entries = pickle.load(cache_file)
+        except Exception:
+            logger.exception("Failed to load result cache from %s", path)
+            return
+
+        with self._lock:
+            for key, value in entries:
+                self._entries[key] = value
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+        logger.info("Loaded %s cached results from %s", len(entries), path)
+
+    def save(self, path: Optional[str] = None):
+        """
+        Save the cache to the given path, or to the path it was created with.
+        """
+        path = path if path else self._path
+        if not path:
+            return
+
+        with self._lock:
+            entries = list(self._entries.items())
+
+        picklable = []
+        for key, value in entries:
+            try:
+                pickle.dumps(value)
+                picklable.append((key, value))
+            except Exception:
+                logger.debug("Result for %s can't be persisted", key)
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", "wb") as cache_file:
+            pickle.dump(picklable, cache_file)
+        os.replace(path + ".tmp", path)
+
+        logger.info("Saved %s cached results to %s", len(picklable), path)
+
+    def _count(self, namespace: str, key: str, count: int = 1):
+        if self._metrics:
+            self._metrics.increment("result_cache", f"{namespace}.{key}", count)
+
+
+class CachedModel:
+    """
+    Proxy for a model that memoizes the results of methods with a single text argument in a
+    :class:`ResultCache`, keyed by the model identity and the normalized text.
+
+    Contextual models, whose result depends on previous inputs, can be cached by including the
+    previous inputs in the key. If the model keeps the context as state, ``on_hit`` must advance
+    the state of the model when a result is taken from the cache.
+
+    All other attributes are delegated to the model.
+    """
+
+    def __init__(self, model: Any, cache: ResultCache, model_id: str, methods: Iterable[str], context: int = 0,
+                 on_hit: Callable[[Any, str], None] = None, name: str = None):
+        """
+        Parameters
+        ----------
+        model : Any
+            The model.
+        cache : ResultCache
+            The cache, it can be shared by multiple models.
+        model_id : str
+            Identity of the model, e.g. implementation and model path. Results are only shared
+            between models with the same identity.
+        methods : Iterable[str]
+            Methods of the model to cache.
+        context : int
+            Number of previous inputs to include in the key.
+        on_hit : Callable[[Any, str], None]
+            Called with the model and the input when the result is taken from the cache.
+        name : str
+            Name of the model in the metrics, by default the model identity.
+        """
+        self._model = model
+        self._cache = cache
+        self._model_id = model_id
+        self._methods = set(methods)
+        self._context_size = context
+        self._on_hit = on_hit
+        self._name = name if name else model_id
+
+        self._context = []
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._model, name)
+        if name not in self._methods:
+            return attribute
+
+        def cached(text, *args, **kwargs):
+            if not isinstance(text, str) or args or kwargs:
+                return attribute(text, *args, **kwargs)
+
+            return self._cached(name, attribute, text)
+
+        return cached
+
+    def _cached(self, name: str, method: Callable[[str], Any], text: str) -> Any:
+        if not self._context_size:
+            key = content_key(self._model_id, name, normalize_text(text))
+            return self._cache.get_or_compute(key, lambda: method(text), self._name)
+
+        # Contextual calls are serialized to keep the context consistent with the state of the model
+        with self._lock:
+            key = content_key(self._model_id, name, *self._context, normalize_text(text))
+            value = self._cache.get(key, _MISSING, self._name)
+            if value is _MISSING:
+                value = method(text)
+                self._cache.put(key, value, self._name)
+            elif self._on_hit:
+                self._on_hit(self._model, text)
+
+            if text:
+                self._context = (self._context + [normalize_text(text)])[-self._context_size:]
+
+        return value
+
+    def __repr__(self):
+        return f"CachedModel({self._model!r})"
+
+
+def advance_midas_dialog(tagger: Any, utterance: str):
+    """
+    Add the utterance to the dialog of a :class:`MidasDialogTagger`, as done when it classifies the utterance.
+
+    Empty utterances are not added to the dialog by the tagger.
+    """
+    if utterance:
+        tagger._dialog.append(utterance)
+
@@ -0,0 +1,130 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Callable, Dict, Iterable, Mapping
+
+logger = logging.getLogger(__name__)
+
+
+class StartupScheduler:
+    """
+    Run startup tasks concurrently while respecting their dependencies.
+
+    Each task is identified by name and is only submitted to the thread pool
+    once all tasks it depends on completed successfully. Tasks without
+    dependencies between them run in parallel, such that the total startup
+    time is bounded by the longest chain of dependent tasks instead of the sum
+    of all tasks.
+
+    If a task fails, no further tasks are scheduled, already running tasks are
+    awaited and the first error is raised.
+    """
+
+    def __init__(self, tasks: Mapping[str, Callable[[], Any]], dependencies: Mapping[str, Iterable[str]] = None,
+                 max_workers: int = 4):
+        """
+        Parameters
+        ----------
+        tasks : Mapping[str, Callable[[], Any]]
+            The tasks to run by name.
+        dependencies : Mapping[str, Iterable[str]]
+            For each task name the names of the tasks that must complete before it is started.
+        max_workers : int
+            Number of threads used to run the tasks. With a value smaller than two
+            the tasks are run sequentially in dependency order on the calling thread.
+        """
+        self._tasks = dict(tasks)
+        self._dependencies = {name: set(dependencies.get(name, ())) if dependencies else set()
+                              for name in self._tasks}
+        self._max_workers = max_workers
+
+        self._validate()
+
+    def _validate(self):
+        for name, required in self._dependencies.items():
+            unknown = required - self._tasks.keys()
+            if unknown:
+                raise ValueError(f"Unknown dependencies {unknown} for startup task {name}")
+
+        # Raises on cycles
+        self.order()
+
+    def order(self) -> Iterable[str]:
+        """
+        Returns
+        -------
+        Iterable[str]
+            The task names in an order that respects all dependencies.
+        """
+        ordered = []
+        done = set()
+        remaining = dict(self._dependencies)
+        while remaining:
+            ready = [name for name, required in remaining.items() if required <= done]
+            if not ready:
+                raise ValueError(f"Cyclic dependencies between startup tasks {list(remaining.keys())}")
+            for name in ready:
+                ordered.append(name)
+                done.add(name)
+                del remaining[name]
+
+        return ordered
+
+    def run(self) -> Dict[str, float]:
+        """
+        Run all tasks.
+
+        Returns
+        -------
+        Dict[str, float]
+            The duration of each task in seconds.
+        """
+        start = time.perf_counter()
+        if self._max_workers < 2:
+            durations = {name: self._run_task(name) for name in self.order()}
+        else:
+            durations = self._run_parallel()
+
+        logger.info("Completed %s startup tasks in %.2f s (sum of task durations: %.2f s)",
+                    len(durations), time.perf_counter() - start, sum(durations.values()))
+
+        return durations
+
+    def _run_parallel(self) -> Dict[str, float]:
+        durations = {}
+        pending = dict(self._dependencies)
+        running = {}
+        error = None
+
+        with ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="startup") as executor:
+            while pending or running:
+                if not error:
+                    ready = [name for name, required in pending.items() if required <= durations.keys()]
+                    for name in ready:
+                        del pending[name]
+                        running[executor.submit(self._run_task, name)] = name
+
+                if not running:
+                    break
+
+                completed, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in completed:
+                    name = running.pop(future)
+                    try:
+                        durations[name] = future.result()
+                    except Exception as e:
+                        logger.error("Startup task %s failed", name)
+                        error = error if error else e
+
+        if error:
+            raise error
+
+        return durations
+
+    def _run_task(self, name: str) -> float:
+        start = time.perf_counter()
+        self._tasks[name]()
+        duration = time.perf_counter() - start
+        logger.debug("Completed startup task %s in %.2f s", name, duration)
+
+        return duration
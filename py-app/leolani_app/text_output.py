@@ -0,0 +1,156 @@
+import logging
+import random
+import threading
+import time
+from contextlib import nullcontext
+from queue import Queue, Full, Empty
+from typing import Optional
+
+import cltl.leolani.gestures as gestures
+import requests
+from cltl.backend.api.microphone import AUDIO_RESOURCE_NAME
+from cltl.backend.spi.text import TextOutput
+from cltl.combot.infra.config import ConfigurationManager
+from cltl.combot.infra.resource.api import ResourceManager
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from leolani_app.metrics import MetricsRegistry
+
+logger = logging.getLogger(__name__)
+
+
+_STOP = object()
+
+
+class RemoteTextOutput(TextOutput):
+    """
+    Sends text to a remote text-to-speech endpoint, e.g. on the robot.
+
+    Text is queued and sent by a background thread over a pooled keep-alive HTTP
+    session with timeouts and retries, so :meth:`consume` does not block the
+    caller while the request is in flight. If the remote end cannot keep up, the
+    oldest queued text is dropped in favour of the latest.
+
+    As the text is spoken after :meth:`consume` returned, the sender thread holds the write lock
+    on the audio resource while a request is in flight, if a resource manager is given, to mute
+    the microphone while the robot speaks.
+
+    The sender thread is started when entering and stopped when exiting the context,
+    which the backend does on start and stop of the text-to-speech.
+    """
+
+    @classmethod
+    def from_config(cls, config_manager: ConfigurationManager, metrics: MetricsRegistry = None,
+                    resource_manager: ResourceManager = None):
+        config = config_manager.get_config("cltl.backend.text_output")
+
+        return cls(config.get("remote_url"),
+                   queue_size=config.get_int("queue_size") if "queue_size" in config else 16,
+                   timeout=config.get_float("timeout") if "timeout" in config else 5.0,
+                   retries=config.get_int("retries") if "retries" in config else 2,
+                   metrics=metrics, resource_manager=resource_manager)
+
+    def __init__(self, remote_url: str, queue_size: int = 16, timeout: float = 5.0, retries: int = 2,
+                 metrics: MetricsRegistry = None, resource_manager: ResourceManager = None):
+        """
+        Parameters
+        ----------
+        remote_url : str
+            Base URL of the remote endpoint, text is posted to ``<remote_url>/text``.
+        queue_size : int
+            Maximum number of texts waiting to be sent.
+        timeout : float
+            Connect and read timeout of a request in seconds.
+        retries : int
+            Number of retries on connection errors and server unavailability. Requests are not retried
+            after they were sent, e.g. on read timeouts, as the text might be spoken twice.
+        metrics : MetricsRegistry
+            Optional registry to record send latencies and the number of sent, failed and dropped texts.
+        resource_manager : ResourceManager
+            Optional resource manager to hold the audio resource while text is sent to the remote end.
+        """
+        self._remote_url = remote_url
+        self._timeout = timeout
+        self._metrics = metrics
+        self._resource_manager = resource_manager
+        self._queue = Queue(maxsize=queue_size)
+
+        retry = Retry(total=retries, read=0, backoff_factor=0.2, status_forcelist=(503,),
+                      allowed_methods=frozenset({"POST"}))
+        self._session = requests.Session()
+        self._session.headers.update({'Content-type': 'text/plain'})
+        self._session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=retry))
+        self._session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=retry))
+
+        self._thread = None
+
+    def __enter__(self):
+        if not self._thread:
+            self._thread = threading.Thread(target=self._run, name="RemoteTextOutput", daemon=True)
+            self._thread.start()
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._thread:
+            self._put(_STOP)
+            self._thread.join(timeout=self._timeout)
+            self._thread = None
+        self._session.close()
+
+    def consume(self, text: str, language: Optional[str] = None):
+        if not self._thread:
+            logger.warning("Text output is not started, dropped: %s", text)
+            self._count("dropped")
+            return
+
+        animation = f"{random.choice(gestures.options)}"
+        logger.info("Send text to %s: %s (%s)", self._remote_url, text, animation)
+
+        # The remote end cannot handle quotes in the text
+        self._put(f"\\^startTag({animation}){text}^stopTag({animation})")
+
+    def _put(self, item):
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return
+            except Full:
+                pass
+
+            try:
+                dropped = self._queue.get_nowait()
+                logger.warning("Text output queue is full, dropped: %s", dropped)
+                self._count("dropped")
+            except Empty:
+                pass
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+
+            start = time.perf_counter()
+            try:
+                with self._audio_lock():
+                    response = self._session.post(f"{self._remote_url}/text", data=item, timeout=self._timeout)
+                response.raise_for_status()
+                self._count("sent")
+            except requests.RequestException as e:
+                logger.warning("Failed to send text to %s: %s", self._remote_url, e)
+                self._count("failed")
+            finally:
+                if self._metrics:
+                    self._metrics.record("text_output", "send", (time.perf_counter() - start) * 1000)
+
+    def _audio_lock(self):
+        if not self._resource_manager:
+            return nullcontext()
+
+        return self._resource_manager.get_write_lock(AUDIO_RESOURCE_NAME)
+
+    def _count(self, key: str):
+        if self._metrics:
+            self._metrics.increment("text_output_status", key)
@@ -0,0 +1,207 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from cltl.combot.infra.config import ConfigurationManager
+from cltl.combot.infra.event import Event
+
+from leolani_app.metrics import MetricsRegistry
+
+logger = logging.getLogger(__name__)
+
+
+class _Trace:
+    def __init__(self, trace_id: str, origin_topic: str, start: float):
+        self.trace_id = trace_id
+        self.origin_topic = origin_topic
+        self.start = start
+        self.hops: List[Tuple[str, float]] = []
+        self.event_ids: List[str] = []
+        self.completed = False
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "origin": self.origin_topic,
+            "start": self.start,
+            "hops": [{"topic": topic, "offset_ms": offset} for topic, offset in self.hops],
+        }
+
+
+class _Span:
+    def __init__(self, trace: _Trace, topic: str, published: float):
+        self.trace = trace
+        self.topic = topic
+        self.published = published
+
+
+_context = threading.local()
+
+
+def current_span() -> Optional[_Span]:
+    """The span of the event handled on the current thread, if any."""
+    return getattr(_context, "span", None)
+
+
+@contextmanager
+def active_span(span: Optional[_Span]):
+    """Context in which events published on the current thread belong to the trace of the given span."""
+    previous = current_span()
+    _context.span = span
+    try:
+        yield span
+    finally:
+        _context.span = previous
+
+
+def propagate(function: Callable) -> Callable:
+    """
+    Bind the function to the span of the current thread, to run it on another thread, e.g. in an executor.
+    """
+    span = current_span()
+
+    @functools.wraps(function)
+    def traced(*args, **kwargs):
+        with active_span(span):
+            return function(*args, **kwargs)
+
+    return traced
+
+
+class Tracer:
+    """
+    Trace events across the services through which they cause further events.
+
+    Events published while no other event is handled on the current thread start a
+    new trace. Events published while handling an event, i.e. within :meth:`activate`,
+    belong to the trace of the handled event. Work handed over to other threads is traced
+    if it is wrapped with :func:`propagate`. The trace ID is set as ``trace_id`` attribute
+    on the events delivered to the subscribers, and with that also included in the event log.
+
+    For each hop between two topics, the time between publishing the event and publishing
+    the event caused by it is recorded in the ``hop`` group of the metrics registry, and for
+    traces that reach one of the terminal topics the time until they first reach it in the
+    ``end_to_end`` group.
+    """
+
+    @classmethod
+    def from_config(cls, config_manager: ConfigurationManager, metrics: MetricsRegistry):
+        config = config_manager.get_config("cltl.event.tracing")
+
+        return cls(metrics, config.get("terminal_topics", multi=True), config.get_int("max_traces"))
+
+    def __init__(self, metrics: MetricsRegistry, terminal_topics: Iterable[str], max_traces: int = 1024):
+        """
+        Parameters
+        ----------
+        metrics : MetricsRegistry
+            The registry to record the latencies.
+        terminal_topics : Iterable[str]
+            Topics at which a trace is considered complete, e.g. the text output.
+        max_traces : int
+            Maximum number of traces kept in memory, the least recently active traces are
+            discarded, as well as the number of completed traces available through :meth:`recent`.
+        """
+        self._metrics = metrics
+        self._terminal_topics = set(terminal_topics)
+        self._max_traces = max_traces
+
+        self._lock = threading.Lock()
+        self._traces = OrderedDict()
+        self._spans = {}
+        self._completed = deque(maxlen=max_traces)
+
+    def publish(self, topic: str, event: Event):
+        """
+        Register an event published on the given topic.
+        """
+        now = time.time()
+        parent = self.current()
+
+        if parent:
+            trace = parent.trace
+            self._metrics.record("hop", f"{parent.topic}->{topic}", (now - parent.published) * 1000)
+        else:
+            trace = _Trace(event.id, topic, now)
+
+        with self._lock:
+            trace.hops.append((topic, (now - trace.start) * 1000))
+            trace.event_ids.append(event.id)
+            self._spans[event.id] = _Span(trace, topic, now)
+
+            self._traces[trace.trace_id] = trace
+            self._traces.move_to_end(trace.trace_id)
+            while len(self._traces) > self._max_traces:
+                _, discarded = self._traces.popitem(last=False)
+                for event_id in discarded.event_ids:
+                    self._spans.pop(event_id, None)
+
+            completed = topic in self._terminal_topics and parent and not trace.completed
+            if completed:
+                trace.completed = True
+                self._completed.append(trace)
+
+        if completed:
+            self._metrics.record("end_to_end", f"{trace.origin_topic}->{topic}", (now - trace.start) * 1000)
+
+    @contextmanager
+    def activate(self, event: Optional[Event]):
+        """
+        Context in which the given event is handled on the current thread.
+        """
+        with self._lock:
+            span = self._spans.get(event.id) if event is not None else None
+
+        if span:
+            event.trace_id = span.trace.trace_id
+
+        with active_span(span):
+            yield span
+
+    def current(self) -> Optional[_Span]:
+        return current_span()
+
+    def trace_id(self, event: Event) -> Optional[str]:
+        with self._lock:
+            span = self._spans.get(event.id)
+
+        return span.trace.trace_id if span else None
+
+    def recent(self) -> List[dict]:
+        """
+        Returns
+        -------
+        List[dict]
+            The most recent traces that reached a terminal topic, with the offset of each hop.
+        """
+        with self._lock:
+            return [trace.to_dict() for trace in self._completed]
+
+    def to_dict(self) -> dict:
+        content = self._metrics.to_dict()["timings"]
+
+        return {
+            "hop": content.get("hop", {}),
+            "end_to_end": content.get("end_to_end", {}),
+            "traces": self.recent(),
+        }
+
+    def dump(self, log_dir: str) -> str:
+        """
+        Write the latency statistics and recent traces to a JSON file in the given directory.
+        """
+        os.makedirs(log_dir, exist_ok=True)
+        path = os.path.join(log_dir, f"{datetime.now():%y_%m_%d-%H_%M_%S}-latency.json")
+        with open(path, 'w') as trace_file:
+            json.dump(self.to_dict(), trace_file, indent=2)
+
+        logger.info("Wrote latency traces to %s", path)
+
+        return path
@@ -0,0 +1,453 @@
+import copy
+import functools
+import json
+import logging
+import threading
+import time
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from queue import Queue
+from types import SimpleNamespace
+from typing import Iterable, List, Mapping, Optional, Sequence
+
+from cltl.combot.infra.event import Event
+from cltl.question_extraction.analyzer import Analyzer
+from cltl.triple_extraction.api import Chat
+from cltl_service.triple_extraction.service import TripleExtractionService
+
+from leolani_app.batching import MicroBatcher
+from leolani_app.metrics import MetricsRegistry
+from leolani_app.tracing import propagate
+
+logger = logging.getLogger(__name__)
+
+
+class _AnalyzerGroup:
+    def __init__(self, analyzers: Sequence[Analyzer], deferred: bool = False, replicas: int = 1):
+        self.analyzers = list(analyzers)
+        self.deferred = deferred
+        self.name = "+".join(analyzer.__class__.__name__ for analyzer in self.analyzers)
+
+        # Analyzers keep state of the utterance they analyze, each worker uses its own replica.
+        # Replicas are shallow copies that share the model of the original analyzers.
+        self._replicas = Queue()
+        self._replicas.put(self.analyzers)
+        for _ in range(replicas - 1):
+            self._replicas.put([copy.copy(analyzer) for analyzer in self.analyzers])
+        self.executor = ThreadPoolExecutor(max_workers=replicas, thread_name_prefix=self.name)
+
+        self._workers = replicas
+        self._busy = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, queue: bool = False) -> bool:
+        """
+        Reserve a worker for an analysis, if ``queue`` is ``False`` only if a worker is idle.
+        """
+        with self._lock:
+            if not queue and self._busy >= self._workers:
+                return False
+            self._busy += 1
+
+        return True
+
+    def release(self):
+        with self._lock:
+            self._busy -= 1
+
+    def analyze_in_context(self, chat: Chat):
+        analyzers = self._replicas.get()
+        try:
+            for analyzer in analyzers:
+                analyzer.analyze_in_context(chat)
+        finally:
+            self._replicas.put(analyzers)
+
+
+class ConcurrentChatAnalyzer(Analyzer):
+    """
+    Drop-in replacement for the :class:`ChatAnalyzer` that runs groups of analyzers concurrently.
+
+    Analyzers within a group run in order, groups run concurrently. Analyzers that share
+    state, e.g. the grammar-based analyzers that share the CFG parser, must be placed in
+    the same group. Each group analyzes a working copy of the last utterance, the triples
+    found by all groups are merged into the last utterance of the chat, with duplicates removed.
+
+    Each group has its own timeout budget. If a group does not complete within the timeout,
+    the triples it found so far are used and the results of the other groups are not affected.
+    A group that is still busy with previous utterances when the next utterance arrives, e.g.
+    after a timeout, skips that utterance instead of delaying it.
+
+    Groups that contain a deferred analyzer are not awaited in :meth:`analyze_in_context`,
+    their triples are provided through :meth:`deferred_triples` when they complete.
+    """
+
+    def __init__(self, groups: Sequence[Sequence[Analyzer]], timeout: float = 0.0, deferred: Iterable[str] = (),
+                 replicas: Mapping[str, int] = None, metrics: MetricsRegistry = None):
+        """
+        Parameters
+        ----------
+        groups : Sequence[Sequence[Analyzer]]
+            Groups of analyzers that run concurrently.
+        timeout : float
+            Maximum time in seconds to wait for each group, ``0`` to wait until all groups complete.
+        deferred : Iterable[str]
+            Class names of analyzers whose group is not awaited, see :meth:`deferred_triples`.
+        replicas : Mapping[str, int]
+            Number of concurrent workers for groups containing the analyzer with the given class name,
+            the default is a single worker. This allows to analyze multiple utterances at the same time
+            with deferred analyzers.
+        metrics : MetricsRegistry
+            Optional registry to record the analysis time of each group.
+        """
+        deferred = set(deferred)
+        replicas = dict(replicas) if replicas else {}
+        self._groups = [_AnalyzerGroup(group,
+                                       any(analyzer.__class__.__name__ in deferred for analyzer in group),
+                                       max(replicas.get(analyzer.__class__.__name__, 1) for analyzer in group))
+                        for group in groups if group]
+        self._timeout = timeout
+        self._metrics = metrics
+        self._chat = None
+        self._deferred_results = weakref.WeakKeyDictionary()
+
+    def analyze_in_context(self, chat: Chat):
+        self._chat = chat
+        utterance = chat.last_utterance
+
+        start = time.perf_counter()
+        runs = []
+        for group in self._groups:
+            # Deferred groups are not awaited and their timeout starts when they start the analysis
+            if not group.reserve(queue=group.deferred):
+                logger.warning("Skipped analysis by %s, it is still busy with a previous utterance: %s",
+                               group.name, utterance.transcript)
+                if self._metrics:
+                    self._metrics.increment("triple_extraction_skipped", group.name)
+                continue
+
+            working_chat = _working_copy(chat)
+            runs.append((group, working_chat, group.executor.submit(propagate(self._analyze), group, working_chat)))
+
+        awaited = [run for run in runs if not run[0].deferred]
+        done, _ = wait([future for _, _, future in awaited], timeout=self._timeout if self._timeout else None)
+        for group, working_chat, future in awaited:
+            if future not in done:
+                logger.warning("Analysis by %s timed out after %s seconds for utterance: %s",
+                               group.name, self._timeout, utterance.transcript)
+                if self._metrics:
+                    self._metrics.increment("triple_extraction_timeout", group.name)
+            elif future.exception():
+                logger.error("Analysis by %s failed for utterance: %s", group.name, utterance.transcript,
+                             exc_info=future.exception())
+
+            # Use the triples found so far also if the group did not complete
+            merge_triples(utterance, list(working_chat.last_utterance.triples))
+
+        deferred = [run for run in runs if run[0].deferred]
+        if deferred:
+            self._deferred_results[utterance] = self._collect(utterance, deferred)
+
+        logger.debug("Analyzed utterance in %s ms", (time.perf_counter() - start) * 1000)
+
+    def deferred_triples(self, utterance) -> Optional[Future]:
+        """
+        Parameters
+        ----------
+        utterance : Utterance
+            An utterance analyzed by :meth:`analyze_in_context`.
+
+        Returns
+        -------
+        Optional[Future]
+            A future of the triples found for the utterance by the deferred analyzers within
+            their timeout, or ``None`` if there are no deferred analyzers. The triples are not
+            merged into the utterance and may contain duplicates of its triples.
+        """
+        return self._deferred_results.pop(utterance, None)
+
+    def _collect(self, utterance, runs) -> Future:
+        result = Future()
+        remaining = [len(runs)]
+        lock = threading.Lock()
+
+        def on_done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+
+            triples = []
+            for group, working_chat, future in runs:
+                if future.exception():
+                    logger.error("Analysis by %s failed for utterance: %s", group.name, utterance.transcript,
+                                 exc_info=future.exception())
+                elif self._timeout and future.result() > self._timeout:
+                    logger.warning("Analysis by %s exceeded the timeout of %s seconds for utterance, "
+                                   "discarded %s triples: %s", group.name, self._timeout,
+                                   len(working_chat.last_utterance.triples), utterance.transcript)
+                    if self._metrics:
+                        self._metrics.increment("triple_extraction_timeout", group.name)
+                else:
+                    triples.extend(working_chat.last_utterance.triples)
+            result.set_result(triples)
+
+        for _, _, future in runs:
+            future.add_done_callback(on_done)
+
+        return result
+
+    def _analyze(self, group: _AnalyzerGroup, chat: Chat) -> float:
+        start = time.perf_counter()
+        try:
+            group.analyze_in_context(chat)
+        finally:
+            group.release()
+            duration = time.perf_counter() - start
+            if self._metrics:
+                self._metrics.record("triple_extraction", group.name, duration * 1000)
+
+        return duration
+
+    def analyze(self, utterance):
+        """Deprecated, use `analyze_in_context` instead!"""
+        for group in self._groups:
+            for analyzer in group.analyzers:
+                analyzer.analyze(utterance)
+
+    def shutdown(self):
+        for group in self._groups:
+            group.executor.shutdown(wait=False)
+
+    @property
+    def utterance(self):
+        return self._chat.last_utterance
+
+    @property
+    def triple(self):
+        return self.utterance.triple
+
+
+_SCORING_INTERNALS = ("_retokenize_dialogue", "_retokenize_triple", "_add_padding", "_tokenizer", "_device")
+"""Attributes of the triple scoring model used to build the input of a batched forward pass."""
+
+
+class BatchedTripleScoring:
+    """
+    Proxy for the triple scoring model of the conversational triple extractor, that combines
+    the candidate triples scored concurrently for different utterances into a single forward pass.
+
+    The batched input is built with the same internals of the scoring model as its ``predict``
+    method, see :data:`_SCORING_INTERNALS`. If they are not available, requests are scored with
+    ``predict`` one by one.
+
+    All other attributes are delegated to the scoring model.
+    """
+
+    def __init__(self, scoring, max_delay: float = 0.005, max_size: int = 32, metrics: MetricsRegistry = None):
+        """
+        Parameters
+        ----------
+        scoring : TripleScoring
+            The triple scoring model.
+        max_delay : float
+            Maximum time in seconds to wait for candidates of other utterances.
+        max_size : int
+            Maximum number of candidate triples in a forward pass.
+        metrics : MetricsRegistry
+            Optional registry to record the batching metrics.
+        """
+        self._scoring = scoring
+        self._batcher = MicroBatcher(self._score, max_delay, max_size, size=lambda request: len(request[1]),
+                                     name="TripleScoring", metrics=metrics)
+        self._batcher.start()
+
+    def predict(self, tokens, triples):
+        if not triples:
+            return self._scoring.predict(tokens, triples)
+
+        return self._batcher.submit((tokens, triples))
+
+    def __getattr__(self, name):
+        return getattr(self._scoring, name)
+
+    def _score(self, requests):
+        scoring = self._scoring
+        if len(requests) == 1 or not all(hasattr(scoring, name) for name in _SCORING_INTERNALS):
+            return [scoring.predict(tokens, triples) for tokens, triples in requests]
+
+        import torch
+
+        batch_input_ids, batch_speakers, batch_attn_mask = [], [], []
+        for tokens, triples in requests:
+            # Same input as the predict method of the scoring model, padded to a fixed length
+            dialog_input_ids, dialog_speakers = scoring._retokenize_dialogue(tokens)
+            for triple in triples:
+                triple_input_ids, triple_speakers = scoring._retokenize_triple(triple)
+                input_ids = dialog_input_ids + [scoring._tokenizer.unk_token_id] + triple_input_ids
+                speakers = dialog_speakers + [0] + triple_speakers
+
+                input_ids, _ = scoring._add_padding(input_ids, scoring._tokenizer.pad_token_id)
+                speakers, attn_mask = scoring._add_padding(speakers, 0)
+
+                batch_input_ids.append(input_ids)
+                batch_speakers.append(speakers)
+                batch_attn_mask.append(attn_mask)
+
+        with torch.no_grad():
+            labels = scoring(torch.LongTensor(batch_input_ids).to(scoring._device),
+                             torch.LongTensor(batch_speakers).to(scoring._device),
+                             torch.FloatTensor(batch_attn_mask).to(scoring._device))
+        labels = labels.cpu().detach().numpy()
+
+        results, offset = [], 0
+        for _, triples in requests:
+            results.append(labels[offset:offset + len(triples)])
+            offset += len(triples)
+
+        return results
+
+
+def enable_micro_batching(analyzer: Analyzer, max_delay: float, max_size: int, metrics: MetricsRegistry = None) -> bool:
+    """
+    Batch the triple scoring of the given :class:`ConversationalAnalyzer` across concurrent utterances.
+
+    Returns
+    -------
+    bool
+        ``True`` if batching was enabled, ``False`` if the analyzer has no triple scoring model.
+    """
+    extractor = getattr(analyzer, "_extractor", None)
+    scoring = getattr(extractor, "_scoring_module", None)
+    if scoring is None:
+        logger.warning("Micro-batching is not supported for %s", analyzer.__class__.__name__)
+        return False
+    missing = [name for name in _SCORING_INTERNALS if not hasattr(scoring, name)]
+    if missing and not isinstance(scoring, BatchedTripleScoring):
+        logger.warning("Micro-batching is not supported for %s, the scoring model has no %s",
+                       analyzer.__class__.__name__, ", ".join(missing))
+        return False
+
+    if not isinstance(scoring, BatchedTripleScoring):
+        extractor._scoring_module = BatchedTripleScoring(scoring, max_delay, max_size, metrics)
+        logger.info("Enabled micro-batching for %s (%s ms, %s triples)",
+                    analyzer.__class__.__name__, max_delay * 1000, max_size)
+
+    return True
+
+
+class ProgressiveTripleExtractionService(TripleExtractionService):
+    """
+    Triple extraction that publishes the triples of the deferred analyzers of a
+    :class:`ConcurrentChatAnalyzer` in a supplementary event.
+
+    The triples of the other analyzers are published as soon as they are available, the
+    supplementary event follows when the deferred analyzers complete and contains only
+    triples that were not published before for the same utterance. The supplementary
+    capsules have the author of the utterance at the time it was analyzed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._supplementary_lock = threading.Lock()
+        # Author of the supplementary capsules built by the current thread
+        self._supplementary = threading.local()
+
+    def _utterance_to_capsules(self, utterance, signal):
+        with self._supplementary_lock:
+            capsules = super()._utterance_to_capsules(utterance, signal)
+            # The chat and speaker may change or end before the deferred analyzers complete
+            author = super()._get_author()
+
+        deferred = self._extractor.deferred_triples(utterance) \
+            if isinstance(self._extractor, ConcurrentChatAnalyzer) else None
+        if deferred:
+            deferred.add_done_callback(propagate(functools.partial(self._publish_supplementary,
+                                                                   utterance, signal, author)))
+
+        return capsules
+
+    def _get_author(self):
+        author = getattr(self._supplementary, "author", None)
+
+        return author if author else super()._get_author()
+
+    def _publish_supplementary(self, utterance, signal, author: dict, deferred: Future):
+        with self._supplementary_lock:
+            triples = merge_triples(utterance, deferred.result())
+            if not triples:
+                logger.debug("No supplementary triples for signal %s (%s)", signal.id, signal.text)
+                return
+
+            supplement = SimpleNamespace(triples=triples, transcript=utterance.transcript)
+            self._supplementary.author = author
+            try:
+                capsules = super()._utterance_to_capsules(supplement, signal)
+            finally:
+                self._supplementary.author = None
+
+        self._event_bus.publish(self._output_topic, Event.for_payload(capsules))
+        logger.debug("Published %s supplementary triples for signal %s (%s): %s",
+                     len(capsules), signal.id, signal.text, capsules)
+
+
+def merge_triples(utterance, triples: Iterable[dict]) -> List[dict]:
+    """
+    Add the triples to the utterance that it does not contain yet.
+
+    Returns
+    -------
+    List[dict]
+        The triples that were added.
+    """
+    known = {_triple_key(triple) for triple in utterance.triples}
+
+    added = []
+    for triple in triples:
+        key = _triple_key(triple)
+        if key not in known:
+            known.add(key)
+            utterance.add_triple(triple)
+            added.append(triple)
+
+    return added
+
+
+def _triple_key(triple: dict) -> str:
+    elements = {element: triple[element].get("label") if isinstance(triple.get(element), dict) else None
+                for element in ("subject", "predicate", "object")}
+    elements["utterance_type"] = triple.get("utterance_type")
+
+    return json.dumps(elements, sort_keys=True, default=str)
+
+
+def _working_copy(chat: Chat) -> Chat:
+    """
+    Copy of the chat that shares the previous utterances, with a new last utterance without triples.
+    """
+    working_chat = type(chat)(chat.agent, chat.speaker)
+    working_chat.id = chat.id
+    working_chat.utterances.extend(chat.utterances[:-1])
+
+    utterance = chat.last_utterance
+    working_chat.add_utterance(utterance.transcript, utterance.utterance_speaker, list(utterance.dialogue_acts))
+
+    return working_chat
+
+
+def group_analyzers(analyzers: List[Analyzer], shared: Sequence[str]) -> List[List[Analyzer]]:
+    """
+    Group the analyzers for the :class:`ConcurrentChatAnalyzer`.
+
+    Parameters
+    ----------
+    analyzers : List[Analyzer]
+        The analyzers.
+    shared : Sequence[str]
+        Class names of analyzers that must run in the same group, all other analyzers run in
+        a group of their own.
+    """
+    shared_group = [analyzer for analyzer in analyzers if analyzer.__class__.__name__ in shared]
+    groups = [[analyzer] for analyzer in analyzers if analyzer.__class__.__name__ not in shared]
+
+    return [shared_group] + groups if shared_group else groups
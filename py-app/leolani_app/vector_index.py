@@ -0,0 +1,418 @@
+"""
+Indexed face identity store, as alternative to the agglomerative clustering of all stored embeddings.
+
+Embeddings are added to a nearest neighbour index and clustered incrementally: an embedding joins the
+clusters of all stored embeddings within the distance threshold, merging them if there are several.
+This is single linkage clustering with a distance threshold, maintained with a union-find structure
+instead of recomputed for every added embedding.
+
+The index uses `hnswlib <https://github.com/nmslib/hnswlib>`_ for approximate nearest neighbour search
+if it is installed, and exact, vectorized search with numpy otherwise. Embeddings are persisted in an
+append-only :class:`~leolani_app.embedding_store.EmbeddingStore`, which the exact search reads through
+a memory map.
+
+Compare the latency with the agglomerative clustering, e.g. from the ``py-app/`` directory::
+
+    python -m leolani_app.vector_index --sizes 1000 10000 100000
+"""
+import argparse
+import logging
+import tempfile
+import threading
+import time
+import uuid
+from typing import List, Optional, Sequence
+
+import numpy as np
+from cltl.vector_id.api import VectorIdentity
+
+from leolani_app.embedding_store import EmbeddingStore
+
+logger = logging.getLogger(__name__)
+
+
+class _NumpyIndex:
+    """Exact nearest neighbour search, over the embeddings in memory or in an :class:`EmbeddingStore`."""
+
+    def __init__(self, dim: int, store: EmbeddingStore = None, chunk_size: int = 65536):
+        self._store = store
+        self._vectors = np.empty((0 if store is not None else 1024, dim), dtype=np.float32)
+        self._norms = np.empty(1024, dtype=np.float32)
+        self._count = 0
+        self._chunk_size = chunk_size
+
+    def __len__(self):
+        return self._count
+
+    def add(self, vectors: np.ndarray):
+        """Add the vectors, with a store they must have been appended to the store already."""
+        required = self._count + len(vectors)
+        if required > len(self._norms):
+            capacity = max(required, 2 * len(self._norms))
+            self._norms = np.resize(self._norms, capacity)
+            if self._store is None:
+                self._vectors = np.resize(self._vectors, (capacity, self._vectors.shape[1]))
+
+        for start in range(0, len(vectors), self._chunk_size):
+            chunk = np.asarray(vectors[start:start + self._chunk_size])
+            offset = self._count + start
+            self._norms[offset:offset + len(chunk)] = np.einsum("ij,ij->i", chunk, chunk)
+            if self._store is None:
+                self._vectors[offset:offset + len(chunk)] = chunk
+        self._count = required
+
+    def search(self, queries: np.ndarray, k: int, radius: float) -> List[np.ndarray]:
+        """All stored vectors within the squared distance ``radius``, nearest first; ``k`` is ignored."""
+        stored = self._store.vectors if self._store is not None else self._vectors
+        query_norms = np.einsum("ij,ij->i", queries, queries)
+        matches = [[] for _ in range(len(queries))]
+        for start in range(0, self._count, self._chunk_size):
+            end = min(start + self._chunk_size, self._count)
+            distances = query_norms[:, None] + self._norms[None, start:end] - 2 * queries @ stored[start:end].T
+            for row, column in zip(*np.nonzero(distances <= radius)):
+                matches[row].append((distances[row, column], start + column))
+
+        return [np.array([index for _, index in sorted(row)], dtype=np.int64) for row in matches]
+
+
+class _HnswIndex:
+    """Approximate nearest neighbour search with hnswlib."""
+
+    def __init__(self, dim: int, ef: int = 64, m: int = 16):
+        import hnswlib
+
+        self._index = hnswlib.Index(space="l2", dim=dim)
+        self._index.init_index(max_elements=1024, ef_construction=max(ef, 100), M=m)
+        self._ef = ef
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, vectors: np.ndarray):
+        required = self._count + len(vectors)
+        if required > self._index.get_max_elements():
+            self._index.resize_index(max(required, 2 * self._index.get_max_elements()))
+
+        for start in range(0, len(vectors), 65536):
+            chunk = np.asarray(vectors[start:start + 65536])
+            self._index.add_items(chunk, np.arange(self._count + start, self._count + start + len(chunk)))
+        self._count = required
+
+    def search(self, queries: np.ndarray, k: int, radius: float) -> List[np.ndarray]:
+        """Up to ``k`` stored vectors within the squared distance ``radius``, nearest first."""
+        k = min(k, self._count)
+        self._index.set_ef(max(self._ef, k))
+        labels, distances = self._index.knn_query(queries, k=k)
+
+        return [row_labels[row_distances <= radius].astype(np.int64)
+                for row_labels, row_distances in zip(labels, distances)]
+
+
+def _create_index(backend: str, dim: int, store: EmbeddingStore = None):
+    if backend == "hnsw" or backend == "auto":
+        try:
+            return _HnswIndex(dim)
+        except ImportError:
+            if backend == "hnsw":
+                raise
+            logger.info("hnswlib is not installed, use exact nearest neighbour search")
+
+    if backend not in ("hnsw", "numpy", "auto"):
+        raise ValueError(f"Unsupported index backend: {backend}")
+
+    return _NumpyIndex(dim, store)
+
+
+class _Clusters:
+    """
+    Union-find over clusters, merged clusters keep the identity of the oldest cluster.
+
+    Changes are collected in :attr:`changes` to persist them, and restored with :meth:`apply`.
+    """
+
+    def __init__(self):
+        self.parents = []
+        self.ids = []
+        self.changes = []
+        self._by_id = {}
+
+    def new(self, identifier: str = None) -> int:
+        identifier = identifier if identifier else str(uuid.uuid4())
+        self.parents.append(len(self.parents))
+        self.ids.append(identifier)
+        self._by_id[identifier] = len(self.ids) - 1
+        self.changes.append(["new", identifier])
+
+        return len(self.parents) - 1
+
+    def find(self, cluster: int) -> int:
+        root = cluster
+        while self.parents[root] != root:
+            root = self.parents[root]
+        while self.parents[cluster] != root:
+            self.parents[cluster], cluster = root, self.parents[cluster]
+
+        return root
+
+    def union(self, clusters: Sequence[int]) -> int:
+        roots = {self.find(int(cluster)) for cluster in clusters}
+        root = min(roots)
+        for other in roots:
+            self.parents[other] = root
+        if len(roots) > 1:
+            self.changes.append(["union", sorted(roots)])
+
+        return root
+
+    def apply(self, changes: Sequence[list]):
+        for change, argument in changes:
+            if change == "new":
+                self.new(argument)
+            elif change == "union":
+                self.union(argument)
+            else:
+                raise ValueError(f"Unknown cluster change: {change}")
+        self.changes = []
+
+    def cluster(self, identifier: str) -> Optional[int]:
+        return self._by_id.get(identifier)
+
+
+class IndexedIdentity(VectorIdentity):
+    """
+    Vector identity based on a nearest neighbour index with incremental single linkage clustering.
+
+    Each added embedding gets the identity of its cluster. If an embedding connects existing clusters,
+    they are merged and keep the identity of the oldest cluster; identities returned before remain
+    valid through :meth:`resolve`.
+
+    Embeddings and clusters are persisted in an append-only :class:`EmbeddingStore`. A read-only
+    identity can share the store with a process that adds embeddings, and picks up the added
+    embeddings on each query.
+    """
+
+    @classmethod
+    def indexed(cls, distance_threshold: float = 0.66, storage_path: str = None, metric: str = "euclidean",
+                backend: str = "auto", neighbours: int = 32, read_only: bool = False):
+        """
+        Factory analogous to :meth:`ClusterIdentity.agglomerative`.
+        """
+        return cls(distance_threshold, storage_path, metric, backend, neighbours, read_only)
+
+    def __init__(self, distance_threshold: float = 0.66, storage_path: str = None, metric: str = "euclidean",
+                 backend: str = "auto", neighbours: int = 32, read_only: bool = False):
+        """
+        Parameters
+        ----------
+        distance_threshold : float
+            Maximum distance of embeddings linked in a cluster.
+        storage_path : str
+            Directory to persist the embeddings and clusters in, or ``None`` to keep them in memory only.
+        metric : str
+            ``euclidean`` or ``cosine`` distance.
+        backend : str
+            ``hnsw``, ``numpy``, or ``auto`` to use hnswlib if it is installed.
+        neighbours : int
+            Number of nearest neighbours considered by the approximate index.
+        read_only : bool
+            Only query the embeddings in the storage. Embeddings passed to :meth:`add` get the identity
+            of the nearest stored embedding, or a new identity if there is none, and are not stored.
+        """
+        if metric not in ("euclidean", "cosine"):
+            raise ValueError(f"Unsupported metric: {metric}")
+        if read_only and not storage_path:
+            raise ValueError("A read-only vector identity requires a storage path")
+
+        self._metric = metric
+        self._backend = backend
+        self._neighbours = neighbours
+        # Squared euclidean distance of the (normalized) embeddings
+        self._radius = 2 * distance_threshold if metric == "cosine" else distance_threshold ** 2
+
+        self._store = EmbeddingStore(storage_path, read_only=read_only) if storage_path else None
+        self._index = None
+        self._labels = np.empty(0, dtype=np.int64)
+        self._clusters = _Clusters()
+        self._lock = threading.Lock()
+
+        if self._store is not None and len(self._store):
+            start = time.perf_counter()
+            self._sync()
+            logger.info("Loaded %s embeddings in %s clusters from %s in %.1f s", len(self._labels),
+                        len({self._clusters.find(label) for label in set(self._labels.tolist())}),
+                        storage_path, time.perf_counter() - start)
+
+    def __len__(self) -> int:
+        return len(self._labels)
+
+    def add(self, representations: np.ndarray) -> List[str]:
+        if self._store is not None and self._store.read_only:
+            # Faces that are not in the store get an identity that is not remembered
+            return [identifier if identifier else str(uuid.uuid4()) for identifier in self.query(representations)]
+
+        vectors = self._prepare(representations)
+
+        with self._lock:
+            if self._index is None:
+                self._index = _create_index(self._backend, vectors.shape[1], self._store)
+
+            neighbours = self._index.search(vectors, self._neighbours, self._radius) \
+                if len(self._index) else [()] * len(vectors)
+            within_batch = self._pairwise(vectors)
+
+            labels = []
+            for row, row_neighbours in enumerate(neighbours):
+                linked = [self._labels[neighbour] for neighbour in row_neighbours] \
+                         + [labels[other] for other in np.nonzero(within_batch[row, :row])[0]]
+                labels.append(self._clusters.union(linked) if linked else self._clusters.new())
+            labels = np.array(labels, dtype=np.int64)
+
+            if self._store is not None:
+                self._store.append(vectors, labels, self._clusters.changes)
+            self._clusters.changes = []
+            self._index.add(vectors)
+            self._labels = np.concatenate([self._labels, labels])
+
+            return [self._clusters.ids[self._clusters.find(label)] for label in labels]
+
+    def query(self, representations: np.ndarray) -> List[Optional[str]]:
+        """
+        The identity of the nearest stored embedding within the distance threshold, without adding the embeddings.
+        """
+        vectors = self._prepare(representations)
+
+        with self._lock:
+            if self._store is not None and self._store.read_only:
+                self._sync()
+            if self._index is None or not len(self._index):
+                return [None] * len(vectors)
+
+            neighbours = self._index.search(vectors, self._neighbours, self._radius)
+
+            return [self._clusters.ids[self._clusters.find(self._labels[row[0]])] if len(row) else None
+                    for row in neighbours]
+
+    def resolve(self, identifier: str) -> Optional[str]:
+        """
+        The current identity of a cluster that may have been merged since the identity was returned.
+        """
+        with self._lock:
+            if self._store is not None and self._store.read_only:
+                self._sync()
+            cluster = self._clusters.cluster(identifier)
+
+            return self._clusters.ids[self._clusters.find(cluster)] if cluster is not None else None
+
+    def close(self):
+        if self._store is not None:
+            self._store.close()
+
+    def _sync(self):
+        """Add the embeddings from the store that are not in the index yet."""
+        self._store.refresh()
+        if len(self._store) == len(self._labels):
+            return
+
+        self._clusters.apply(self._store.read_clusters())
+        if self._index is None:
+            self._index = _create_index(self._backend, self._store.dim, self._store)
+
+        start = len(self._labels)
+        self._index.add(self._store.vectors[start:])
+        self._labels = np.concatenate([self._labels, self._store.labels[start:]])
+
+    def _prepare(self, representations: np.ndarray) -> np.ndarray:
+        vectors = np.atleast_2d(np.asarray(representations, dtype=np.float32))
+        if self._metric == "cosine":
+            vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+        return vectors
+
+    def _pairwise(self, vectors: np.ndarray) -> np.ndarray:
+        norms = np.einsum("ij,ij->i", vectors, vectors)
+
+        return norms[:, None] + norms[None, :] - 2 * vectors @ vectors.T <= self._radius
+
+
+def _synthetic_embeddings(count: int, dim: int, people: int, noise: float, seed: int = 0) -> np.ndarray:
+    random = np.random.default_rng(seed)
+    centers = random.standard_normal((people, dim)).astype(np.float32)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    samples = centers[random.integers(0, people, count)] \
+        + noise * random.standard_normal((count, dim)).astype(np.float32) / np.sqrt(dim)
+
+    return samples / np.linalg.norm(samples, axis=1, keepdims=True)
+
+
+def _benchmark_identity(create, embeddings: np.ndarray, queries: np.ndarray, batch_size: int):
+    identity = create()
+
+    start = time.perf_counter()
+    for offset in range(0, len(embeddings), batch_size):
+        identity.add(embeddings[offset:offset + batch_size])
+    fill = time.perf_counter() - start
+
+    add_latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        identity.add(query[None, :])
+        add_latencies.append(time.perf_counter() - start)
+
+    query_latency = None
+    if hasattr(identity, "query"):
+        start = time.perf_counter()
+        identity.query(queries)
+        query_latency = (time.perf_counter() - start) / len(queries)
+
+    return fill, float(np.median(add_latencies)), query_latency
+
+
+def benchmark(sizes: Sequence[int], dim: int = 512, queries: int = 20, people: int = 0, batch_size: int = 100,
+              distance_threshold: float = 0.66, baseline_max: int = 10000, backend: str = "auto"):
+    """
+    Print the latency of adding and querying embeddings at different store sizes, for the
+    indexed identity and the agglomerative clustering.
+    """
+    print(f"{'implementation':<16}{'size':>8}{'fill s':>10}{'add ms':>10}{'query ms':>10}")
+    for size in sizes:
+        embeddings = _synthetic_embeddings(size + queries, dim, people if people else max(1, size // 20), 0.3)
+        stored, probes = embeddings[:size], embeddings[size:]
+
+        implementations = [("indexed", lambda: IndexedIdentity(distance_threshold, backend=backend))]
+        if size <= baseline_max:
+            try:
+                from cltl.vector_id.clusterid import ClusterIdentity
+                storage = tempfile.mkdtemp()
+                implementations.append(
+                    ("agglomerative", lambda: ClusterIdentity.agglomerative(0, distance_threshold, storage)))
+            except ImportError:
+                logger.warning("cltl.vector_id is not installed, skip the agglomerative baseline")
+
+        for name, create in implementations:
+            fill, add, query = _benchmark_identity(create, stored, probes, batch_size)
+            print(f"{name:<16}{size:>8}{fill:>10.2f}{add * 1000:>10.2f}"
+                  f"{(query * 1000 if query is not None else float('nan')):>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the indexed vector identity against agglomerative clustering")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="Number of stored embeddings")
+    parser.add_argument("--dim", type=int, default=512, help="Dimension of the embeddings")
+    parser.add_argument("--queries", type=int, default=20, help="Number of timed single embedding adds and queries")
+    parser.add_argument("--threshold", type=float, default=0.66, help="Distance threshold of the clustering")
+    parser.add_argument("--baseline-max", type=int, default=10000,
+                        help="Largest size to run the agglomerative clustering for")
+    parser.add_argument("--backend", type=str, default="auto", choices=["auto", "hnsw", "numpy"],
+                        help="Nearest neighbour search backend")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    benchmark(args.sizes, args.dim, args.queries, distance_threshold=args.threshold,
+              baseline_max=args.baseline_max, backend=args.backend)
+
+
+if __name__ == '__main__':
+    main()